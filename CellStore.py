@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+from collections.abc import MutableMapping
+
+import numpy as np
+
+"""
+Storage backends for the non-empty cells of a ProbMap
+
+Every backend behaves like the original {(x, y): value} dict, so the scalar
+ProbMap API (get/set/delete_value_from_xy_index) keeps working, and also
+exposes a bulk interface over whole arrays for the vectorized hot paths:
+
+    index_array()           -> (n, 2) int64 grid indices
+    key_array()             -> (n,) int64 packed cell keys
+    value_array()           -> (n,) values, same order as key_array()
+    assign(values)          -> overwrite all values, same order as key_array()
+    keep(mask)              -> drop every cell whose mask entry is False
+    update_many(keys, vals) -> insert or overwrite cells by unique packed keys
+    find(keys)              -> slot of each key in key_array(), -1 if missing
+    touch(keys)             -> mark the cells as freshly measured
+    load_arrays(keys, vals) -> replace all cells, the store may keep the arrays
+
+Implementations
+---------------
+1. DictCellStore  := The original tuple-keyed dict plus the bulk interface
+2. ArrayCellStore := Contiguous packed int64 keys and float values
+3. TiledCellStore := Unbounded grid of dense tiles allocated on first touch
+"""
+
+logger = logging.getLogger(__name__)
+
+_LOW_MASK = 0xffffffff
+_SIGN_BIT = 0x80000000
+
+
+def pack_xy_index(x_ind, y_ind):
+    """Pack grid indices into int64 cell keys, x in the high 32 bits
+
+    Args:
+        x_ind (array_like): x grid indices
+        y_ind (array_like): y grid indices
+
+    Returns:
+        np.ndarray: packed int64 keys
+    """
+    x_ind = np.asarray(x_ind, dtype=np.int64)
+    y_ind = np.asarray(y_ind, dtype=np.int64)
+    return (x_ind << 32) | (y_ind & _LOW_MASK)
+
+
+def unpack_xy_index(keys):
+    """Unpack int64 cell keys into an (n, 2) array of grid indices
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    index = np.empty(keys.shape + (2,), dtype=np.int64)
+    index[..., 0] = keys >> 32
+    index[..., 1] = ((keys & _LOW_MASK) ^ _SIGN_BIT) - _SIGN_BIT
+    return index
+
+
+def _pack(index):
+    # scalar version of pack_xy_index, works on python ints
+    return (int(index[0]) << 32) | (int(index[1]) & _LOW_MASK)
+
+
+def _find_sorted(sorted_keys, order, keys):
+    """Look keys up in a sorted key array, return slots or -1
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(sorted_keys) == 0:
+        return np.full(keys.shape, -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_keys, keys)
+    pos[pos == len(sorted_keys)] = 0
+    hit = sorted_keys[pos] == keys
+    return np.where(hit, order[pos], -1)
+
+
+def find_keys(table_keys, keys):
+    """Find the position of each key in an unsorted key array
+
+    Args:
+        table_keys (np.ndarray): packed keys to search in
+        keys (array_like): packed keys to look up
+
+    Returns:
+        np.ndarray: position in table_keys, -1 if the key is missing
+    """
+    table_keys = np.asarray(table_keys, dtype=np.int64)
+    order = np.argsort(table_keys, kind='stable')
+    return _find_sorted(table_keys[order], order, keys)
+
+
+class DictCellStore(dict):
+    """The original {(x, y): value} storage with the bulk interface on top
+
+    The bulk methods convert from and to python objects, so this is only a
+    compatibility backend, use ArrayCellStore for large maps.
+    """
+
+    def __init__(self, dtype=np.float64):
+        super().__init__()
+        self.dtype = np.dtype(dtype)
+
+    def index_array(self):
+        return np.array(list(self.keys()), dtype=np.int64).reshape(-1, 2)
+
+    def key_array(self):
+        index = self.index_array()
+        return pack_xy_index(index[:, 0], index[:, 1])
+
+    def value_array(self):
+        return np.fromiter(self.values(), dtype=self.dtype, count=len(self))
+
+    def assign(self, values):
+        for cell_ind, value in zip(list(self), np.asarray(values).tolist()):
+            self[cell_ind] = value
+
+    def keep(self, mask):
+        for cell_ind, keep in zip(list(self), np.asarray(mask).tolist()):
+            if not keep:
+                del self[cell_ind]
+
+    def update_many(self, keys, values):
+        index = unpack_xy_index(keys).tolist()
+        for cell_ind, value in zip(index, np.asarray(values).tolist()):
+            self[tuple(cell_ind)] = value
+
+    def find(self, keys):
+        return find_keys(self.key_array(), keys)
+
+    def touch(self, keys):
+        pass
+
+    def load_arrays(self, keys, values):
+        self.clear()
+        self.update_many(keys, values)
+
+
+class ArrayCellStore(MutableMapping):
+    """Non-empty cells kept in contiguous NumPy arrays
+
+    Cells are stored as packed int64 keys (see pack_xy_index) and values of
+    the given dtype in two parallel arrays. A {key: slot} dict serves scalar
+    lookups and a cached argsort of the keys serves bulk lookups, both are
+    rebuilt lazily after the bulk operations invalidate them.
+    """
+
+    def __init__(self, dtype=np.float64, capacity=1024):
+        """Create an empty store
+
+        Args:
+            dtype (np.dtype, optional): Value type, float32 or float64. Defaults to np.float64.
+            capacity (int, optional): Initial number of slots. Defaults to 1024.
+        """
+        self.dtype = np.dtype(dtype)
+        self._keys = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=self.dtype)
+        self._size = 0
+        # {packed key: slot}, None if it needs to be rebuilt
+        self._slots = dict()
+        # argsort of the keys, None if it needs to be rebuilt
+        self._order = None
+
+    def _reserve(self, size):
+        if size <= len(self._keys):
+            return
+        capacity = max(size, 2 * len(self._keys))
+        keys = np.empty(capacity, dtype=np.int64)
+        values = np.empty(capacity, dtype=self.dtype)
+        keys[:self._size] = self._keys[:self._size]
+        values[:self._size] = self._values[:self._size]
+        self._keys, self._values = keys, values
+
+    def _slot_index(self):
+        if self._slots is None:
+            keys = self._keys[:self._size].tolist()
+            self._slots = dict(zip(keys, range(self._size)))
+        return self._slots
+
+    def _sorted(self):
+        if self._order is None:
+            self._order = np.argsort(self._keys[:self._size], kind='stable')
+        return self._keys[:self._size][self._order], self._order
+
+    def _invalidate(self):
+        self._slots = None
+        self._order = None
+
+    # --- mapping interface, keys are (x, y) tuples ---
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, index):
+        return _pack(index) in self._slot_index()
+
+    def __getitem__(self, index):
+        try:
+            slot = self._slot_index()[_pack(index)]
+        except KeyError:
+            raise KeyError(index) from None
+        return self._values[slot]
+
+    def __setitem__(self, index, value):
+        key = _pack(index)
+        slots = self._slot_index()
+        slot = slots.get(key)
+        if slot is None:
+            slot = self._size
+            self._reserve(slot + 1)
+            self._keys[slot] = key
+            self._size += 1
+            slots[key] = slot
+            self._order = None
+        self._values[slot] = value
+
+    def __delitem__(self, index):
+        key = _pack(index)
+        slots = self._slot_index()
+        try:
+            slot = slots.pop(key)
+        except KeyError:
+            raise KeyError(index) from None
+        # move the last cell into the hole
+        last = self._size - 1
+        if slot != last:
+            self._keys[slot] = self._keys[last]
+            self._values[slot] = self._values[last]
+            slots[int(self._keys[slot])] = slot
+        self._size = last
+        self._order = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())})"
+
+    def __iter__(self):
+        index = self.index_array()
+        return zip(index[:, 0].tolist(), index[:, 1].tolist())
+
+    def items(self):
+        return zip(self, self._values[:self._size].tolist())
+
+    def values(self):
+        return self._values[:self._size].tolist()
+
+    def clear(self):
+        self._size = 0
+        self._slots = dict()
+        self._order = None
+
+    # --- bulk interface ---
+
+    def index_array(self):
+        return unpack_xy_index(self._keys[:self._size])
+
+    def key_array(self):
+        return self._keys[:self._size]
+
+    def value_array(self):
+        return self._values[:self._size]
+
+    def assign(self, values):
+        self._values[:self._size] = values
+
+    def keep(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        kept = int(np.count_nonzero(mask))
+        if kept == self._size:
+            return
+        self._keys[:kept] = self._keys[:self._size][mask]
+        self._values[:kept] = self._values[:self._size][mask]
+        self._size = kept
+        self._invalidate()
+
+    def update_many(self, keys, values):
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), keys.shape)
+        slots = self.find(keys)
+        found = slots >= 0
+        self._values[slots[found]] = values[found]
+        new = ~found
+        count = int(np.count_nonzero(new))
+        if count:
+            start = self._size
+            self._reserve(start + count)
+            self._keys[start:start + count] = keys[new]
+            self._values[start:start + count] = values[new]
+            self._size += count
+            self._invalidate()
+
+    def find(self, keys):
+        sorted_keys, order = self._sorted()
+        return _find_sorted(sorted_keys, order, keys)
+
+    def touch(self, keys):
+        pass
+
+    def load_arrays(self, keys, values):
+        """Take over the arrays as storage, without copying them
+
+        Writable arrays are used as they are (e.g. a copy-on-write memmap),
+        they are only copied once the store grows beyond them.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.asarray(values, dtype=self.dtype)
+        if not keys.flags.writeable or not values.flags.writeable:
+            keys, values = keys.copy(), values.copy()
+        self._keys, self._values = keys, values
+        self._size = len(keys)
+        self._invalidate()
+
+
+class TiledCellStore(MutableMapping):
+    """Non-empty cells kept in fixed-size dense tiles
+
+    The unbounded grid is split into tile_size x tile_size tiles. A tile is
+    allocated from a shared pool the first time one of its cells is written,
+    NaN marks the empty cells inside it, and it goes back to the pool as soon
+    as its last cell is deleted. If max_tiles is given, allocating beyond it
+    evicts the least recently updated tile, dropping its cells. An update
+    touching more than max_tiles tiles raises ValueError.
+
+    Memory use is bounded by max_tiles * tile_size**2 * dtype.itemsize bytes.
+    """
+
+    def __init__(self, dtype=np.float64, tile_size=64, max_tiles=None, capacity=16):
+        """Create an empty store
+
+        Args:
+            dtype (np.dtype, optional): Value type, float32 or float64. Defaults to np.float64.
+            tile_size (int, optional): Number of cells per tile side. Defaults to 64.
+            max_tiles (int, optional): Maximum number of live tiles, None means no limit. Defaults to None.
+            capacity (int, optional): Initial number of tiles in the pool. Defaults to 16.
+        """
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        if max_tiles is not None:
+            capacity = min(capacity, max_tiles)
+        self._area = tile_size * tile_size
+        # one flattened tile per row
+        self._pool = np.full((capacity, self._area), np.nan, dtype=self.dtype)
+        # per pool slot: tile key, number of cells, last update tick
+        self._pool_tiles = np.zeros(capacity, dtype=np.int64)
+        self._counts = np.zeros(capacity, dtype=np.int64)
+        self._last_update = np.zeros(capacity, dtype=np.int64)
+        self._tile_slots = dict()  # {tile key: pool slot}
+        self._free = list(range(capacity - 1, -1, -1))
+        self._tick = 0
+        self._size = 0
+        # sorted flat pool positions and keys of all cells, None if stale
+        self._flat = None
+        self._keys = None
+
+    @property
+    def tile_count(self):
+        return len(self._tile_slots)
+
+    def _split(self, keys):
+        """Split packed cell keys into tile keys and positions inside the tile
+        """
+        index = unpack_xy_index(keys).reshape(-1, 2)
+        tile_xy = index // self.tile_size
+        local = index - tile_xy * self.tile_size
+        tile_keys = pack_xy_index(tile_xy[:, 0], tile_xy[:, 1])
+        return tile_keys, local[:, 0] * self.tile_size + local[:, 1]
+
+    def _split_one(self, index):
+        tile_x, local_x = divmod(int(index[0]), self.tile_size)
+        tile_y, local_y = divmod(int(index[1]), self.tile_size)
+        return _pack((tile_x, tile_y)), local_x * self.tile_size + local_y
+
+    def _grow(self):
+        old = len(self._pool_tiles)
+        capacity = 2 * old
+        if self.max_tiles is not None:
+            capacity = min(capacity, self.max_tiles)
+        pool = np.full((capacity, self._area), np.nan, dtype=self.dtype)
+        pool[:old] = self._pool
+        self._pool = pool
+        for name in ('_pool_tiles', '_counts', '_last_update'):
+            array = np.zeros(capacity, dtype=np.int64)
+            array[:old] = getattr(self, name)
+            setattr(self, name, array)
+        self._free.extend(range(capacity - 1, old - 1, -1))
+
+    def _alloc(self, tile_key, protected=()):
+        if self.max_tiles is not None and len(self._tile_slots) >= self.max_tiles:
+            self._evict(protected)
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self._tile_slots[tile_key] = slot
+        self._pool_tiles[slot] = tile_key
+        self._counts[slot] = 0
+        return slot
+
+    def _evict(self, protected):
+        slots = np.fromiter(self._tile_slots.values(), dtype=np.int64)
+        slots = slots[~np.isin(slots, list(protected))]
+        if len(slots) == 0:
+            raise ValueError(f"max_tiles={self.max_tiles} is smaller than the "
+                             f"{len(protected) + 1} tiles of a single update")
+        slot = int(slots[np.argmin(self._last_update[slots])])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Evicting tile %s", unpack_xy_index(self._pool_tiles[slot]),
+                         extra={'event': 'evict_tile'})
+        self._free_slot(slot)
+
+    def _free_slot(self, slot):
+        del self._tile_slots[int(self._pool_tiles[slot])]
+        self._size -= int(self._counts[slot])
+        self._counts[slot] = 0
+        self._pool[slot] = np.nan
+        self._free.append(slot)
+        self._flat = None
+
+    def _active(self):
+        """Sorted flat pool positions of all cells and their packed keys
+        """
+        if self._flat is None:
+            slots = np.array(sorted(self._tile_slots.values()), dtype=np.int64)
+            rows, local = np.nonzero(~np.isnan(self._pool[slots]))
+            slots = slots[rows]
+            self._flat = slots * self._area + local
+            tile_xy = unpack_xy_index(self._pool_tiles[slots]).reshape(-1, 2)
+            self._keys = pack_xy_index(
+                tile_xy[:, 0] * self.tile_size + local // self.tile_size,
+                tile_xy[:, 1] * self.tile_size + local % self.tile_size)
+        return self._flat, self._keys
+
+    # --- mapping interface, keys are (x, y) tuples ---
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        tile_key, local = self._split_one(index)
+        slot = self._tile_slots.get(tile_key)
+        if slot is None or np.isnan(self._pool[slot, local]):
+            raise KeyError(index)
+        return self._pool[slot, local]
+
+    def __setitem__(self, index, value):
+        tile_key, local = self._split_one(index)
+        slot = self._tile_slots.get(tile_key)
+        if slot is None:
+            slot = self._alloc(tile_key)
+        if np.isnan(self._pool[slot, local]):
+            self._counts[slot] += 1
+            self._size += 1
+            self._flat = None
+        self._pool[slot, local] = value
+        self._tick += 1
+        self._last_update[slot] = self._tick
+
+    def __delitem__(self, index):
+        tile_key, local = self._split_one(index)
+        slot = self._tile_slots.get(tile_key)
+        if slot is None or np.isnan(self._pool[slot, local]):
+            raise KeyError(index)
+        self._pool[slot, local] = np.nan
+        self._counts[slot] -= 1
+        self._size -= 1
+        self._flat = None
+        if self._counts[slot] == 0:
+            self._free_slot(slot)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())})"
+
+    def __iter__(self):
+        index = self.index_array()
+        return zip(index[:, 0].tolist(), index[:, 1].tolist())
+
+    def items(self):
+        return zip(self, self.value_array().tolist())
+
+    def values(self):
+        return self.value_array().tolist()
+
+    def clear(self):
+        for slot in list(self._tile_slots.values()):
+            self._free_slot(slot)
+
+    # --- bulk interface ---
+
+    def index_array(self):
+        return unpack_xy_index(self.key_array()).reshape(-1, 2)
+
+    def key_array(self):
+        return self._active()[1]
+
+    def value_array(self):
+        return self._pool.reshape(-1)[self._active()[0]]
+
+    def assign(self, values):
+        self._pool.reshape(-1)[self._active()[0]] = values
+
+    def keep(self, mask):
+        flat, keys = self._active()
+        mask = np.asarray(mask, dtype=bool)
+        dropped = flat[~mask]
+        if len(dropped) == 0:
+            return
+        self._pool.reshape(-1)[dropped] = np.nan
+        self._counts -= np.bincount(dropped // self._area,
+                                    minlength=len(self._counts))
+        self._size -= len(dropped)
+        for slot in np.unique(dropped // self._area).tolist():
+            if self._counts[slot] == 0:
+                self._free_slot(slot)
+        # the kept cells stay sorted, and none of them lived in a freed tile
+        self._flat, self._keys = flat[mask], keys[mask]
+
+    def update_many(self, keys, values):
+        tile_keys, local = self._split(keys)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), local.shape)
+        unique_tiles, inverse = np.unique(tile_keys, return_inverse=True)
+        if self.max_tiles is not None and len(unique_tiles) > self.max_tiles:
+            # checked before anything is evicted or written
+            raise ValueError(f"max_tiles={self.max_tiles} is smaller than the "
+                             f"{len(unique_tiles)} tiles of a single update")
+        unique_slots = np.empty(len(unique_tiles), dtype=np.int64)
+        for i, tile_key in enumerate(unique_tiles.tolist()):
+            slot = self._tile_slots.get(tile_key)
+            if slot is None:
+                slot = self._alloc(tile_key, unique_slots[:i])
+            unique_slots[i] = slot
+        slots = unique_slots[inverse]
+        flat = slots * self._area + local
+        pool = self._pool.reshape(-1)
+        new = np.isnan(pool[flat])
+        pool[flat] = values
+        if np.any(new):
+            self._counts += np.bincount(slots[new], minlength=len(self._counts))
+            self._size += int(np.count_nonzero(new))
+            self._flat = None
+        self._tick += 1
+        self._last_update[unique_slots] = self._tick
+
+    def find(self, keys):
+        tile_keys, local = self._split(keys)
+        unique_tiles, inverse = np.unique(tile_keys, return_inverse=True)
+        unique_slots = np.array([self._tile_slots.get(tile_key, -1)
+                                 for tile_key in unique_tiles.tolist()], dtype=np.int64)
+        slots = unique_slots[inverse]
+        flat = slots * self._area + local
+        active = self._active()[0]
+        if len(active) == 0:
+            return np.full(len(flat), -1, dtype=np.int64)
+        pos = np.searchsorted(active, flat)
+        pos[pos == len(active)] = 0
+        hit = (slots >= 0) & (active[pos] == flat)
+        return np.where(hit, pos, -1)
+
+    def touch(self, keys):
+        tile_keys, _local = self._split(keys)
+        slots = [self._tile_slots.get(tile_key)
+                 for tile_key in np.unique(tile_keys).tolist()]
+        slots = [slot for slot in slots if slot is not None]
+        if slots:
+            self._tick += 1
+            self._last_update[slots] = self._tick
+
+    def load_arrays(self, keys, values):
+        self.clear()
+        self.update_many(keys, values)
+
+
+CELL_STORES = {
+    'dict': DictCellStore,
+    'array': ArrayCellStore,
+    'tiled': TiledCellStore,
+}
+
+
+def make_cell_store(storage, dtype=np.float64):
+    """Create a cell store by backend name or from a store class
+
+    Args:
+        storage (str, type or store): One of CELL_STORES' keys, a store class,
+            or a ready-made store, e.g. TiledCellStore(max_tiles=256).
+        dtype (np.dtype, optional): Value type. Defaults to np.float64.
+    """
+    if isinstance(storage, str):
+        try:
+            storage = CELL_STORES[storage]
+        except KeyError:
+            raise ValueError(f"Unknown cell storage '{storage}'") from None
+    if isinstance(storage, type):
+        return storage(dtype=dtype)
+    return storage
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from CellStore import find_keys, unpack_xy_index
+from ProbMap import ProbMapData
+
+"""
+Delta-encoded sharing of Q maps between neighbors
+
+Every published map gets a version. A publisher sends a full snapshot the
+first time, every snapshot_interval versions, and whenever a neighbor has
+not acknowledged any version since the last snapshot; otherwise it sends a
+delta against the oldest version its neighbors acknowledged: the cells that
+moved more than the tolerance since that version, the cells sent in any
+version after it, and the cells that were deleted. So a neighbor holding
+any version from the base on can apply it, even when its acknowledgments
+lag behind. Receivers rebuild the full map locally.
+
+Implementations
+---------------
+1. DeltaEncoder := Publisher side, turns full maps into versioned payloads
+2. DeltaDecoder := Receiver side, rebuilds full maps from versioned payloads
+"""
+
+
+def _sorted_cells(keys, values):
+    order = np.argsort(keys, kind='stable')
+    return keys[order], values[order]
+
+
+def _union(arrays):
+    return np.unique(np.concatenate(arrays)) if arrays else np.empty(0, dtype=np.int64)
+
+
+class DeltaEncoder:
+
+    def __init__(self, tolerance=1e-3, snapshot_interval=50):
+        """Publisher side of the delta sharing
+
+        Args:
+            tolerance (float, optional): Smallest change of a Q value worth sending. Defaults to 1e-3.
+            snapshot_interval (int, optional): Send a full snapshot every this many versions. Defaults to 50.
+        """
+        self.tolerance = tolerance
+        self.snapshot_interval = snapshot_interval
+        self.version = 0
+        self._last_snapshot = 0
+        # The maps as the neighbors rebuilt them from the versions since the
+        # oldest one acknowledged, which the next delta is computed against:
+        # {version: (sorted keys, values, keys sent, keys deleted by that version)}
+        self._history = dict()
+        # {neighbor id: last version it acknowledged}
+        self.acked = dict()
+
+    def acknowledge(self, neighbor_id, version):
+        self.acked[neighbor_id] = version
+
+    def encode(self, keys, values, tracker_id, neighbors=()):
+        """Publish the next version of a map
+
+        Args:
+            keys (np.ndarray): packed keys of all cells
+            values (np.ndarray): Q values of all cells
+            tracker_id (int): publisher's ID
+            neighbors (iterable, optional): IDs of the neighbors that will read it. Defaults to ().
+
+        Returns:
+            ProbMapData: a full snapshot or a delta against the oldest acknowledged version
+        """
+        keys, values = _sorted_cells(np.asarray(keys, dtype=np.int64),
+                                     np.asarray(values, dtype=np.float32))
+        previous = self.version
+        self.version += 1
+        acked = [self.acked.get(e) for e in neighbors]
+        # the oldest version a neighbor holds, None if one holds none
+        base = None if None in acked else min(acked, default=previous)
+        full = (base not in self._history
+                or self.version - self._last_snapshot >= self.snapshot_interval)
+        if full:
+            data = ProbMapData.from_cells(unpack_xy_index(keys), values,
+                                          'Q', tracker_id)
+            ref_values, sent = values, keys
+            before = self._history[previous][0] if previous in self._history \
+                else np.empty(0, dtype=np.int64)
+            deleted = before[find_keys(keys, before) < 0]
+            self._last_snapshot = self.version
+        else:
+            base_keys, base_values, _, _ = self._history[base]
+            # a neighbor may hold any version since the base, so the cells
+            # sent or deleted after it are sent again
+            after = [self._history[v] for v in range(base + 1, self.version)]
+            sent_after = _union([ref[2] for ref in after])
+            slots = find_keys(base_keys, keys)
+            known = slots >= 0
+            changed = ~known
+            changed[known] = np.abs(values[known] - base_values[slots[known]]) \
+                > self.tolerance
+            changed |= find_keys(_union([sent_after] + [ref[3] for ref in after]), keys) >= 0
+            gone = np.union1d(base_keys, sent_after)
+            deleted = gone[find_keys(keys, gone) < 0]
+            data = ProbMapData.from_cells(unpack_xy_index(keys[changed]),
+                                          values[changed], 'Q', tracker_id)
+            data.set_deleted(deleted)
+            data.base_version = base
+            # cells within the tolerance keep the value the neighbors hold
+            unchanged = known & ~changed
+            ref_values = values.copy()
+            ref_values[unchanged] = base_values[slots[unchanged]]
+            sent = keys[changed]
+        # acknowledgments only move forward, older versions are never a base
+        # again, and none older than the snapshot interval is kept
+        oldest = max(min([a for a in acked if a is not None], default=0),
+                     self.version - self.snapshot_interval)
+        self._history = {v: ref for v, ref in self._history.items() if v >= oldest}
+        self._history[self.version] = (keys, ref_values, sent, deleted)
+        data.version = self.version
+        return data
+
+
+class DeltaDecoder:
+
+    def __init__(self):
+        """Receiver side of the delta sharing, one rebuilt map per publisher
+        """
+        # {publisher id: (version, sorted keys, values, rebuilt ProbMapData)}
+        self.maps = dict()
+
+    def decode(self, data):
+        """Rebuild a publisher's full map from its latest payload
+
+        Unversioned payloads are passed through. A delta whose base is newer
+        than the version held here cannot be applied, the previous map is kept
+        until the publisher sends a snapshot or a delta against an older base.
+
+        Args:
+            data (ProbMapData): payload from a neighbor
+
+        Returns:
+            ProbMapData: the publisher's full map, its version is the one rebuilt here.
+                None if no snapshot arrived yet.
+        """
+        if data.version == 0:
+            return data
+        version, keys, values, full = self.maps.get(data.tracker_id, (0, None, None, None))
+        if data.version <= version:
+            return full
+        if not data.is_delta:
+            keys, values = _sorted_cells(data.key_array(), data.values)
+        elif data.base_version <= version:
+            kept = find_keys(data.deleted_key_array(), keys) < 0
+            kept &= find_keys(data.key_array(), keys) < 0
+            keys, values = _sorted_cells(
+                np.concatenate((keys[kept], data.key_array())),
+                np.concatenate((values[kept], data.values)))
+        else:
+            return full
+        full = ProbMapData.from_cells(unpack_xy_index(keys), values,
+                                      'Q', data.tracker_id)
+        full.version = data.version
+        self.maps[data.tracker_id] = (data.version, keys, values, full)
+        return full
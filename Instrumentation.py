@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import json
+import time
+
+import numpy as np
+
+"""
+Per-step timing and counters of the trackers
+
+A tracker with a recorder attached (see Tracker.stats) times its phases and
+counts what it did, the simulator collects every recorder once per step
+into one row per tracker. Trackers without a recorder only pay one
+attribute check per phase.
+
+Timings are stored as 'time_<phase>' [s], everything else is a count.
+
+Implementations
+---------------
+1. StepRecorder := One tracker's timings and counters of the current step
+2. Instrumentation := Rows of all trackers and steps, histograms and export
+"""
+
+
+class StepRecorder:
+
+    def __init__(self):
+        """One tracker's timings and counters of the current step
+        """
+        self.record = dict()
+
+    def add(self, name, value):
+        self.record[name] = self.record.get(name, 0) + value
+
+    def set(self, name, value):
+        self.record[name] = value
+
+    def add_time(self, phase, seconds):
+        self.add('time_' + phase, seconds)
+
+    def timed(self, phase, func, *args, **kwargs):
+        """Call func and add its wall time to the phase
+        """
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.add_time(phase, time.perf_counter() - start)
+        return result
+
+    def pop(self):
+        record, self.record = self.record, dict()
+        return record
+
+
+class Instrumentation:
+
+    def __init__(self):
+        """Rows of timings and counters, one per tracker and step
+
+        The simulator's own timings (e.g. batched sensing and the whole
+        step) are stored in a row with tracker -1.
+        """
+        self.rows = []
+        self.simulator = StepRecorder()
+
+    def collect(self, step, trackers):
+        """Move the trackers' current records into rows
+
+        Args:
+            step (int): step number
+            trackers (list): trackers with a StepRecorder as stats
+        """
+        for t in trackers:
+            if t.stats is not None:
+                self.rows.append(dict(step=step, tracker=t.id, **t.stats.pop()))
+        self.rows.append(dict(step=step, tracker=-1, **self.simulator.pop()))
+
+    def clear(self):
+        self.rows = []
+
+    @property
+    def metrics(self):
+        """Names of all recorded timings and counters
+        """
+        names = dict()
+        for row in self.rows:
+            names.update(dict.fromkeys(row))
+        return [name for name in names if name not in ('step', 'tracker')]
+
+    def column(self, metric, tracker_rows=True):
+        """All recorded values of one metric
+
+        Args:
+            metric (str): timing or counter name
+            tracker_rows (bool, optional): Only the trackers' rows, or only the simulator's. Defaults to True.
+
+        Returns:
+            np.ndarray: one value per row that recorded the metric
+        """
+        return np.array([row[metric] for row in self.rows
+                         if metric in row and (row['tracker'] >= 0) == tracker_rows],
+                        dtype=np.float64)
+
+    def histogram(self, metric, bins=20, tracker_rows=True):
+        """Histogram of one metric over all rows
+
+        Returns:
+            tuple: (counts, bin edges), see np.histogram
+        """
+        return np.histogram(self.column(metric, tracker_rows), bins=bins)
+
+    def histograms(self, bins=20):
+        """Histograms of all metrics of the trackers' rows
+
+        Returns:
+            dict: {metric: (counts, bin edges)}
+        """
+        return {metric: self.histogram(metric, bins) for metric in self.metrics
+                if len(self.column(metric))}
+
+    def summary(self):
+        """Mean, percentiles and total of every metric, trackers' and simulator's rows apart
+
+        Returns:
+            dict: {metric: {'count', 'mean', 'p50', 'p95', 'max', 'total'}}, simulator
+                metrics are prefixed with 'simulator.'
+        """
+        summary = dict()
+        for metric in self.metrics:
+            for tracker_rows, prefix in ((True, ''), (False, 'simulator.')):
+                values = self.column(metric, tracker_rows)
+                if len(values) == 0:
+                    continue
+                summary[prefix + metric] = {
+                    'count': len(values),
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p95': float(np.percentile(values, 95)),
+                    'max': float(values.max()),
+                    'total': float(values.sum()),
+                }
+        return summary
+
+    def to_csv(self, path):
+        """Write all rows as CSV, metrics a row didn't record are left empty
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['step', 'tracker'] + self.metrics)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def to_json(self, path, bins=20):
+        """Write all rows, the summary and the histograms as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump({'rows': self.rows,
+                       'summary': self.summary(),
+                       'histograms': {metric: {'counts': counts.tolist(), 'edges': edges.tolist()}
+                                      for metric, (counts, edges) in self.histograms(bins).items()}},
+                      f, indent=1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+"""
+Structure-of-arrays motion state of robots
+
+All robots of a group live in parallel arrays (positions, waypoints, speeds,
+headings, ...), so a whole group is advanced with a few array operations.
+Robot objects only keep their slot and read and write their row.
+
+Implementations
+---------------
+1. Kinematics := Motion state of a group of robots, waypoint following
+"""
+
+
+class Kinematics:
+    # per-robot arrays: (name, shape of one row, dtype)
+    fields = (
+        ('position', (2,), np.float64),
+        ('desired_position', (2,), np.float64),
+        ('speed', (), np.float64),
+        ('max_speed', (), np.float64),
+        ('ang', (), np.float64),
+        ('rate', (), np.float64),
+        ('in_position', (), bool),
+    )
+
+    def __init__(self, capacity=64):
+        """Motion state of a group of robots
+
+        Args:
+            capacity (int, optional): Initial number of slots. Defaults to 64.
+        """
+        self.size = 0
+        for name, shape, dtype in self.fields:
+            setattr(self, name, np.zeros((capacity,) + shape, dtype=dtype))
+
+    @classmethod
+    def from_arrays(cls, arrays, size):
+        """Motion state in existing arrays, e.g. in shared memory
+
+        Args:
+            arrays (dict): {field name: array with a row per slot}, see fields
+            size (int): number of robots
+
+        Returns:
+            Kinematics: the group, its arrays are the given ones
+        """
+        group = cls.__new__(cls)
+        group.size = size
+        for name, _shape, _dtype in cls.fields:
+            setattr(group, name, arrays[name])
+        return group
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, size):
+        capacity = len(self.position)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, shape, dtype in self.fields:
+            array = np.zeros((capacity,) + shape, dtype=dtype)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+
+    def add(self, position, ang, max_speed, rate):
+        """Add a robot standing at its waypoint
+
+        Returns:
+            int: the robot's slot
+        """
+        self._reserve(self.size + 1)
+        slot = self.size
+        self.size += 1
+        self.position[slot] = position
+        self.desired_position[slot] = position
+        self.speed[slot] = 0.
+        self.max_speed[slot] = max_speed
+        self.ang[slot] = ang
+        self.rate[slot] = rate
+        self.in_position[slot] = True
+        return slot
+
+    def subset(self, slots):
+        """Copy the state of some robots into a new group, in the given order
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        group = Kinematics(capacity=max(len(slots), 1))
+        group.size = len(slots)
+        for name, _shape, _dtype in self.fields:
+            getattr(group, name)[:len(slots)] = getattr(self, name)[slots]
+        return group
+
+    def advance(self, slots, speed=None):
+        """Move robots one time step towards their waypoints
+
+        Same as Robot.waypoint_ctrl without a new waypoint, for many robots.
+
+        Args:
+            slots (np.ndarray): slots of the robots to move
+            speed (float or np.ndarray, optional): New speed [m/s], None for the maximum speed.
+                Defaults to None.
+
+        Returns:
+            np.ndarray: in_position of the robots after the move
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        if speed is None:
+            self.speed[slots] = self.max_speed[slots]
+        else:
+            self.speed[slots] = speed
+        position = self.position[slots]
+        desired = self.desired_position[slots]
+        moving = np.any(position != desired, axis=1)
+        if np.any(moving):
+            moved = slots[moving]
+            position, desired = position[moving], desired[moving]
+            speed, rate = self.speed[moved], self.rate[moved]
+            one_time_step_length = speed/rate
+            difference = desired - position
+            # the same dot product np.linalg.norm takes for a single vector
+            distance = np.sqrt((difference[:, None, :] @ difference[:, :, None])[:, 0, 0])
+            # if it's close enough to the goal position, make it in position
+            arrived = distance <= one_time_step_length
+            # move to the goal point at the given speed
+            direction = difference/np.where(arrived, 1., distance)[:, None]
+            self.position[moved] = np.where(
+                arrived[:, None], desired,
+                position + direction*speed[:, None]/rate[:, None])
+            self.in_position[moved] = arrived
+        return self.in_position[slots]
+
+    def set_waypoints(self, slots, offsets, speed):
+        """Send robots to a waypoint relative to their position, then move them
+
+        Args:
+            slots (np.ndarray): slots of the robots
+            offsets (np.ndarray): (n, 2) waypoints relative to the robots' positions [m]
+            speed (float): speed [m/s]
+
+        Returns:
+            np.ndarray: in_position of the robots after the move
+        """
+        self.desired_position[slots] = self.position[slots] + offsets
+        return self.advance(slots, speed)
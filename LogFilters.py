@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+"""
+Logging filters for messages logged on every step
+
+Implementations
+---------------
+1. RateLimitFilter := Lets a repeated message through at most once per interval, or every n-th time
+2. limit_warnings := Attaches a RateLimitFilter to the per-step loggers
+"""
+
+# loggers of the per-step code paths
+STEP_LOGGERS = ('ProbMap', 'tracker', 'CellStore')
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, interval=1.0, every=None, level=logging.WARNING):
+        """Rate limit or sample repeated log messages
+
+        Messages are told apart by their unformatted message, so the same
+        warning with different arguments counts as a repetition. The first
+        message that passes after some were dropped tells how many.
+
+        Args:
+            interval (float, optional): Let a message through at most once per this many seconds. Defaults to 1.0.
+            every (int, optional): Sample instead, let every n-th repetition through. Defaults to None.
+            level (int, optional): Messages below this level are never dropped. Defaults to logging.WARNING.
+        """
+        super().__init__()
+        self.interval = interval
+        self.every = every
+        self.level = level
+        # {message: [time it last passed, repetitions dropped since]}
+        self._seen = dict()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.msg)
+        seen = self._seen.get(key)
+        if seen is None:
+            self._seen[key] = [time.monotonic(), 0]
+            return True
+        if self.every is not None:
+            passed = (seen[1] + 1) % self.every == 0
+        else:
+            passed = time.monotonic() - seen[0] >= self.interval
+        if not passed:
+            seen[1] += 1
+            return False
+        if seen[1]:
+            record.msg = f"{record.msg} [{seen[1]} similar messages suppressed]"
+        self._seen[key] = [time.monotonic(), 0]
+        return True
+
+
+def limit_warnings(interval=1.0, every=None, loggers=STEP_LOGGERS):
+    """Rate limit the repeated warnings of the per-step loggers
+
+    Replaces the RateLimitFilter attached by an earlier call, so calling it
+    again, e.g. on every Simsim.run, doesn't pile up filters.
+
+    Args:
+        interval (float, optional): See RateLimitFilter. Defaults to 1.0.
+        every (int, optional): See RateLimitFilter. Defaults to None.
+        loggers (tuple, optional): Logger names. Defaults to STEP_LOGGERS.
+
+    Returns:
+        RateLimitFilter: the attached filter, remove it with remove_filter
+    """
+    rate_limit = RateLimitFilter(interval, every)
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for log_filter in [f for f in logger.filters if isinstance(f, RateLimitFilter)]:
+            logger.removeFilter(log_filter)
+        logger.addFilter(rate_limit)
+    return rate_limit
+
+
+def remove_filter(log_filter, loggers=STEP_LOGGERS):
+    for name in loggers:
+        logging.getLogger(name).removeFilter(log_filter)
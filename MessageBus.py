@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+
+import numpy as np
+
+from Instrumentation import StepRecorder
+
+"""
+Simulated network between the trackers
+
+Every (publisher, reader) pair is a link with its own latency, bandwidth and
+drop rate. A link has one sender coroutine that waits for payloads, sends
+them as frames and hands each frame that is not dropped to the reader after
+the latency. Delivered payloads end up in a Simsim.Topics topic per link and
+kind of payload, where the reader picks up the latest one, taking it off the
+link if it must be read only once. Acknowledgments of delta sharing travel
+back over the link from the reader to the publisher like payloads and are
+handed to on_ack when they arrive.
+
+All coroutines run on simulated time: they only wait on the bus' clock, and
+run_until runs the event loop until every timer up to the given time fired
+and every coroutine is waiting again. So runs are reproducible and as fast
+as the computer allows, whatever the simulated latencies.
+
+    frame = overhead + the payloads sent together
+    transmission = frame size / bandwidth, one frame at a time per link
+    arrival = end of the transmission + latency, unless the frame is dropped
+
+Implementations
+---------------
+1. Link := Latency, bandwidth, drop rate and per-frame overhead of a link
+2. MessageBus := Links between trackers, batching, coalescing, simulated clock
+"""
+
+# bytes of an acknowledgment, the version
+_ACK_SIZE = 8
+
+
+class Link:
+
+    def __init__(self, latency=0., bandwidth=None, drop_rate=0., overhead=0):
+        """Model of a link
+
+        Args:
+            latency (float, optional): Delay between the end of the transmission and the arrival [s]. Defaults to 0.
+            bandwidth (float, optional): [byte/s], None for no limit. Defaults to None.
+            drop_rate (float, optional): Probability of losing a frame. Defaults to 0.
+            overhead (int, optional): Bytes added to every frame. Defaults to 0.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.overhead = overhead
+
+
+class _LinkState:
+    # a link's topics, queued payloads and sender
+
+    def __init__(self, model, topics, publisher, reader):
+        self.model = model
+        self.publisher = publisher
+        self.reader = reader
+        # {kind: topic}
+        self.topics = topics
+        # (kind, payload, time it was published) not sent yet, kind 'ack'
+        # for acknowledgments with the version as payload
+        self.pending = []
+        # resolved to wake the waiting sender
+        self.wakeup = None
+
+
+class MessageBus:
+
+    def __init__(self, topics, latency=0., bandwidth=None, drop_rate=0., overhead=0,
+                 batch_interval=0., coalesce=('v', 'Q', 'ack'), rng=None, on_ack=None):
+        """Links between trackers, running on simulated time
+
+        The link arguments are the default Link, set_link changes single links.
+
+        Args:
+            topics (Simsim.Topics): where delivered payloads are published
+            latency (float, optional): See Link. Defaults to 0.
+            bandwidth (float, optional): See Link. Defaults to None.
+            drop_rate (float, optional): See Link. Defaults to 0.
+            overhead (int, optional): See Link. Defaults to 0.
+            batch_interval (float, optional): Collect payloads this long before sending them as one frame [s].
+                Defaults to 0.
+            coalesce (tuple, optional): Kinds of payloads where a newer one replaces a queued older one.
+                Deltas never replace, they need the payload before them. Defaults to ('v', 'Q', 'ack').
+            rng (np.random.Generator, optional): Draws the dropped frames. Defaults to None.
+            on_ack (callable, optional): Called with (publisher, reader, version) for every
+                acknowledgment that arrives. Defaults to None.
+        """
+        self.topics = topics
+        self.default_link = Link(latency, bandwidth, drop_rate, overhead)
+        self.batch_interval = batch_interval
+        self.coalesce = coalesce
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.on_ack = on_ack
+        # {(publisher, reader): Link} links not using the default
+        self.link_models = dict()
+        # {(publisher, reader): _LinkState}
+        self._links = dict()
+        # counters since the last stats.pop(): sent, acks, coalesced, frames,
+        # bytes, dropped, delivered, latency (summed over the delivered).
+        # sent, coalesced, dropped and delivered include the acknowledgments.
+        self.stats = StepRecorder()
+        self.now = 0.
+        self._loop = asyncio.new_event_loop()
+        # (time, sequence number, callback) of the clock
+        self._timers = []
+        self._sequence = 0
+        # coroutines that are not waiting on the clock or for payloads
+        self._runnable = 0
+        self._tasks = []
+
+    def set_link(self, publisher, reader, link):
+        """Use another model for the link from publisher to reader
+
+        Args:
+            publisher (int): publisher's ID
+            reader (int): reader's ID
+            link (Link): model of the link
+        """
+        self.link_models[(publisher, reader)] = link
+        if (publisher, reader) in self._links:
+            self._links[(publisher, reader)].model = link
+
+    def _call_at(self, when, callback):
+        heapq.heappush(self._timers, (when, self._sequence, callback))
+        self._sequence += 1
+
+    def _wake(self, future):
+        self._runnable += 1
+        future.set_result(None)
+
+    async def _wait(self, future):
+        self._runnable -= 1
+        await future
+
+    async def _sleep(self, duration):
+        future = self._loop.create_future()
+        self._call_at(self.now + duration, lambda: self._wake(future))
+        await self._wait(future)
+
+    def _link(self, publisher, reader):
+        state = self._links.get((publisher, reader))
+        if state is None:
+            model = self.link_models.get((publisher, reader), self.default_link)
+            state = _LinkState(model, dict(), publisher, reader)
+            self._links[(publisher, reader)] = state
+            self._runnable += 1
+            self._tasks.append(self._loop.create_task(self._send_loop(state)))
+        return state
+
+    def _queue(self, state, kind, data, replaces):
+        self.stats.add('sent', 1)
+        if replaces and state.pending:
+            kept = [p for p in state.pending if p[0] != kind]
+            self.stats.add('coalesced', len(state.pending) - len(kept))
+            state.pending = kept
+        state.pending.append((kind, data, self.now))
+        if state.wakeup is not None:
+            self._wake(state.wakeup)
+            state.wakeup = None
+
+    def publish(self, publisher, kind, data, readers):
+        """Queue a payload on the links to the readers
+
+        Args:
+            publisher (int): publisher's ID
+            kind (str): 'v' or 'Q'
+            data (ProbMapData): the payload
+            readers (iterable): IDs of the readers
+        """
+        replaces = kind in self.coalesce and not data.is_delta
+        for reader in readers:
+            state = self._link(publisher, reader)
+            if kind not in state.topics:
+                state.topics[kind] = f"{kind}/{publisher}/{reader}"
+                # readers only use the latest payload
+                self.topics.add_topic(state.topics[kind], maxlen=1)
+            self._queue(state, kind, data, replaces)
+
+    def acknowledge(self, publisher, reader, version):
+        """Queue a reader's acknowledgment of a Q map version on the link back to the publisher
+
+        Args:
+            publisher (int): publisher's ID
+            reader (int): reader's ID
+            version (int): version of the publisher's map the reader holds
+        """
+        self.stats.add('acks', 1)
+        # a newer acknowledgment covers the older ones
+        self._queue(self._link(reader, publisher), 'ack', version, 'ack' in self.coalesce)
+
+    def receive(self, publisher, reader, kind, consume=False):
+        """The latest payload delivered from publisher to reader
+
+        Args:
+            publisher (int): publisher's ID
+            reader (int): reader's ID
+            kind (str): 'v' or 'Q'
+            consume (bool, optional): Take it off the link, so it is read only once. Defaults to False.
+
+        Returns:
+            ProbMapData: the payload, None if nothing arrived since it was consumed
+        """
+        state = self._links.get((publisher, reader))
+        if state is None or kind not in state.topics:
+            return None
+        delivered = self.topics.subs(state.topics[kind])
+        if not delivered:
+            return None
+        return delivered.pop() if consume else delivered[-1]
+
+    async def _send_loop(self, state):
+        while True:
+            if not state.pending:
+                state.wakeup = self._loop.create_future()
+                await self._wait(state.wakeup)
+            if self.batch_interval:
+                await self._sleep(self.batch_interval)
+            frame, state.pending = state.pending, []
+            model = state.model
+            size = model.overhead + sum(_ACK_SIZE if kind == 'ack' else data.nbytes()
+                                        for kind, data, _ in frame)
+            self.stats.add('frames', 1)
+            self.stats.add('bytes', size)
+            if model.bandwidth:
+                await self._sleep(size / model.bandwidth)
+            if model.drop_rate and self.rng.random() < model.drop_rate:
+                self.stats.add('dropped', len(frame))
+                continue
+            self._call_at(self.now + model.latency,
+                          lambda state=state, frame=frame: self._deliver(state, frame))
+
+    def _deliver(self, state, frame):
+        for kind, data, published in frame:
+            if kind != 'ack':
+                self.topics.publish(state.topics[kind], data)
+            elif self.on_ack is not None:
+                # the link runs from the reader back to the publisher
+                self.on_ack(state.reader, state.publisher, data)
+            self.stats.add('delivered', 1)
+            self.stats.add('latency', self.now - published)
+
+    async def _run_until(self, when):
+        while True:
+            # let every woken coroutine run until it waits again
+            while self._runnable:
+                await asyncio.sleep(0)
+            if not self._timers or self._timers[0][0] > when:
+                break
+            time, _, callback = heapq.heappop(self._timers)
+            self.now = max(self.now, time)
+            callback()
+        self.now = max(self.now, when)
+
+    def run_until(self, when):
+        """Advance the simulated time, sending and delivering everything due
+
+        Must not be called from a running event loop.
+
+        Args:
+            when (float): simulated time [s]
+        """
+        self._loop.run_until_complete(self._run_until(when))
+
+    def close(self):
+        """Stop the senders, payloads in flight are lost
+        """
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            self._loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+        self._tasks = []
+        self._loop.close()
+
+    def __del__(self):
+        if not self._loop.is_closed() and not self._loop.is_running():
+            self.close()
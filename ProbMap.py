@@ -2,6 +2,15 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import logging
+import os
+import struct
+import tempfile
+from collections.abc import Mapping
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from CellStore import find_keys, make_cell_store, pack_xy_index, unpack_xy_index
 
 """
 Tracking implementation for the perimeter monitoring problem
@@ -18,27 +27,179 @@ References
 
 """
 
+logger = logging.getLogger(__name__)
+
+
+def _measurement_arrays(measurement):
+    """Convert {(x, y): value} or a (keys, values) tuple into packed keys and float64 values
+    """
+    if isinstance(measurement, tuple):
+        keys, values = measurement
+        return np.asarray(keys, dtype=np.int64), np.asarray(values, dtype=np.float64)
+    index = np.array(list(measurement), dtype=np.int64).reshape(-1, 2)
+    keys = pack_xy_index(index[:, 0], index[:, 1])
+    values = np.fromiter(measurement.values(), dtype=np.float64,
+                         count=len(measurement))
+    return keys, values
+
+
+def aggregate_cells(payloads):
+    """Sum up the values per cell over several payloads
+
+    Args:
+        payloads (iterable): ProbMapData from neighbors
+
+    Returns:
+        tuple: (packed keys, sums, counts), one entry per distinct cell, sorted by key
+    """
+    payloads = list(payloads)
+    keys = np.concatenate([p.key_array() for p in payloads]
+                          + [np.empty(0, dtype=np.int64)])
+    values = np.concatenate([p.values for p in payloads]
+                            + [np.empty(0)]).astype(np.float64)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    # bincount adds in input order, like accumulating payload by payload
+    sums = np.bincount(inverse, weights=values, minlength=len(keys))
+    counts = np.bincount(inverse, minlength=len(keys)).astype(np.float64)
+    return keys, sums, counts
+
+
+def _neighbor_map_arrays(neighbors_map):
+    """Convert {(x, y): [value, count]} or a (keys, sums, counts) tuple into arrays
+    """
+    if isinstance(neighbors_map, tuple):
+        keys, sums, counts = neighbors_map
+        return (np.asarray(keys, dtype=np.int64),
+                np.asarray(sums, dtype=np.float64),
+                np.asarray(counts, dtype=np.float64))
+    keys, _values = _measurement_arrays(
+        {cell_ind: 0. for cell_ind in neighbors_map})
+    sums_counts = np.array(list(neighbors_map.values()),
+                           dtype=np.float64).reshape(-1, 2)
+    return keys, sums_counts[:, 0], sums_counts[:, 1]
+
+
+def _scatter(size, slots, values, default):
+    """Place values at their slots in an array filled with default
+    """
+    out = np.full(size, default, dtype=np.float64)
+    hit = slots >= 0
+    out[slots[hit]] = values[hit]
+    return out
+
+
+def _gather(keys, table_keys, table_values, default):
+    """Look keys up in (table_keys, table_values), default where missing
+    """
+    slots = find_keys(table_keys, keys)
+    out = np.full(len(slots), default, dtype=np.float64)
+    hit = slots >= 0
+    out[hit] = table_values[slots[hit]]
+    return out
+
+
+def _drop_empty(store, values):
+    """Delete cells holding the 'no information' sentinel, see set_value_from_xy_index
+    """
+    empty = values == 35.0
+    if np.any(empty):
+        store.keep(~empty)
+
+
+def label_cells(keys):
+    """Label the 8-connected components of a set of cells
+
+    Args:
+        keys (np.ndarray): packed keys of the cells
+
+    Returns:
+        tuple: (number of components, (n,) component label of each cell)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    index = unpack_xy_index(keys)
+    # every edge once, from each cell to its upper and right neighbors
+    offsets = np.array([[1, -1], [1, 0], [1, 1], [0, 1]])
+    neighbors = index[None, :, :] + offsets[:, None, :]
+    slots = find_keys(keys, pack_xy_index(neighbors[..., 0], neighbors[..., 1]))
+    rows = np.broadcast_to(np.arange(len(keys)), slots.shape)
+    linked = slots >= 0
+    rows, cols = rows[linked], slots[linked]
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(len(keys), len(keys)))
+    return connected_components(graph, directed=False)
+
+
+class ProbCells(Mapping):
+    """Read-only {(x, y): probability} view over parallel arrays
+
+    Holds what convert_to_prob_map kept as packed keys and probabilities,
+    bulk consumers read the arrays and everything else can treat it like
+    the dict it used to be.
+    """
+
+    def __init__(self, keys=None, probs=None):
+        self.keys_array = np.empty(0, dtype=np.int64) if keys is None \
+            else np.asarray(keys, dtype=np.int64)
+        self.probs = np.empty(0) if probs is None else np.asarray(probs)
+        self._slots = None
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __getitem__(self, index):
+        if self._slots is None:
+            self._slots = dict(zip(self.keys_array.tolist(), range(len(self))))
+        return self.probs[self._slots[int(pack_xy_index(index[0], index[1]))]]
+
+    def __iter__(self):
+        return iter(map(tuple, self.index_array().tolist()))
+
+    def __repr__(self):
+        return repr(dict(zip(self, self.probs.tolist())))
+
+    def index_array(self):
+        return unpack_xy_index(self.keys_array)
+
+    def key_array(self):
+        return self.keys_array
+
+    def value_array(self):
+        return self.probs
+
 
 class ProbMap:
+    # magic, value dtype, width, height (-1 if unbounded), resolution, center x, center y,
+    # lower left corner x, y, initial value, false alarm probability, number of cells
+    _snapshot_header = struct.Struct('<4s8sqq7dQ')
+    _snapshot_magic = b'PMS1'
 
     def __init__(self, width_meter, height_meter, resolution,
-                 center_x, center_y, init_val=0.01, false_alarm_prob=0.05):
+                 center_x, center_y, init_val=0.01, false_alarm_prob=0.05,
+                 storage=None, dtype=np.float64):
         """Generate a probability map
 
         Args:
-            width_meter (int): width of the area [m]
-            height_meter (int): height of the area [m]
+            width_meter (int): width of the area [m], None for an unbounded map
+            height_meter (int): height of the area [m], None for an unbounded map
             resolution (float): grid resolution [m]
             center_x (float): center x position  [m]
             center_y (float): center y position  [m]
             init_val (float, optional): Initial value for all cells. Defaults to 0.01.
             false_alarm_prob (float, optional): False alarm probability of the detector. Defaults to 0.05.
+            storage (str or type, optional): Cell storage backend, 'dict', 'array' or 'tiled' (see CellStore).
+                Defaults to 'tiled' for unbounded maps and 'dict' otherwise.
+            dtype (np.dtype, optional): Type of the stored log values. Defaults to np.float64.
         """
-        # TODO make this grid map unlimited, deprecate the width and height params
-        # number of cells for width
-        self.width = int(np.ceil(width_meter / resolution))
-        # number of cells for height
-        self.height = int(np.ceil(height_meter / resolution))
+        # An unbounded map has no width and height, the cell (0, 0) starts at the center
+        self.unbounded = width_meter is None or height_meter is None
+        if self.unbounded:
+            self.width = None
+            self.height = None
+        else:
+            # number of cells for width
+            self.width = int(np.ceil(width_meter / resolution))
+            # number of cells for height
+            self.height = int(np.ceil(height_meter / resolution))
         self.resolution = resolution
         self.center_x = center_x
         self.center_y = center_y
@@ -47,22 +208,30 @@ class ProbMap:
         # pre-calculated v for detected or not detected targets
         self.v_for_1 = np.log(self.false_alarm_prob/(1-self.false_alarm_prob))
         self.v_for_0 = np.log((1-self.false_alarm_prob)/self.false_alarm_prob)
-        
 
-        self._left_lower_x = self.center_x - self.width / 2.0 * self.resolution
-        self._left_lower_y = self.center_y - self.height / 2.0 * self.resolution
+        if self.unbounded:
+            self._left_lower_x = self.center_x
+            self._left_lower_y = self.center_y
+            self.ndata = None
+        else:
+            self._left_lower_x = self.center_x - self.width / 2.0 * self.resolution
+            self._left_lower_y = self.center_y - self.height / 2.0 * self.resolution
+            self.ndata = self.width * self.height
 
-        self.ndata = self.width * self.height
+        if storage is None:
+            storage = 'tiled' if self.unbounded else 'dict'
         # this stores all data, {grid_inx: grid_value}
-        self.non_empty_cell = dict()
+        self.non_empty_cell = make_cell_store(storage, dtype)
+        # cells kept by the last convert_to_prob_map, {grid_inx: probability}
+        self.prob_map = ProbCells()
 
     def _calc_xy_index_from_pos(self, pos, lower_pos, max_index):
         """Calculate the grid index by position
         """
         ind = int(np.floor((pos - lower_pos) / self.resolution))
-        if not 0 <= ind <= max_index:
+        if max_index is not None and not 0 <= ind < max_index:
             # XXX may not need this warning
-            logging.warning("Position not within the area")
+            logger.warning("Position not within the area")
         return ind
 
     def _calc_pos_from_xy_index(self, ind, lower_pos, _max_index):
@@ -102,6 +271,51 @@ class ProbMap:
             y_ind, self._left_lower_y, self.height)
         return tuple([x_pos, y_pos])
 
+    def get_xy_indices_from_xy_pos(self, positions):
+        """Get the grid indices of many positions at once
+
+        Args:
+            positions (np.ndarray): (n, 2) positions [m]
+
+        Returns:
+            tuple: (n, 2) int64 grid indices, (n,) bool mask of the positions within the area
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        lower = np.array([self._left_lower_x, self._left_lower_y])
+        index = np.floor((positions - lower) / self.resolution).astype(np.int64)
+        if self.unbounded:
+            inside = np.ones(len(index), dtype=bool)
+        else:
+            inside = np.all((index >= 0) & (index < [self.width, self.height]),
+                            axis=1)
+        return index, inside
+
+    def get_keys_from_xy_pos(self, positions):
+        """Get the packed cell keys of many positions at once
+
+        Args:
+            positions (np.ndarray): (n, 2) positions [m]
+
+        Returns:
+            tuple: (n,) packed keys (see CellStore.pack_xy_index), (n,) bool mask of the positions within the area
+        """
+        index, inside = self.get_xy_indices_from_xy_pos(positions)
+        return pack_xy_index(index[:, 0], index[:, 1]), inside
+
+    def get_xy_pos_from_xy_indices(self, index):
+        """Get the positions of many grid indices at once
+
+        Args:
+            index (np.ndarray): (n, 2) grid indices
+
+        Returns:
+            np.ndarray: (n, 2) cell center positions [m]
+        """
+        index = np.asarray(index).reshape(-1, 2)
+        return np.column_stack([
+            self._calc_pos_from_xy_index(index[:, 0], self._left_lower_x, self.width),
+            self._calc_pos_from_xy_index(index[:, 1], self._left_lower_y, self.height)])
+
     def get_value_from_xy_pos(self, x_pos, y_pos):
         cell_ind = self.get_xy_index_from_xy_pos(x_pos, y_pos)
         return self.get_value_from_xy_index(cell_ind)
@@ -129,29 +343,31 @@ class ProbMap:
         try:
             del self.non_empty_cell[index]
         except KeyError:
-            logging.warning(f"{index} does't exist.")
+            logger.warning("%s does't exist.", index)
 
     def generate_shareable_v(self, local_measurement):
-        # type: (dict) -> dict
+        # type: (np.ndarray) -> tuple
         """Generate the shareable information from local detection
 
         Args:
-            local_measurement (dict): local detections
+            local_measurement (np.ndarray or dict): local detections, [x, y, confidence] per row or per value
 
         Returns:
-            dict: converted shareable detection info
+            tuple: converted shareable detection info, (packed keys, values) with one entry per detected cell
         """
-        meas_index = dict()
-        for _target_id, meas in local_measurement.items():
-            x_pos, y_pos, meas_confidence = meas
-            point_ind = tuple(
-                self.get_xy_index_from_xy_pos(x_pos, y_pos))
-            # meas_index[point_ind] = meas_confidence
-            meas_confidence = 1 - self.false_alarm_prob
-            meas_index[point_ind] = np.log(
-                self.false_alarm_prob/meas_confidence)
+        if isinstance(local_measurement, dict):
+            local_measurement = list(local_measurement.values())
+        local_measurement = np.asarray(local_measurement, dtype=np.float64).reshape(-1, 3)
+        keys, inside = self.get_keys_from_xy_pos(local_measurement[:, :2])
+        if not np.all(inside):
+            # XXX may not need this warning
+            logger.warning("%d positions not within the area", np.count_nonzero(~inside))
+        keys = np.unique(keys)
+        # meas_index[point_ind] = meas_confidence
+        meas_confidence = 1 - self.false_alarm_prob
+        values = np.full(len(keys), np.log(self.false_alarm_prob/meas_confidence))
         # logging.debug(f"THE DETECTED: {meas_index}")
-        return meas_index
+        return keys, values
 
     # def generate_zero_meas(self):
     #     def cut(x): return 1e-6 if x <= 1e-6 else 1 - \
@@ -164,15 +380,16 @@ class ProbMap:
         """Update the probability map using measurements from local and neighbors
 
         Args:
-            local_measurement (dict): Contains local detections like {id1:[x1, y1, confidence1], id2:[x2, y2, confidence2]}
-            neighbor_measurement (dict): Contains neighbors' detections
+            local_measurement (tuple or dict): Contains local detections as (packed keys, values),
+                see generate_shareable_v, or like {(x1, y1): v1, (x2, y2): v2}
+            neighbor_measurement (tuple or dict): Contains neighbors' detections summed per cell
             N (int): Number of all trackers (working on the same perimeter)
             d (int): Number of all neighbors
         """
 
         def bound_Q(Q):
             # 10 is big enough to make 1/(1+exp(10)) -> 0 and 1/(1+exp(-10)) -> 1
-            return max(min(Q, 10), -10)
+            return np.clip(Q, -10, 10)
 
         # Get the weight of measurements
         weight_local = 1. - (d-1.)/N
@@ -208,130 +425,150 @@ class ProbMap:
         # │                               `───────'             │
         # └─────────────────────────────────────────────────────┘
 
+        local_keys, local_values = _measurement_arrays(local_measurement)
+        neighbor_keys, neighbor_values = _measurement_arrays(
+            neighbor_measurement)
+        # the neighbors' contribution when none of them detected anything
+        v_neighbors_for_0 = sum([self.v_for_0 for i in range(d)])
+
         # update all existing grids (Area 1,2,3,4)
-        for cell_ind in list(self.non_empty_cell):
-            # Check if it's in area 2 or 4 (means we have local measurements about it)
-            if cell_ind in local_measurement:
-                v_local = local_measurement[cell_ind]
-                del local_measurement[cell_ind]
-            else:
-                # If not, we believe there is no targets in that grid
-                # v_local = self.generate_zero_meas()
-                v_local = self.v_for_0
-
-            if cell_ind in neighbor_measurement:
-                v_neighbors = neighbor_measurement[cell_ind]
-                del neighbor_measurement[cell_ind]
-            else:
-                v_neighbors = sum(
-                    [self.v_for_0 for i in range(d)])
-
-            Q = weight_local*(self.non_empty_cell[cell_ind] + v_local) + weight_neighbor * (
-                d*self.non_empty_cell[cell_ind]+v_neighbors)
-            self.set_value_from_xy_index(cell_ind, bound_Q(decay_factor * Q))
+        store = self.non_empty_cell
+        store.touch(local_keys)
+        store.touch(neighbor_keys)
+        # Check if it's in area 2 or 4 (means we have local measurements about it)
+        # If not, we believe there is no targets in that grid
+        local_slots = store.find(local_keys)
+        neighbor_slots = store.find(neighbor_keys)
+        Q = np.asarray(store.value_array(), dtype=np.float64)
+        v_local = _scatter(len(Q), local_slots, local_values, self.v_for_0)
+        v_neighbors = _scatter(len(Q), neighbor_slots,
+                               neighbor_values, v_neighbors_for_0)
+        Q = weight_local*(Q + v_local) + weight_neighbor * (d*Q + v_neighbors)
+        Q = bound_Q(decay_factor * Q)
+        store.assign(Q)
+        _drop_empty(store, Q)
 
         # If got measurement for a new grid (Grids in area 5, 6, 7)
-        else:
-            # get the union set of all remaining measurements (Union of area 5, 6, 7)
-            all_meas = set(list(local_measurement) +
-                           list(neighbor_measurement))
-            for cell_ind in all_meas:
-                try:
-                    v_local = local_measurement[cell_ind]
-                except KeyError:
-                    # v_local = self.generate_zero_meas()
-                    v_local = self.v_for_0
-                try:
-                    v_neighbors = neighbor_measurement[cell_ind]
-                except KeyError:
-                    # v_neighbors = sum(
-                    #     [self.generate_zero_meas() for i in range(d)])
-                    v_neighbors = sum(
-                        [self.v_for_0 for i in range(d)])
-                Q = weight_local*(self.init_val + v_local) + weight_neighbor * (
-                    d*self.init_val+v_neighbors)
-                self.set_value_from_xy_index(
-                    cell_ind, bound_Q(decay_factor * Q))
+        # get the union set of all remaining measurements (Union of area 5, 6, 7)
+        new_keys = np.union1d(local_keys[local_slots < 0],
+                              neighbor_keys[neighbor_slots < 0])
+        if len(new_keys):
+            v_local = _gather(new_keys, local_keys,
+                              local_values, self.v_for_0)
+            v_neighbors = _gather(new_keys, neighbor_keys,
+                                  neighbor_values, v_neighbors_for_0)
+            Q = weight_local*(self.init_val + v_local) + weight_neighbor * (
+                d*self.init_val+v_neighbors)
+            Q = bound_Q(decay_factor * Q)
+            kept = Q != 35.0
+            store.update_many(new_keys[kept], Q[kept])
 
     def consensus(self, neighbors_map):
-        # type: (dict) -> None
+        # type: (tuple) -> None
         """Merge neighbors map into local map and make a consensus
 
         Args:
-            neighbors_map (dict): Contains all values from neighbors and have a count of it. Format: {(x, y):[value, count]}
+            neighbors_map (tuple or dict): Sums and counts of all values from neighbors.
+                Format: (keys, sums, counts) arrays, see aggregate_cells, or {(x, y):[value, count]}
         """
-        for cell_ind, value in self.non_empty_cell.items():
-            if cell_ind in neighbors_map.keys():
-                # Calculate the average value of Q
-                Q = (neighbors_map[cell_ind][0]+value) / \
-                    (neighbors_map[cell_ind][1]+1)
-                self.set_value_from_xy_index(cell_ind, Q)
-                del neighbors_map[cell_ind]
-        else:
-            for cell_ind, value_and_count in neighbors_map.items():
-                Q = value_and_count[0]/value_and_count[1]
-                self.set_value_from_xy_index(cell_ind, Q)
+        keys, sums, counts = _neighbor_map_arrays(neighbors_map)
+        store = self.non_empty_cell
+        slots = store.find(keys)
+        local = slots >= 0
+        if np.any(local):
+            # Calculate the average value of Q
+            Q = np.array(store.value_array(), dtype=np.float64)
+            Q[slots[local]] = (sums[local] + Q[slots[local]]) / \
+                (counts[local] + 1)
+            store.assign(Q)
+            _drop_empty(store, Q)
+        # cells only the neighbors know about
+        new = ~local
+        Q = sums[new] / counts[new]
+        kept = Q != 35.0
+        store.update_many(keys[new][kept], Q[kept])
 
     def convert_to_prob_map(self, threshold, normalization=False):
         """Convert log value to probability value [0~1]
 
+        The kept cells end up in self.prob_map, cells below the lower
+        threshold are deleted from the map.
+
         Args:
             threshold (float): Values higher than this will be returned
+            normalization (bool, optional): Scale the probabilities so the largest one is 1. Defaults to False.
         """
         # logging.debug(f"{self.non_empty_cell}")
         lower_threshold = 0.05
         if threshold < 0.5:
             # shrink the lower threshold value
             lower_threshold *= threshold
-            logging.warning(
+            logger.warning(
                 "Got probability threshold smaller than 0.5, it's not recommended.")
-        self.prob_map = dict()
-
-        max_prob = lower_threshold
+        store = self.non_empty_cell
+        keys = store.key_array()
+        # Decode the probability value of all cells at once
+        prob = 1./(1.+np.exp(np.asarray(store.value_array(), dtype=np.float64)))
         if normalization:
-            # Generate the full prob map
-            for cell_ind in list(self.non_empty_cell):
-                value = self.non_empty_cell[cell_ind]
-                # Decode the probability value
-                prob = 1./(1.+np.exp(value))
-                if prob > max_prob:
-                    max_prob = prob
-                self.prob_map[cell_ind] = prob
+            max_prob = lower_threshold
+            if len(prob) and prob.max() > max_prob:
+                max_prob = prob.max()
             # Normalize the whole map and delete data which is small enough
-            for cell_ind in list(self.prob_map):
-                factor = 1/max_prob
-                normed_prob = factor*self.prob_map[cell_ind]
-                if normed_prob >= threshold:
-                    self.prob_map[cell_ind] = normed_prob
-                else:
-                    self.delete_value_from_xy_index(cell_ind)
-                    del self.prob_map[cell_ind]
-                    pass
-                # if normed_prob <= lower_threshold*8:
-                #     # keep some uncertainty between the lower and upper thresholds
-                #     self.delete_value_from_xy_index(cell_ind)
+            factor = 1/max_prob
+            prob = factor*prob
+            kept = prob >= threshold
+            self.prob_map = ProbCells(keys[kept], prob[kept])
+            store.keep(kept)
         else:
-            for cell_ind in list(self.non_empty_cell):
-                value = self.non_empty_cell[cell_ind]
-                # logging.debug(f"PROB: {value}")
-                # Decode the probability value
-                prob = 1./(1.+np.exp(value))
-                if prob >= threshold:
-                    self.prob_map[cell_ind] = prob
-                    if prob >= 0.99999:
-                        logging.warning(f"GOT 1!!! {prob} {value}")
-                if prob < lower_threshold:
-                    # logging.debug(f"Deleting {cell_ind},{prob}")
-                    # keep some uncertainty between the lower and upper thresholds
-                    self.delete_value_from_xy_index(cell_ind)
-                    # pass
-                    
-
-    def get_target_est(self, threshold, normalization=False):
+            kept = prob >= threshold
+            self.prob_map = ProbCells(keys[kept], prob[kept])
+            certain = self.prob_map.probs >= 0.99999
+            if np.any(certain):
+                logger.warning("GOT 1!!! %d cells, max %s",
+                               np.count_nonzero(certain), self.prob_map.probs.max())
+            # keep some uncertainty between the lower and upper thresholds
+            store.keep(prob >= lower_threshold)
+
+    def get_target_clusters(self, threshold, normalization=False):
+        """Group the cells above threshold into one estimate per target
+
+        Touching cells (8-connected) form one cluster, each cluster is
+        summarized by its probability-weighted centroid and covariance.
+
+        Args:
+            threshold (float): Probability threshold value to filter out the targets
+            normalization (bool, optional): See convert_to_prob_map. Defaults to False.
+
+        Returns:
+            tuple: (k, 2) centroids [m], (k,) masses (summed probabilities),
+                (k, 2, 2) covariances [m^2], one row per cluster
+        """
+        self.convert_to_prob_map(threshold, normalization)
+        prob = np.asarray(self.prob_map.value_array(), dtype=np.float64)
+        n_clusters, labels = label_cells(self.prob_map.key_array())
+        pos = self.get_xy_pos_from_xy_indices(self.prob_map.index_array())
+        mass = np.bincount(labels, weights=prob,
+                           minlength=n_clusters).astype(np.float64)
+        centroids = np.column_stack(
+            [np.bincount(labels, weights=prob*pos[:, i], minlength=n_clusters)
+             for i in range(2)]) / mass[:, None]
+        spread = pos - centroids[labels]
+        covariances = np.empty((n_clusters, 2, 2))
+        for i in range(2):
+            for j in range(i, 2):
+                covariances[:, i, j] = covariances[:, j, i] = np.bincount(
+                    labels, weights=prob*spread[:, i]*spread[:, j],
+                    minlength=n_clusters) / mass
+        return centroids, mass, covariances
+
+    def get_target_est(self, threshold, normalization=False, cluster=False):
         """Get all targets' estimated position
 
         Args:
             threshold (float): Probability threshold value to filter out the targets
+            normalization (bool, optional): See convert_to_prob_map. Defaults to False.
+            cluster (bool, optional): One estimate per cluster of cells instead of
+                one per cell, see get_target_clusters. Defaults to False.
 
         Returns:
             list: Targets' position
@@ -339,19 +576,274 @@ class ProbMap:
         # if normalization:
         #     logging.warning(
         #         "Using normalization for PorbMap, the real probability will be hidden.")
-        self.convert_to_prob_map(threshold, normalization)
-        targets_est = list(self.prob_map.keys())
-        for i in range(len(targets_est)):
+        if cluster:
+            centroids, _mass, _covariances = self.get_target_clusters(
+                threshold, normalization)
             # XXX since we don't need z-data, I put a placeholder here
-            x, y = self.get_xy_pos_from_xy_index(
-                targets_est[i][0], targets_est[i][1])
-            targets_est[i] = [x, y, 150]
-        return targets_est
+            return [[x, y, 150] for x, y in centroids.tolist()]
+        self.convert_to_prob_map(threshold, normalization)
+        pos = self.get_xy_pos_from_xy_indices(self.prob_map.index_array())
+        # XXX since we don't need z-data, I put a placeholder here
+        return [[x, y, 150] for x, y in pos.tolist()]
+
+    def save(self, path):
+        """Save a snapshot of the map, see load
+
+        The file is a fixed header with the geometry, then the packed keys
+        and the values of all cells as raw arrays, each starting at a
+        multiple of 64 bytes so they can be memory-mapped.
+
+        The snapshot is written to a temporary file that then replaces the
+        old one, so maps still memory-mapping the old file keep reading it.
+
+        Args:
+            path (str): snapshot file, overwritten if it exists
+        """
+        store = self.non_empty_cell
+        keys = np.ascontiguousarray(store.key_array(), dtype='<i8')
+        values = np.ascontiguousarray(store.value_array(), dtype=store.dtype.newbyteorder('<'))
+        header = self._snapshot_header.pack(
+            self._snapshot_magic, values.dtype.str.encode(),
+            -1 if self.unbounded else self.width, -1 if self.unbounded else self.height,
+            self.resolution, self.center_x, self.center_y,
+            self._left_lower_x, self._left_lower_y,
+            self.init_val, self.false_alarm_prob, len(keys))
+        keys_offset, values_offset = self._snapshot_offsets(len(keys))
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                         prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header + bytes(keys_offset - len(header)))
+                f.write(keys.tobytes() + bytes(values_offset - keys_offset - keys.nbytes))
+                f.write(values.tobytes())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def _snapshot_offsets(cls, n_cells):
+        align = 64
+        keys_offset = -(-cls._snapshot_header.size // align) * align
+        values_offset = keys_offset + -(-8 * n_cells // align) * align
+        return keys_offset, values_offset
+
+    @classmethod
+    def load(cls, path, storage=None, mmap=True):
+        """Restore a map from a snapshot written by save
+
+        With mmap the cells are memory-mapped copy-on-write, so a store that
+        keeps the arrays (see CellStore.load_arrays) is restored without
+        reading the cells, pages are read when touched and the file is never
+        written back.
+
+        Args:
+            path (str): snapshot file
+            storage (str or type, optional): Cell storage backend, see ProbMap. Defaults to None.
+            mmap (bool, optional): Memory-map the cells instead of reading them. Defaults to True.
+
+        Returns:
+            ProbMap: the restored map
+        """
+        with open(path, 'rb') as f:
+            header = f.read(cls._snapshot_header.size)
+        if len(header) < cls._snapshot_header.size:
+            raise ValueError(f"{path} is not a ProbMap snapshot")
+        (magic, dtype, width, height, resolution, center_x, center_y,
+         left_lower_x, left_lower_y, init_val, false_alarm_prob,
+         n_cells) = cls._snapshot_header.unpack(header)
+        if magic != cls._snapshot_magic:
+            raise ValueError(f"{path} is not a ProbMap snapshot")
+        dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        keys_offset, values_offset = cls._snapshot_offsets(n_cells)
+        if n_cells == 0:
+            keys, values = np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)
+        elif mmap:
+            keys = np.memmap(path, dtype='<i8', mode='c', offset=keys_offset, shape=(n_cells,))
+            values = np.memmap(path, dtype=dtype, mode='c', offset=values_offset, shape=(n_cells,))
+        else:
+            keys = np.fromfile(path, dtype='<i8', count=n_cells, offset=keys_offset)
+            values = np.fromfile(path, dtype=dtype, count=n_cells, offset=values_offset)
+
+        unbounded = width < 0
+        prob_map = cls(None if unbounded else width * resolution,
+                       None if unbounded else height * resolution,
+                       resolution, center_x, center_y, init_val=init_val,
+                       false_alarm_prob=false_alarm_prob, storage=storage,
+                       dtype=dtype.newbyteorder('='))
+        if not unbounded:
+            # take the cell counts as saved, width * resolution / resolution
+            # doesn't always round back to the same number
+            prob_map.width, prob_map.height = width, height
+            prob_map.ndata = width * height
+            prob_map._left_lower_x, prob_map._left_lower_y = left_lower_x, left_lower_y
+        prob_map.non_empty_cell.load_arrays(keys, values)
+        return prob_map
+
+    def same_geometry(self, other):
+        """Check whether another map has the same grid, so cell indices can be shared
+        """
+        return (self.width == other.width and self.height == other.height
+                and self.resolution == other.resolution
+                and self._left_lower_x == other._left_lower_x
+                and self._left_lower_y == other._left_lower_y)
 
 
 class ProbMapData:
+    """Cells shared between trackers, either measurements (v) or a map (Q)
+
+    The cells live in one structured array of (x, y, value) records, so a
+    payload is built, decoded and serialized with array operations. The wire
+    format is a fixed header followed by the raw records, to_bytes writes it
+    and from_buffer reads it back without copying the records.
+
+    A payload with a version is one step of a versioned map: a full snapshot
+    if base_version is -1, otherwise a delta against base_version that holds
+    the changed cells plus the deleted cells' indices (see DeltaSharing).
+    """
+    dtype = np.dtype([('x', '<i4'), ('y', '<i4'), ('value', '<f4')])
+    deleted_dtype = np.dtype([('x', '<i4'), ('y', '<i4')])
+    # magic, info type, tracker id, version, base version, number of cells, number of deleted cells
+    _header = struct.Struct('<4scxxxiqqII')
+    _magic = b'PMD2'
+
     def __init__(self):
         self.myid = -1
+        self.tracker_id = -1
         self.type = 'n'
-        self.grid_ind = list()
-        self.values = list()
+        # 0 for unversioned data
+        self.version = 0
+        # -1 for a full snapshot
+        self.base_version = -1
+        self.cells = np.empty(0, dtype=self.dtype)
+        self.deleted = np.empty(0, dtype=self.deleted_dtype)
+
+    @classmethod
+    def from_cells(cls, index, values, info_type='n', tracker_id=-1):
+        """Build a payload from grid indices and values
+
+        Args:
+            index (np.ndarray): (n, 2) grid indices
+            values (np.ndarray): (n,) values
+            info_type (str, optional): 'v' for measurements, 'Q' for a map. Defaults to 'n'.
+            tracker_id (int, optional): Publisher's ID. Defaults to -1.
+        """
+        data = cls()
+        data.type = info_type
+        data.tracker_id = tracker_id
+        index = np.asarray(index).reshape(-1, 2)
+        data.cells = np.empty(len(index), dtype=cls.dtype)
+        data.cells['x'] = index[:, 0]
+        data.cells['y'] = index[:, 1]
+        data.cells['value'] = values
+        return data
+
+    @classmethod
+    def from_mapping(cls, cells, info_type='n', tracker_id=-1):
+        """Build a payload from a {(x, y): value} dict, a (packed keys, values) tuple or a cell store
+        """
+        if hasattr(cells, 'index_array'):
+            return cls.from_cells(cells.index_array(), cells.value_array(),
+                                  info_type, tracker_id)
+        keys, values = _measurement_arrays(cells)
+        return cls.from_cells(unpack_xy_index(keys), values, info_type, tracker_id)
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def is_delta(self):
+        return self.base_version >= 0
+
+    @property
+    def grid_ind(self):
+        """Flat [x0, y0, x1, y1, ...] indices, kept for compatibility
+        """
+        return self.index_array().reshape(-1)
+
+    @property
+    def values(self):
+        return self.cells['value']
+
+    def index_array(self):
+        return np.column_stack((self.cells['x'], self.cells['y'])).astype(np.int64)
+
+    def key_array(self):
+        return pack_xy_index(self.cells['x'], self.cells['y'])
+
+    def set_deleted(self, keys):
+        """Store the packed keys of the deleted cells
+        """
+        index = unpack_xy_index(keys).reshape(-1, 2)
+        self.deleted = np.empty(len(index), dtype=self.deleted_dtype)
+        self.deleted['x'] = index[:, 0]
+        self.deleted['y'] = index[:, 1]
+
+    def deleted_key_array(self):
+        return pack_xy_index(self.deleted['x'], self.deleted['y'])
+
+    def nbytes(self):
+        """Size of the wire format [byte]
+        """
+        return self._header.size + self.cells.nbytes + self.deleted.nbytes
+
+    def to_bytes(self):
+        """Serialize to the wire format
+
+        Returns:
+            bytes: header followed by the raw cell and deleted cell records
+        """
+        header = self._header.pack(self._magic, self.type.encode(), self.tracker_id,
+                                   self.version, self.base_version,
+                                   len(self.cells), len(self.deleted))
+        return b''.join((header,
+                         memoryview(np.ascontiguousarray(self.cells)),
+                         memoryview(np.ascontiguousarray(self.deleted))))
+
+    def write_to(self, buffer, offset=0):
+        """Write the wire format into a writable buffer, see to_bytes
+
+        Args:
+            buffer (bytes-like): writable buffer with nbytes() free from offset
+            offset (int, optional): Where to start [byte]. Defaults to 0.
+
+        Returns:
+            int: number of bytes written
+        """
+        self._header.pack_into(buffer, offset, self._magic, self.type.encode(),
+                               self.tracker_id, self.version, self.base_version,
+                               len(self.cells), len(self.deleted))
+        start = offset + self._header.size
+        for records in (self.cells, self.deleted):
+            if len(records):
+                np.frombuffer(buffer, dtype=records.dtype, count=len(records),
+                              offset=start)[:] = records
+            start += records.nbytes
+        return start - offset
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Deserialize from the wire format, the records stay views of buffer
+
+        Args:
+            buffer (bytes-like): data written by to_bytes
+
+        Returns:
+            ProbMapData: the decoded payload
+        """
+        (magic, info_type, tracker_id, version, base_version,
+         count, deleted_count) = cls._header.unpack_from(buffer)
+        if magic != cls._magic:
+            raise ValueError("Not a ProbMapData buffer")
+        data = cls()
+        data.type = info_type.decode()
+        data.tracker_id = tracker_id
+        data.version = version
+        data.base_version = base_version
+        offset = cls._header.size
+        data.cells = np.frombuffer(buffer, dtype=cls.dtype, count=count,
+                                   offset=offset)
+        offset += data.cells.nbytes
+        data.deleted = np.frombuffer(buffer, dtype=cls.deleted_dtype,
+                                     count=deleted_count, offset=offset)
+        return data
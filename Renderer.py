@@ -0,0 +1,157 @@
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.ticker import LinearLocator
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class Renderer:
+    def __init__(self, simulator, interval=1, ground_truth=False,
+                 buffer_size=2000, block_size=32) -> None:
+        """Live matplotlib view of a simulator
+
+        Args:
+            simulator (Simsim): Simulator to draw
+            interval (int, optional): Draw every interval-th step. Defaults to 1.
+            ground_truth (bool, optional): Also draw the real targets. Defaults to False.
+            buffer_size (int, optional): Cells per side of the probability surface. Defaults to 2000.
+            block_size (int, optional): Cells per side of a dirty block. Defaults to 32.
+        """
+        self.simulator = simulator
+        self.interval = interval
+        self.ground_truth = ground_truth
+
+        # Probability surface, kept between frames and only recomputed in
+        # the blocks touched by cells that appeared, changed or vanished.
+        # _peaks holds the max probability over trackers of every cell and
+        # _surface the same dilated by a 5x5 max filter, which is drawn.
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self._peaks = np.zeros([buffer_size, buffer_size])
+        self._surface = np.zeros([buffer_size, buffer_size])
+        self._drawn_cells = np.empty(0, dtype=np.int64)
+        self._dilation = 2
+        X = np.arange(1000, 2000, 1)
+        Y = np.arange(1000, 2000, 1)
+        self._X, self._Y = np.meshgrid(X, Y)
+
+        plt.ion()
+
+        # self.fig, (self.plt_sim, self.plt_pm) = plt.subplots(
+        #     1, 2, figsize=(10, 5), dpi=160)
+        self.fig = plt.figure(figsize=(20, 8))
+        self.plt_sim = self.fig.add_subplot(121)
+        # plt.axis('equal')
+        self.plt_pm = self.fig.add_subplot(122, projection='3d')
+        # plt.axis('equal')
+        self.plt_sim.axis('equal')
+
+    def draw(self):
+        sim = self.simulator
+        self.plt_sim.cla()
+        self.plt_pm.cla()
+        self.plt_sim.set_xlim(0, sim.map_size[0])
+        self.plt_sim.set_ylim(0, sim.map_size[1])
+        self.plt_pm.set_xlim(1000, 2000)
+        self.plt_pm.set_ylim(1000, 2000)
+
+        if self.ground_truth:
+            for target in sim.targets:
+                self.plt_sim.scatter(
+                    target.position[0], target.position[1], marker='x', s=2, color='r')
+        for e in sim.edges:
+            t0 = sim.trackers[e[0]]
+            t1 = sim.trackers[e[1]]
+            self.plt_sim.plot([t0.position[0], t1.position[0]],
+                              [t0.position[1], t1.position[1]],
+                              linewidth=1, color='g', alpha=0.5)
+        for t in sim.trackers:
+            # draw the trackers
+            self.plt_sim.scatter(t.position[0], t.position[1],
+                                 marker='s', s=20, c='b')
+            self.plt_sim.annotate(t.id, (t.position[0], t.position[1]+10))
+            # draw the camera coverage
+            circle = plt.Circle(
+                (t.position), t.sensor.coverage_radius, fill=False, color='grey', alpha=0.3)
+            self.plt_sim.add_patch(circle)
+            if len(t.target_estimates):
+                det_pos = np.asarray(t.target_estimates)[:, 0:2]
+                # det_abs_pos = det_pos+t.position
+                self.plt_sim.scatter(det_pos[:, 0], det_pos[:, 1],
+                                     marker='^', s=2)
+        self.update_surface()
+        self.plt_pm.set_zlim(0, 1.01)
+        # print(Z)
+        self.plt_pm.plot_surface(
+            self._X, self._Y, self._surface[1000:, 1000:], cmap='RdBu_r', rcount=150, ccount=150, antialiased=True)
+        self.plt_pm.view_init(elev=35., azim=0)
+        plt.gca().invert_yaxis()
+        # self.plt_pm.plot_surface(X, Y, Z, cmap=cm.bwr, linewidth=5, antialiased=True)
+        self.plt_pm.zaxis.set_major_locator(LinearLocator(10))
+        plt.pause(1/sim.rate)
+
+    def _collect_cells(self):
+        """Flat buffer positions and probabilities of all trackers' cells
+        """
+        cells, probs = [], []
+        for t in self.simulator.trackers:
+            prob_map = t.prob_map.prob_map
+            index = prob_map.index_array()
+            prob = prob_map.value_array()
+            inside = np.all((index >= 0) & (index < self.buffer_size), axis=1)
+            cells.append(index[inside, 0] * self.buffer_size + index[inside, 1])
+            probs.append(prob[inside])
+        return (np.concatenate(cells + [np.empty(0, dtype=np.int64)]),
+                np.concatenate(probs + [np.empty(0)]))
+
+    def update_surface(self):
+        """Bring the probability surface up to date with the trackers' maps
+
+        Returns:
+            np.ndarray: the (buffer_size, buffer_size) surface
+        """
+        cells, probs = self._collect_cells()
+        old_cells = self._drawn_cells
+        old_peaks = self._peaks.flat[old_cells]
+        self._peaks.flat[old_cells] = 0.
+        np.maximum.at(self._peaks.reshape(-1), cells, probs)
+        self._drawn_cells = np.unique(cells)
+        # dirty: cells that appeared or vanished, and kept cells whose peak changed
+        kept, old_at, new_at = np.intersect1d(old_cells, self._drawn_cells,
+                                              assume_unique=True, return_indices=True)
+        changed = old_peaks[old_at] != self._peaks.flat[self._drawn_cells[new_at]]
+        dirty = np.concatenate([np.setxor1d(old_cells, self._drawn_cells, assume_unique=True),
+                                kept[changed]])
+        if len(dirty) == 0:
+            return self._surface
+
+        # every block the 5x5 neighborhood of a dirty cell reaches
+        size, block, reach = self.buffer_size, self.block_size, self._dilation
+        rows, cols = np.divmod(dirty, size)
+        n_blocks = -(-size // block)
+        blocks = []
+        for dr in (-reach, reach):
+            for dc in (-reach, reach):
+                block_rows = np.clip(rows + dr, 0, size - 1) // block
+                block_cols = np.clip(cols + dc, 0, size - 1) // block
+                blocks.append(block_rows * n_blocks + block_cols)
+        for block_id in np.unique(np.concatenate(blocks)).tolist():
+            r0, c0 = (block_id // n_blocks) * block, (block_id % n_blocks) * block
+            r1, c1 = min(r0 + block, size), min(c0 + block, size)
+            self._surface[r0:r1, c0:c1] = self._max_filter(r0, r1, c0, c1)
+        return self._surface
+
+    def _max_filter(self, r0, r1, c0, c1):
+        """5x5 max filter of the peaks, evaluated on [r0:r1, c0:c1]
+        """
+        reach = self._dilation
+        width = 2 * reach + 1
+        padded = np.zeros([r1 - r0 + 2 * reach, c1 - c0 + 2 * reach])
+        src_r0, src_c0 = max(r0 - reach, 0), max(c0 - reach, 0)
+        src_r1 = min(r1 + reach, self.buffer_size)
+        src_c1 = min(c1 + reach, self.buffer_size)
+        padded[src_r0 - (r0 - reach):src_r1 - (r0 - reach),
+               src_c0 - (c0 - reach):src_c1 - (c0 - reach)] = \
+            self._peaks[src_r0:src_r1, src_c0:src_c1]
+        # separable: max over the rows' window, then over the columns' window
+        out = sliding_window_view(padded, width, axis=0).max(axis=-1)
+        return sliding_window_view(out, width, axis=1).max(axis=-1)
@@ -3,10 +3,29 @@ import logging
 import numpy as np
 
 
+def _motion_field(name):
+    """A Robot attribute stored in its row of the Kinematics arrays
+    """
+    def get(self):
+        return getattr(self._motion, name)[self._slot]
+
+    def set(self, value):
+        getattr(self._motion, name)[self._slot] = value
+
+    return property(get, set)
+
+
 class Robot:
+    # Kinematics group of the robots of this class, see Simsim.get_motion
+    motion_group = 'robots'
+
     def __init__(self, simulator,  name: str, id: int, position: np.array) -> None:
         """The base Robot class
 
+        The motion state lives in the simulator's Kinematics arrays, position,
+        desired_position, speed etc. read and write the robot's row there,
+        position and desired_position are views of that row.
+
         Parameters
         ----------
         simulator: Simsim
@@ -23,14 +42,27 @@ class Robot:
         self.name = name
         self.id = id
         self.log_head = f"{self.name}_{self.id}"
-        self.position = position
-        # facing direction
-        self.ang = np.random.random()*360
-        self.desired_position = self.position
-        self.in_position = True
-        self.speed = 0.0
-        self.rate = self.simulator.rate
-        self.max_speed = 100.0  # m/s
+        # random generator of this robot, seeded by the simulator
+        self.rng = self.simulator.spawn_rng()
+        self._motion = self.simulator.get_motion(self.motion_group)
+        self._slot = self._motion.add(position,
+                                      ang=self.rng.random()*360,  # facing direction
+                                      max_speed=100.0,  # m/s
+                                      rate=self.simulator.rate)
+
+    position = _motion_field('position')
+    desired_position = _motion_field('desired_position')
+    speed = _motion_field('speed')
+    max_speed = _motion_field('max_speed')
+    ang = _motion_field('ang')
+    rate = _motion_field('rate')
+    in_position = _motion_field('in_position')
+
+    def attach_motion(self, motion, slot):
+        """Move the robot's motion state to a row of other Kinematics arrays
+        """
+        self._motion = motion
+        self._slot = slot
 
     def waypoint_ctrl(self, speed=None, desired_pos: np.array = None):
         # if got new waypoint, update
@@ -38,31 +70,19 @@ class Robot:
             # logging.debug(f"{self.name}{self.id} set new desired position")
             self.desired_position = desired_pos
 
-        if speed is None:
-            # logging.debug(f"{self.name}_{self.id} set to max speed")
-            self.speed = self.max_speed
-        else:
-            if speed > self.max_speed:
-                logging.warning("Given speed is over maximum")
-            self.speed = speed
-
-        if np.any(self.position != self.desired_position):
-            # logging.debug(
-            #     f"{self.name}_{self.id} moving to {self.desired_position}")
-            self.in_position = False
-            one_time_step_length = self.speed/self.rate
-            difference = self.desired_position - self.position
-            distance = np.linalg.norm(difference)
-            # if it's close enough to the goal position, make it in position
-            if distance <= one_time_step_length:
-                self.position = self.desired_position
-                self.in_position = True
-            else:
-                # move to the goal point at the given speed
-                direction = difference/distance
-                self.position = self.position + direction*self.speed/self.rate
-                # print("MOVED")
-        return self.in_position
+        if speed is not None and speed > self.max_speed:
+            logging.warning("Given speed is over maximum")
+        # None is the maximum speed
+        return bool(self._motion.advance([self._slot], speed)[0])
+
+    def __getstate__(self):
+        # the simulator stays behind when a robot is sent to another process,
+        # the robot takes a copy of its own motion state along
+        state = self.__dict__.copy()
+        state['simulator'] = None
+        state['_motion'] = self._motion.subset([self._slot])
+        state['_slot'] = 0
+        return state
 
     def job(self):
         self.waypoint_ctrl()
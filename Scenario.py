@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+
+from SpatialIndex import GridIndex
+
+"""
+Seeded scenarios of trackers, targets and their communication graph
+
+A scenario is built from a spec, a JSON-like dict such as
+
+    {'seed': 1, 'map_size': [4000, 4000], 'comm_radius': 300,
+     'trackers': [{'layout': 'perimeter', 'n': 500, 'center': [2000, 2000],
+                   'radius': 1500, 'sensor_radius': 250}],
+     'targets': [{'layout': 'clustered', 'n_clusters': 20, 'per_cluster': 50,
+                  'lower': [0, 0], 'upper': [4000, 4000], 'spread': 40}]}
+
+Every layout draws from one generator seeded by the spec, so the same spec
+always gives the same scenario. Trackers closer than comm_radius become
+neighbors, the pairs are found with a uniform grid (see GridIndex) instead
+of checking all pairs. The simulator built from a scenario gives every
+tracker a map of the drawn area, from (0, 0) to map_size.
+
+Layouts
+-------
+trackers: perimeter (n, center, radius, sensor_radius, jitter),
+          random (n, lower, upper, sensor_radius)
+targets:  random (n, lower, upper),
+          clustered (n_clusters, per_cluster, lower, upper, spread)
+
+Implementations
+---------------
+1. Scenario := Positions, sensor ranges and edges, builds a Simsim, save/load
+"""
+
+
+class Scenario:
+
+    def __init__(self, seed=0, map_size=(1000, 1000), comm_radius=300., rate=30):
+        """An empty scenario
+
+        Args:
+            seed (int, optional): Seed of the layouts and of the simulator. Defaults to 0.
+            map_size (tuple, optional): Size of the drawn area [m]. Defaults to (1000, 1000).
+            comm_radius (float, optional): Trackers closer than this are neighbors [m]. Defaults to 300.
+            rate (int, optional): Simulation rate [Hz]. Defaults to 30.
+        """
+        self.seed = seed
+        self.map_size = list(map_size)
+        self.comm_radius = comm_radius
+        self.rate = rate
+        self.rng = np.random.default_rng(seed)
+        self.tracker_positions = np.empty((0, 2))
+        self.sensor_radii = np.empty(0)
+        self.target_positions = np.empty((0, 2))
+        self._edges = None
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Build a scenario from a spec, see the module description
+        """
+        scenario = cls(seed=spec.get('seed', 0),
+                       map_size=spec.get('map_size', (1000, 1000)),
+                       comm_radius=spec.get('comm_radius', 300.),
+                       rate=spec.get('rate', 30))
+        for group, layouts in (('trackers', scenario.TRACKER_LAYOUTS),
+                               ('targets', scenario.TARGET_LAYOUTS)):
+            for layout in spec.get(group, []):
+                layout = dict(layout)
+                name = layout.pop('layout')
+                try:
+                    add = getattr(scenario, layouts[name])
+                except KeyError:
+                    raise ValueError(f"Unknown {group} layout '{name}'") from None
+                add(**layout)
+        return scenario
+
+    TRACKER_LAYOUTS = {'perimeter': 'perimeter_trackers', 'random': 'random_trackers'}
+    TARGET_LAYOUTS = {'random': 'random_targets', 'clustered': 'clustered_targets'}
+
+    def _add_trackers(self, positions, sensor_radius):
+        self.tracker_positions = np.concatenate([self.tracker_positions, positions])
+        self.sensor_radii = np.concatenate(
+            [self.sensor_radii, np.broadcast_to(np.asarray(sensor_radius, dtype=np.float64),
+                                                len(positions))])
+        self._edges = None
+
+    def perimeter_trackers(self, n, center, radius, sensor_radius=250, jitter=0.):
+        """Trackers evenly spaced on a circle around the monitored area
+
+        Args:
+            n (int): number of trackers
+            center (list): center of the circle [m]
+            radius (float): radius of the circle [m]
+            sensor_radius (float, optional): sensor range [m]. Defaults to 250.
+            jitter (float, optional): Standard deviation of the position noise [m]. Defaults to 0.
+        """
+        angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+        positions = np.asarray(center, dtype=np.float64) + radius * np.column_stack(
+            [np.cos(angles), np.sin(angles)])
+        if jitter:
+            positions += self.rng.normal(0, jitter, positions.shape)
+        self._add_trackers(positions, sensor_radius)
+
+    def random_trackers(self, n, lower=(0, 0), upper=None, sensor_radius=250):
+        """Trackers uniformly spread over a rectangle, the whole map by default
+        """
+        upper = self.map_size if upper is None else upper
+        self._add_trackers(self.rng.uniform(lower, upper, (n, 2)), sensor_radius)
+
+    def random_targets(self, n, lower=(0, 0), upper=None):
+        """Targets uniformly spread over a rectangle, the whole map by default
+        """
+        upper = self.map_size if upper is None else upper
+        self.target_positions = np.concatenate(
+            [self.target_positions, self.rng.uniform(lower, upper, (n, 2))])
+
+    def clustered_targets(self, n_clusters, per_cluster, lower=(0, 0), upper=None, spread=50.):
+        """Groups of targets around random centers
+
+        Args:
+            n_clusters (int): number of groups
+            per_cluster (int): targets per group
+            lower (list, optional): Lower corner of the group centers [m]. Defaults to (0, 0).
+            upper (list, optional): Upper corner of the group centers [m]. Defaults to the map size.
+            spread (float, optional): Standard deviation around the group center [m]. Defaults to 50.
+        """
+        upper = self.map_size if upper is None else upper
+        centers = self.rng.uniform(lower, upper, (n_clusters, 2))
+        offsets = self.rng.normal(0, spread, (n_clusters, per_cluster, 2))
+        self.target_positions = np.concatenate(
+            [self.target_positions, (centers[:, None, :] + offsets).reshape(-1, 2)])
+
+    @property
+    def edges(self):
+        """(m, 2) tracker ID pairs closer than comm_radius, i < j
+        """
+        if self._edges is None:
+            index = GridIndex(cell_size=self.comm_radius)
+            index.rebuild(self.tracker_positions)
+            first, second = index.pairs_within(self.comm_radius)
+            self._edges = np.column_stack([first, second])
+        return self._edges
+
+    def build(self, **kwargs):
+        """Create a simulator running this scenario
+
+        Args:
+            kwargs: passed to Simsim, e.g. headless=True
+
+        Returns:
+            Simsim: the simulator with all trackers, targets and edges added,
+                each tracker mapping the area from (0, 0) to map_size
+        """
+        # imported here, Simsim pulls in the whole simulation
+        from Simsim import Simsim
+        kwargs.setdefault('seed', self.seed)
+        sim = Simsim(**kwargs)
+        sim.map_size = list(self.map_size)
+        sim.rate = self.rate
+        sim.add_trackers('tracker', self.tracker_positions, self.sensor_radii)
+        width, height = self.map_size
+        for tracker in sim.trackers:
+            tracker.set_area(width, height, width / 2., height / 2.)
+        sim.add_targets('tgt', self.target_positions)
+        sim.add_edges(self.edges.tolist())
+        return sim
+
+    def save(self, path):
+        """Save the generated scenario, it loads back exactly, see load
+
+        Args:
+            path (str): .npz file
+        """
+        meta = {'seed': self.seed, 'map_size': self.map_size,
+                'comm_radius': self.comm_radius, 'rate': self.rate}
+        np.savez(path, meta=np.array(json.dumps(meta)),
+                 tracker_positions=self.tracker_positions,
+                 sensor_radii=self.sensor_radii,
+                 target_positions=self.target_positions,
+                 edges=self.edges)
+
+    @classmethod
+    def load(cls, path):
+        """Load a scenario written by save
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            scenario = cls(**meta)
+            scenario.tracker_positions = data['tracker_positions']
+            scenario.sensor_radii = data['sensor_radii']
+            scenario.target_positions = data['target_positions']
+            scenario._edges = data['edges']
+        return scenario
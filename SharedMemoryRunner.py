@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from Kinematics import Kinematics
+from ProbMap import ProbMapData
+from SpatialIndex import GridIndex
+from tracker import Sensor, Tracker
+
+"""
+Trackers stepped by worker processes, one region of the area per worker
+
+The trackers are split into regions of about the same number of trackers,
+and every worker process steps the trackers of its region. Everything the
+workers read from each other lives in shared memory, nothing of it is
+pickled:
+
+    motion     the Kinematics arrays of the trackers and of the targets
+    arenas     every worker's published payloads, one after the other in
+               ProbMapData wire format, one arena per worker and kind
+    directory  (offset, length) of every tracker's payload in its arena
+
+A tracker reads its neighbors' payloads straight from the arenas, so only
+the trackers on the border of a region read from other workers. The
+coordinator (the simulator's process) only sends the phase to run and
+small bookkeeping through pipes:
+
+    move       acknowledgments of the last step, random_moving
+    publish_v  neighbors (if dynamic), sensing, publish_v
+    update     update, publish_Q
+    merge      merge, estimate, returns estimates and acknowledgments
+
+with a barrier after each phase, so a step gives the same result as the
+phased scheduler.
+
+Trackers moving out of their region make more and more neighbors cross
+workers. Once the border trackers grow past a factor of their count after
+the last partition, the trackers are partitioned again at their current
+positions, and only the trackers changing region are pickled to their new
+worker. If a worker fails, all workers are stopped and the shared memory is
+freed before the error is raised.
+
+Implementations
+---------------
+1. partition_by_region := Balanced regions by recursive coordinate bisection
+2. SharedArrays := Named numpy arrays in one shared memory block
+3. SharedMemoryRunner := Coordinator of the worker processes
+"""
+
+_ALIGN = 64
+
+
+def partition_by_region(positions, parts):
+    """Split points into regions holding about the same number of points
+
+    Recursive coordinate bisection: the longer side of the bounding box is
+    cut so the number of points on each side is proportional to the number
+    of regions it is split into.
+
+    Args:
+        positions (np.ndarray): (n, 2) positions
+        parts (int): number of regions
+
+    Returns:
+        list: sorted indices of the points of every region
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+
+    def split(ids, parts):
+        if parts == 1:
+            return [np.sort(ids)]
+        points = positions[ids]
+        axis = int(np.argmax(np.ptp(points, axis=0))) if len(ids) else 0
+        left = parts // 2
+        cut = len(ids) * left // parts
+        order = np.argsort(points[:, axis], kind='stable')
+        return split(ids[order[:cut]], left) + split(ids[order[cut:]], parts - left)
+
+    return split(np.arange(len(positions)), parts)
+
+
+def _close(shm):
+    """Close a block, False if payloads still refer to it
+    """
+    try:
+        shm.close()
+    except BufferError:
+        return False
+    return True
+
+
+class SharedArrays:
+
+    def __init__(self, layout, name=None):
+        """Numpy arrays in one shared memory block
+
+        Args:
+            layout (tuple): (name, shape, dtype) of every array
+            name (str, optional): Attach to this block instead of creating one. Defaults to None.
+        """
+        self.layout = tuple(layout)
+        offsets = []
+        size = 0
+        for _name, shape, dtype in self.layout:
+            offsets.append(size)
+            size += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // _ALIGN) * _ALIGN
+        if name is None:
+            self.shm = SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shm = SharedMemory(name=name)
+        self.arrays = {array_name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for (array_name, shape, dtype), offset in zip(self.layout, offsets)}
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self, unlink=False):
+        self.arrays = None
+        _close(self.shm)
+        if unlink:
+            self.shm.unlink()
+
+
+def _motion_layout(size):
+    return tuple((name, (max(size, 1),) + shape, dtype)
+                 for name, shape, dtype in Kinematics.fields)
+
+
+class _Worker:
+    """Steps the trackers of one region, standing in for their simulator
+    """
+
+    def __init__(self, worker_id, trackers, spec, connection):
+        self.worker_id = worker_id
+        self.connection = connection
+        self.num_trackers = spec['num_trackers']
+        self.owners = spec['owners']
+        self.shared = {group: SharedArrays(_motion_layout(size), name)
+                       for group, (name, size) in spec['motion'].items()}
+        self.motion = {group: Kinematics.from_arrays(self.shared[group].arrays, size)
+                       for group, (name, size) in spec['motion'].items()}
+        self.directory = SharedArrays(spec['directory_layout'], spec['directory'])
+        self.target_index = GridIndex(cell_size=spec['cell_size'])
+        self._set_trackers(trackers)
+        for t in trackers:
+            t.simulator = self
+            t.attach_motion(self.motion['trackers'], t._slot)
+        # own arenas {kind: SharedMemory}
+        self.arenas = dict()
+        # {(worker id, kind): arena name} of all workers, from the coordinator
+        self.arena_names = dict()
+        # {arena name: SharedMemory} of the other workers
+        self._attached = dict()
+        # replaced arenas that payloads may still refer to
+        self._retired = []
+        self._acks = []
+
+    def get_shared(self, tracker_id, kind, reader_id=None):
+        offset, length = self.directory.arrays[kind][tracker_id].tolist()
+        owner = int(self.owners[tracker_id])
+        if owner == self.worker_id:
+            arena = self.arenas[kind]
+        else:
+            name = self.arena_names[(owner, kind)]
+            arena = self._attached.get(name)
+            if arena is None:
+                arena = self._attached[name] = SharedMemory(name=name)
+        return ProbMapData.from_buffer(arena.buf[offset:offset + length])
+
+    def acknowledge_Q(self, publisher_id, reader_id, version):
+        self._acks.append((publisher_id, reader_id, version))
+
+    def _set_arena_names(self, arena_names):
+        self.arena_names = arena_names
+        current = set(arena_names.values())
+        for name in [name for name in self._attached if name not in current]:
+            self._retired.append(self._attached.pop(name))
+        self._retired = [arena for arena in self._retired if not _close(arena)]
+
+    def _write_arena(self, kind):
+        """Copy the trackers' payloads into the arena, in a new one if too small
+
+        Returns:
+            dict: {kind: name} of a new arena, else empty
+        """
+        payloads = [getattr(t, 'shareable_' + kind) for t in self.trackers]
+        size = sum(p.nbytes() for p in payloads)
+        arena = self.arenas.get(kind)
+        renamed = dict()
+        if arena is None or arena.size < size:
+            if arena is not None:
+                arena.unlink()
+                self._retired.append(arena)
+            arena = SharedMemory(create=True, size=max(size, 2 * (arena.size if arena else 0), 1 << 16))
+            self.arenas[kind] = arena
+            renamed[kind] = arena.name
+        directory = self.directory.arrays[kind]
+        offset = 0
+        for t, payload in zip(self.trackers, payloads):
+            length = payload.write_to(arena.buf, offset)
+            directory[t.id] = (offset, length)
+            offset += length
+        return renamed
+
+    def release(self, ids):
+        """Hand trackers over to another worker
+
+        Args:
+            ids (list): IDs of the trackers leaving
+
+        Returns:
+            list: the trackers
+        """
+        leaving = [self.by_id.pop(i) for i in ids]
+        self._set_trackers([t for t in self.trackers if t.id in self.by_id])
+        return leaving
+
+    def adopt(self, owners, trackers):
+        """Take over trackers from other workers
+
+        Args:
+            owners (np.ndarray): worker of every tracker after the move
+            trackers (list): (tracker, slot) of the trackers arriving
+        """
+        self.owners = owners
+        for t, slot in trackers:
+            t.simulator = self
+            t.attach_motion(self.motion['trackers'], slot)
+        self._set_trackers(self.trackers + [t for t, _slot in trackers])
+
+    def _set_trackers(self, trackers):
+        self.trackers = sorted(trackers, key=lambda t: t.id)
+        self.by_id = {t.id: t for t in self.trackers}
+        self.slots = np.array([t._slot for t in self.trackers], dtype=np.int64)
+
+    def move(self, acks):
+        for publisher_id, reader_id, version in acks:
+            self.by_id[publisher_id].acknowledge_Q(reader_id, version)
+        Tracker.random_moving_all(self.trackers)
+
+    def publish_v(self, neighbors, arena_names):
+        self._set_arena_names(arena_names)
+        for tracker_id, ids in (neighbors or dict()).items():
+            t, ids = self.by_id[tracker_id], set(ids)
+            if ids != t.neighbor:
+                t.update_neighbors(ids - t.neighbor, t.neighbor - ids)
+        targets = self.motion['targets']
+        self.target_index.rebuild(targets.position[:targets.size])
+        Sensor.sense_many(self.trackers, self.motion['trackers'].position[self.slots],
+                          self.target_index)
+        for t in self.trackers:
+            t.publish_v()
+        return self._write_arena('v')
+
+    def update(self, arena_names):
+        self._set_arena_names(arena_names)
+        for t in self.trackers:
+            t.update()
+        for t in self.trackers:
+            t.publish_Q()
+        return self._write_arena('Q')
+
+    def merge(self, arena_names):
+        self._set_arena_names(arena_names)
+        for t in self.trackers:
+            t.merge()
+        for t in self.trackers:
+            t.estimate()
+        acks, self._acks = self._acks, []
+        estimates = {t.id: t.target_estimates for t in self.trackers}
+        records = {t.id: t.stats.pop() for t in self.trackers if t.stats is not None}
+        return estimates, acks, records
+
+    def run(self):
+        while True:
+            command, args = self.connection.recv()
+            if command == 'stop':
+                self.connection.send(('ok', self.trackers))
+                break
+            try:
+                self.connection.send(('ok', getattr(self, command)(*args)))
+            except Exception:
+                self.connection.send(('error', traceback.format_exc()))
+                break
+        for arena in self.arenas.values():
+            arena.unlink()
+        # the process exits next, what is still referred to is unmapped then
+        for arena in list(self.arenas.values()) + list(self._attached.values()) + self._retired:
+            _close(arena)
+
+
+def _worker_main(worker_id, trackers, spec, connection):
+    _Worker(worker_id, trackers, spec, connection).run()
+
+
+class SharedMemoryRunner:
+
+    def __init__(self, simulator, workers=None, repartition=1.5):
+        """Move the motion state to shared memory and start the workers
+
+        The trackers run in the workers until close, which brings them back
+        to the simulator. Robots can't be added in between.
+
+        Args:
+            simulator (Simsim): the coordinator's simulator
+            workers (int, optional): Number of worker processes, None for one per CPU. Defaults to None.
+            repartition (float, optional): Partition again once the border trackers grow to this many
+                times their count after the last partition, None never. Defaults to 1.5.
+        """
+        self.simulator = simulator
+        self.repartition = repartition
+        trackers = simulator.trackers
+        workers = max(1, min(workers or os.cpu_count() or 1, len(trackers)))
+        self.shared = dict()
+        for group in ('trackers', 'targets'):
+            motion = simulator.get_motion(group)
+            shared = SharedArrays(_motion_layout(len(motion)))
+            for name, _shape, _dtype in Kinematics.fields:
+                shared.arrays[name][:len(motion)] = getattr(motion, name)[:len(motion)]
+            self._attach_robots(group, Kinematics.from_arrays(shared.arrays, len(motion)))
+            self.shared[group] = shared
+        directory_layout = tuple((kind, (max(len(trackers), 1), 2), np.int64) for kind in ('v', 'Q'))
+        self.directory = SharedArrays(directory_layout)
+        self.regions = partition_by_region(simulator.positions('trackers'), workers)
+        self.owners = np.empty(len(trackers), dtype=np.int64)
+        for worker_id, ids in enumerate(self.regions):
+            self.owners[ids] = worker_id
+        spec = {'num_trackers': len(trackers),
+                'owners': self.owners,
+                'motion': {group: (shared.name, len(simulator.get_motion(group)))
+                           for group, shared in self.shared.items()},
+                'directory': self.directory.name,
+                'directory_layout': directory_layout,
+                'cell_size': max((t.sensor.coverage_radius for t in trackers), default=150)}
+        # fork, if the platform has it, starts much faster than spawn
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.connections = []
+        self.processes = []
+        for worker_id, ids in enumerate(self.regions):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker_main, daemon=True,
+                args=(worker_id, [trackers[i] for i in ids.tolist()], spec, child))
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.arena_names = dict()
+        # acknowledgments to hand to each worker with the next step
+        self._acks = [[] for _ in self.regions]
+        # border trackers right after the last partition
+        self._border_baseline = self.border_trackers()
+
+    def _attach_robots(self, group, motion):
+        self.simulator.motion[group] = motion
+        for robot in getattr(self.simulator, group):
+            robot.attach_motion(motion, robot._slot)
+
+    def _run(self, command, args):
+        """Run a phase on all workers and wait for them
+
+        Args:
+            command (str): _Worker method
+            args (callable): worker id -> arguments
+
+        Returns:
+            list: every worker's result
+        """
+        start = time.perf_counter()
+        for worker_id, connection in enumerate(self.connections):
+            connection.send((command, args(worker_id)))
+        results = []
+        failure = None
+        for worker_id, connection in enumerate(self.connections):
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                status, result = 'error', f"exited with code {self.processes[worker_id].exitcode}"
+            if status == 'error' and failure is None:
+                failure = f"Worker {worker_id} failed in {command}:\n{result}"
+            results.append(result)
+        if failure is not None:
+            self._abort()
+            raise RuntimeError(failure)
+        if self.simulator.instrumentation is not None:
+            self.simulator.instrumentation.simulator.add_time(
+                'worker_' + command, time.perf_counter() - start)
+        return results
+
+    def _rename(self, results):
+        for worker_id, renamed in enumerate(results):
+            for kind, name in renamed.items():
+                self.arena_names[(worker_id, kind)] = name
+
+    def update(self):
+        """Step all trackers on the workers
+        """
+        if not self.shared:
+            raise RuntimeError("The workers were stopped after a failure")
+        simulator = self.simulator
+        acks, self._acks = self._acks, [[] for _ in self.regions]
+        self._run('move', lambda w: (acks[w],))
+        neighbors = None
+        if simulator.comm_range is not None:
+            simulator._update_neighbors_timed()
+            neighbors = [{i: sorted(simulator.trackers[i].neighbor) for i in ids.tolist()}
+                         for ids in self.regions]
+        self._rename(self._run('publish_v', lambda w: (
+            neighbors[w] if neighbors else None, self.arena_names)))
+        self._rename(self._run('update', lambda w: (self.arena_names,)))
+        results = self._run('merge', lambda w: (self.arena_names,))
+        trackers = simulator.trackers
+        for estimates, worker_acks, records in results:
+            for tracker_id, target_estimates in estimates.items():
+                trackers[tracker_id].target_estimates = target_estimates
+            for tracker_id, record in records.items():
+                if trackers[tracker_id].stats is not None:
+                    for name, value in record.items():
+                        trackers[tracker_id].stats.add(name, value)
+            for ack in worker_acks:
+                self._acks[self.owners[ack[0]]].append(ack)
+        border = self.border_trackers()
+        if self.repartition is not None and border > self.repartition * max(self._border_baseline, 1):
+            if simulator.instrumentation is None:
+                self.partition()
+            else:
+                simulator.instrumentation.simulator.add(
+                    'migrated', simulator.instrumentation.simulator.timed('partition', self.partition))
+            border = self._border_baseline
+        if simulator.instrumentation is not None:
+            simulator.instrumentation.simulator.set('border_trackers', border)
+
+    def border_trackers(self):
+        """Number of trackers with a neighbor on another worker
+        """
+        if not self.simulator.edges:
+            return 0
+        edges = np.asarray(self.simulator.edges, dtype=np.int64)
+        crossing = self.owners[edges[:, 0]] != self.owners[edges[:, 1]]
+        return len(np.unique(edges[crossing]))
+
+    def partition(self):
+        """Partition the trackers again at their current positions
+
+        Only the trackers changing region move between workers, between two
+        steps, when no payload of the last step is read anymore.
+
+        Returns:
+            int: number of trackers that moved to another worker
+        """
+        trackers = self.simulator.trackers
+        regions = partition_by_region(self.simulator.positions('trackers'), len(self.regions))
+        owners = np.empty_like(self.owners)
+        for worker_id, ids in enumerate(regions):
+            owners[ids] = worker_id
+        moving = owners != self.owners
+        released = self._run('release', lambda w: (
+            np.flatnonzero(moving & (self.owners == w)).tolist(),))
+        arriving = [[] for _ in regions]
+        for worker_trackers in released:
+            for t in worker_trackers:
+                arriving[owners[t.id]].append((t, trackers[t.id]._slot))
+        self._run('adopt', lambda w: (owners, arriving[w]))
+        self.regions, self.owners = regions, owners
+        # acknowledgments go to the publisher's new worker
+        acks = [ack for worker_acks in self._acks for ack in worker_acks]
+        self._acks = [[] for _ in regions]
+        for ack in acks:
+            self._acks[owners[ack[0]]].append(ack)
+        self._border_baseline = self.border_trackers()
+        return int(np.count_nonzero(moving))
+
+    def _abort(self):
+        """Stop the workers after a failure and free the shared memory
+
+        The simulator keeps its own copies of the trackers, as of before
+        the workers took them over.
+        """
+        connections, self.connections = self.connections, []
+        for connection, process in zip(connections, self.processes):
+            # a worker that failed already freed its arenas and exited
+            try:
+                connection.send(('stop', ()))
+                connection.recv()
+            except (EOFError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        # arenas of workers that could not free them
+        for name in self.arena_names.values():
+            try:
+                arena = SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            arena.close()
+            arena.unlink()
+        self._free_motion()
+
+    def _free_motion(self):
+        simulator = self.simulator
+        for group, shared in self.shared.items():
+            motion = simulator.get_motion(group)
+            self._attach_robots(group, motion.subset(np.arange(len(motion))))
+        for shared in self.shared.values():
+            shared.close(unlink=True)
+        self.directory.close(unlink=True)
+        self.shared = dict()
+
+    def close(self):
+        """Stop the workers, bring their trackers back and free the shared memory
+        """
+        simulator = self.simulator
+        if not self.shared:
+            # freed after a failure
+            return
+        for connection in self.connections:
+            connection.send(('stop', ()))
+        restored = dict()
+        for connection in self.connections:
+            _status, trackers = connection.recv()
+            restored.update((t.id, t) for t in trackers)
+        for process in self.processes:
+            process.join()
+        self._free_motion()
+        for i, tracker in enumerate(simulator.trackers):
+            t = restored[tracker.id]
+            t.simulator = simulator
+            t.attach_motion(simulator.get_motion(t.motion_group), tracker._slot)
+            # the coordinator keeps the statistics collected so far
+            t.stats = tracker.stats
+            simulator.trackers[i] = t
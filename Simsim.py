@@ -1,13 +1,23 @@
 import logging
+import time
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator
 
+from CellStore import find_keys, pack_xy_index, unpack_xy_index
+from DeltaSharing import DeltaEncoder
+from Instrumentation import Instrumentation, StepRecorder
+from Kinematics import Kinematics
+from LogFilters import limit_warnings
+from MessageBus import MessageBus
+from ProbMap import ProbMapData
+from SharedMemoryRunner import SharedMemoryRunner
+from SocketTransport import SocketTransport
+from SpatialIndex import GridIndex
+from Trace import TraceWriter
 from target import Target
-from tracker import Tracker
+from tracker import Sensor, Tracker
 
 import sys
 import numpy
@@ -15,12 +25,18 @@ numpy.set_printoptions(threshold=sys.maxsize)
 
 
 class Simsim:
+    # Tracker phases of the phased scheduler, every phase finishes for all
+    # trackers before the next one starts
+    PHASES = ('publish_v', 'update', 'publish_Q', 'merge', 'estimate')
+    # what each publishing phase publishes
+    PUBLISHES = {'publish_v': 'v', 'publish_Q': 'Q'}
+
     class Topics:
         def __init__(self) -> None:
             self.topics = dict()
 
-        def add_topic(self, topic_name):
-            self.topics[topic_name] = deque(maxlen=20)
+        def add_topic(self, topic_name, maxlen=20):
+            self.topics[topic_name] = deque(maxlen=maxlen)
 
         def del_topic(self, topic_name):
             try:
@@ -34,32 +50,349 @@ class Simsim:
         def subs(self, topic_name):
             return self.topics[topic_name]
 
-    def __init__(self) -> None:
+    def __init__(self, seed=None, batch_sensing=False, headless=False,
+                 phased=False, executor=None) -> None:
+        """The simulator
+
+        Args:
+            seed (int, optional): Seed of the robots' random generators. Defaults to None.
+            batch_sensing (bool, optional): Sense for all trackers in one pass, see sense_all. Defaults to False.
+            headless (bool, optional): Don't open a live view, matplotlib is never imported. Defaults to False.
+            phased (bool, optional): Step all trackers phase by phase, see _update_phased. Defaults to False.
+            executor (concurrent.futures.Executor, optional): Thread pool running the trackers'
+                phases, None runs them in order. Defaults to None. For processes see
+                enable_shared_memory, which keeps the trackers in the workers.
+        """
+        if isinstance(executor, ProcessPoolExecutor):
+            raise ValueError("Trackers would be pickled to the processes and back in every "
+                             "phase, use enable_shared_memory instead")
         self.trackers = []
         self.edges = []
         self.targets = []
+        # {group: Kinematics}, the motion state of the trackers and of the
+        # targets. Robots are added in ID order, so a robot's slot is its ID.
+        self.motion = dict()
         self.map_size = [1000, 1000]
         self.rate = 30
         self.topics = self.Topics()
+        self.seed = seed
+        self._seed_seq = np.random.SeedSequence(seed)
+        self.batch_sensing = batch_sensing
+        # spatial index of the targets, rebuilt lazily after they moved
+        self.target_index = GridIndex(cell_size=150)
+        self._target_index_dirty = True
+        self.step_count = 0
+        # communication range of the dynamic neighbor discovery, None keeps
+        # the edges given by add_edges, see enable_dynamic_neighbors
+        self.comm_range = None
+        self.neighbor_index = GridIndex(cell_size=300)
+        # sorted packed (i, j) keys of the current edges, i < j, None when
+        # they have to be rebuilt from self.edges
+        self._edge_keys = None
+        # DeltaEncoder arguments when delta sharing of Q maps is enabled
+        self.delta_sharing = None
+        self.phased = phased
+        self.executor = executor
+        # Front buffer of the phased scheduler, the payloads published in
+        # the last publishing phase: {'v': {tracker id: ProbMapData}, 'Q': {...}}
+        self._shared = None
+        self._pending_acks = []
+        # MessageBus carrying the payloads between trackers, None reads them
+        # directly, see enable_message_bus
+        self.bus = None
+        # SocketTransport or SharedMemoryRunner stepping the trackers in
+        # other processes, see enable_socket_transport / enable_shared_memory
+        self.transport = None
+        # per-step timings and counters, see enable_instrumentation
+        self.instrumentation = None
+        # TraceWriter recording every step, see start_trace
+        self.trace = None
+
+        self.renderer = None
+        if not headless:
+            self.attach_renderer()
+
+    def attach_renderer(self, interval=1, ground_truth=False):
+        """Draw the simulation every interval-th step
+
+        Args:
+            interval (int, optional): Number of steps between frames. Defaults to 1.
+            ground_truth (bool, optional): Also draw the real targets. Defaults to False.
+
+        Returns:
+            Renderer: the attached renderer
+        """
+        self._check_local_trackers("draw them")
+        # imported here so headless runs never load matplotlib
+        from Renderer import Renderer
+        self.renderer = Renderer(self, interval, ground_truth)
+        return self.renderer
+
+    def detach_renderer(self):
+        self.renderer = None
 
-        plt.ion()
+    def _check_local_trackers(self, action):
+        # the trackers in other processes only send their estimates back,
+        # the simulator's copies keep a stale map, observations and payloads
+        if self.transport is not None:
+            raise ValueError(f"The trackers are stepped by the {type(self.transport).__name__}, "
+                             f"disable it to {action}")
 
-        # self.fig, (self.plt_sim, self.plt_pm) = plt.subplots(
-        #     1, 2, figsize=(10, 5), dpi=160)
-        fig = plt.figure(figsize=(20, 8))
-        self.plt_sim = fig.add_subplot(121)
-        # plt.axis('equal')
-        self.plt_pm = fig.add_subplot(122, projection='3d')
-        # plt.axis('equal')
-        self.plt_sim.axis('equal')
+    def _check_no_observers(self, transport):
+        if self.trace is not None or self.renderer is not None:
+            raise ValueError(f"With the {transport} the trackers only send their estimates "
+                             "back, stop the trace and detach the renderer first")
 
-    def add_tracker(self, name, position, sensor_rad):
+    def add_tracker(self, name, position, sensor_rad, snapshot=None):
+        """Add a tracker
+
+        Args:
+            name (str): tracker's name
+            position (np.array): starting position [m]
+            sensor_rad (float): sensor range [m]
+            snapshot (str, optional): Start from this map snapshot, e.g. a neighbor's,
+                see Tracker.bootstrap_map. Defaults to None.
+        """
         tracker = Tracker(self, name, len(self.trackers),
                           position, sensor_rad)
+        if snapshot is not None:
+            tracker.bootstrap_map(snapshot)
+        if self.delta_sharing is not None:
+            tracker.q_encoder = DeltaEncoder(**self.delta_sharing)
+        if self.instrumentation is not None:
+            tracker.stats = StepRecorder()
         self.trackers.append(tracker)
 
+    def add_trackers(self, name, positions, sensor_rad):
+        """Add many trackers, with IDs in the order of positions
+
+        Args:
+            name (str): trackers' name
+            positions (np.ndarray): (n, 2) starting positions [m]
+            sensor_rad (float or np.ndarray): sensor range [m], scalar or (n,)
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        sensor_rad = np.broadcast_to(sensor_rad, len(positions))
+        for position, radius in zip(positions, sensor_rad.tolist()):
+            self.add_tracker(name, position, radius)
+
+    def add_targets(self, name, positions):
+        """Add many targets, with IDs in the order of positions
+
+        Args:
+            name (str): targets' name
+            positions (np.ndarray): (n, 2) starting positions [m]
+        """
+        for position in np.asarray(positions, dtype=np.float64).reshape(-1, 2):
+            self.add_target(name, position)
+
+    def enable_delta_sharing(self, tolerance=1e-3, snapshot_interval=50):
+        """Let all trackers share their Q maps as versioned deltas
+
+        Args:
+            tolerance (float, optional): Smallest change of a Q value worth sending. Defaults to 1e-3.
+            snapshot_interval (int, optional): Send a full snapshot every this many versions. Defaults to 50.
+        """
+        self.delta_sharing = dict(tolerance=tolerance,
+                                  snapshot_interval=snapshot_interval)
+        for tracker in self.trackers:
+            tracker.q_encoder = DeltaEncoder(**self.delta_sharing)
+
+    def enable_message_bus(self, **kwargs):
+        """Carry the payloads between trackers over a simulated network
+
+        Switches to the phased scheduler: after each publishing phase the
+        payloads are sent to the neighbors, which read what arrived on their
+        links. Measurements are read only once, a map until a newer one
+        arrives. A step lasts 1/rate seconds of the bus' time. Acknowledgments
+        of delta sharing travel back over the links, so with latency the
+        deltas are computed against older versions.
+
+        Args:
+            kwargs: link model, batching and coalescing, see MessageBus
+
+        Returns:
+            MessageBus: the bus, e.g. to set single links or read its stats
+        """
+        self.disable_message_bus()
+        self.phased = True
+        trackers = self.trackers
+        # no reference back to the simulator, the bus goes away with it
+        self.bus = MessageBus(self.topics, rng=self.spawn_rng(),
+                              on_ack=lambda p, r, version: trackers[p].acknowledge_Q(r, version),
+                              **kwargs)
+        self.bus.now = self.step_count / self.rate
+        return self.bus
+
+    def disable_message_bus(self):
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+
+    def enable_socket_transport(self, timeout=60.):
+        """Run every tracker in its own process, exchanging payloads over localhost TCP
+
+        Steps like the phased scheduler. The trackers stay in their processes
+        until disable_socket_transport, meanwhile the simulator's trackers only
+        move, sense and get the estimates back, so neither a trace nor a
+        renderer can be attached. Enable instrumentation before, to get the
+        trackers' timings including serialization and waiting.
+
+        Args:
+            timeout (float, optional): See SocketTransport. Defaults to 60.
+
+        Returns:
+            SocketTransport: the coordinator
+        """
+        if self.bus is not None:
+            raise ValueError("The socket transport replaces the message bus, disable it first")
+        self._check_no_observers('socket transport')
+        self.disable_socket_transport()
+        self.transport = SocketTransport(self, timeout)
+        return self.transport
+
+    def disable_socket_transport(self):
+        """Stop the tracker processes and take their trackers back
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def enable_shared_memory(self, workers=None, repartition=1.5):
+        """Step the trackers on worker processes, one region of the area each
+
+        The motion state and the published payloads move to shared memory,
+        see SharedMemoryRunner. Steps like the phased scheduler. The trackers
+        stay in the workers until disable_shared_memory, meanwhile the
+        simulator's trackers only get the estimates back, so neither a trace
+        nor a renderer can be attached. Enable instrumentation before, to get
+        the trackers' timings.
+
+        Args:
+            workers (int, optional): Number of worker processes, None for one per CPU. Defaults to None.
+            repartition (float, optional): See SharedMemoryRunner. Defaults to 1.5.
+
+        Returns:
+            SharedMemoryRunner: the coordinator
+        """
+        if self.bus is not None:
+            raise ValueError("The shared memory workers replace the message bus, disable it first")
+        self._check_no_observers('shared memory workers')
+        self.disable_shared_memory()
+        self.transport = SharedMemoryRunner(self, workers, repartition)
+        return self.transport
+
+    def disable_shared_memory(self):
+        """Stop the workers and take their trackers back
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def enable_dynamic_neighbors(self, comm_range):
+        """Recompute the neighbors from the trackers' positions every step
+
+        Trackers closer than comm_range are neighbors. The graph replaces the
+        edges given by add_edges and follows the trackers as they move.
+
+        Args:
+            comm_range (float): communication range [m]
+        """
+        self.comm_range = comm_range
+        # one grid cell per range keeps the pair search to 3x3 cells
+        self.neighbor_index.cell_size = comm_range
+        self.update_neighbors()
+
+    def disable_dynamic_neighbors(self):
+        """Keep the current neighbors from now on
+        """
+        self.comm_range = None
+
+    def update_neighbors(self):
+        """Recompute the neighbors from the current positions
+
+        The new edges are compared with the current ones and only the
+        trackers gaining or losing a neighbor are updated.
+
+        Returns:
+            int: number of edges added or removed
+        """
+        self.neighbor_index.rebuild(self.positions('trackers'))
+        first, second = self.neighbor_index.pairs_within(self.comm_range)
+        # sorted, the pairs come sorted by first then second
+        keys = pack_xy_index(first, second)
+        if self._edge_keys is None:
+            edges = np.asarray(self.edges, dtype=np.int64).reshape(-1, 2)
+            self._edge_keys = np.unique(pack_xy_index(edges.min(axis=1), edges.max(axis=1)))
+        if np.array_equal(keys, self._edge_keys):
+            return 0
+        added = unpack_xy_index(keys[find_keys(self._edge_keys, keys) < 0])
+        removed = unpack_xy_index(self._edge_keys[find_keys(keys, self._edge_keys) < 0])
+        changes = dict()
+        for (i, j), kind in [(pair, 0) for pair in added.tolist()] + \
+                [(pair, 1) for pair in removed.tolist()]:
+            changes.setdefault(i, ([], []))[kind].append(j)
+            changes.setdefault(j, ([], []))[kind].append(i)
+        for tracker_id, (gained, lost) in changes.items():
+            self.trackers[tracker_id].update_neighbors(gained, lost)
+        self._edge_keys = keys
+        self.edges = np.column_stack([first, second]).tolist()
+        return len(added) + len(removed)
+
+    def _update_neighbors_timed(self):
+        if self.comm_range is None:
+            return
+        if self.instrumentation is None:
+            self.update_neighbors()
+        else:
+            self.instrumentation.simulator.add(
+                'edge_changes', self.instrumentation.simulator.timed(
+                    'neighbors', self.update_neighbors))
+
+    def enable_instrumentation(self):
+        """Record every tracker's per-phase timings and counters each step
+
+        Returns:
+            Instrumentation: the rows collected so far, histograms and export
+        """
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation()
+        for tracker in self.trackers:
+            tracker.stats = StepRecorder()
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        for tracker in self.trackers:
+            tracker.stats = None
+        self.instrumentation = None
+
+    def start_trace(self, path, chunk_steps=32, cells=True, payloads=True):
+        """Record the state after every step to a trace file, see Trace
+
+        Args:
+            path (str): trace file, appended to if it exists
+            chunk_steps (int, optional): Steps per chunk. Defaults to 32.
+            cells (bool, optional): Record every tracker's active cells. Defaults to True.
+            payloads (bool, optional): Record the exchanged ProbMapData. Defaults to True.
+
+        Returns:
+            TraceWriter: the writer, stop it with stop_trace
+        """
+        self._check_local_trackers("trace them")
+        self.stop_trace()
+        self.trace = TraceWriter(path, chunk_steps, cells, payloads)
+        return self.trace
+
+    def stop_trace(self):
+        """Write the rest of the trace and close it
+        """
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
     def add_edges(self, edges):
         self.edges.extend(edges)
+        self._edge_keys = None
         for e in edges:
             self.trackers[e[0]].neighbor.add(e[1])
             self.trackers[e[1]].neighbor.add(e[0])
@@ -67,70 +400,248 @@ class Simsim:
     def add_target(self, name, position):
         target = Target(self, name, len(self.targets), position)
         self.targets.append(target)
+        self._target_index_dirty = True
+
+    def get_motion(self, group):
+        """The Kinematics arrays of a group of robots, created on first use
+        """
+        if group not in self.motion:
+            self.motion[group] = Kinematics()
+        return self.motion[group]
+
+    def positions(self, group):
+        """Current positions of all trackers or targets
+
+        Args:
+            group (str): 'trackers' or 'targets'
+
+        Returns:
+            np.ndarray: (n, 2) copy of the positions, row i is the robot with ID i
+        """
+        count = len(getattr(self, group))
+        return self.get_motion(group).position[:count].copy()
+
+    def spawn_rng(self):
+        """Create an independent random generator derived from the seed
+        """
+        return np.random.default_rng(self._seed_seq.spawn(1)[0])
+
+    @property
+    def num_trackers(self):
+        return len(self.trackers)
+
+    def get_shared(self, tracker_id, kind, reader_id=None):
+        """Get what a tracker published
+
+        Args:
+            tracker_id (int): publisher's ID
+            kind (str): 'v' for measurements, 'Q' for the map
+            reader_id (int, optional): Reader's ID, with a message bus it reads what
+                arrived on its link, measurements only once. Defaults to None.
+
+        Returns:
+            ProbMapData: the live payload, or the last phase's snapshot when phased
+        """
+        if self.bus is not None and reader_id is not None:
+            # fusing the same measurements twice would count them twice
+            data = self.bus.receive(tracker_id, reader_id, kind, consume=kind == 'v')
+            # nothing new arrived
+            return ProbMapData() if data is None else data
+        if self._shared is not None:
+            return self._shared[kind][tracker_id]
+        return getattr(self.trackers[tracker_id], 'shareable_' + kind)
+
+    def acknowledge_Q(self, publisher_id, reader_id, version):
+        """Tell a publisher which version of its Q map a reader holds
+        """
+        if self._shared is not None:
+            # applied, or sent over the bus, at the end of the phase on the
+            # main thread, the phase may run on the executor's threads
+            self._pending_acks.append((publisher_id, reader_id, version))
+        else:
+            self.trackers[publisher_id].acknowledge_Q(reader_id, version)
+
+    def _refresh_target_index(self):
+        if self._target_index_dirty:
+            if self.trackers:
+                # one grid cell per sensor range keeps queries to 3x3 cells
+                self.target_index.cell_size = max(
+                    t.sensor.coverage_radius for t in self.trackers)
+            self.target_index.rebuild(self.positions('targets'))
+            self._target_index_dirty = False
+
+    def query_targets(self, position, radius):
+        """Find the targets within radius of a position
+
+        Args:
+            position (np.array): query position [m]
+            radius (float): query radius [m]
+
+        Returns:
+            np.ndarray: sorted indices into self.targets
+        """
+        self._refresh_target_index()
+        return self.target_index.query_radius(position, radius)
+
+    def sense_all(self):
+        """Sense for all trackers in one pass
+
+        Finds every tracker-target pair in range at once, draws each tracker's
+        noise from its own seeded generator and hands every tracker its array
+        of detections.
+        """
+        self._refresh_target_index()
+        Sensor.sense_many(self.trackers, self.positions('trackers'), self.target_index)
+
+    def _move_trackers(self):
+        """Tracker.random_moving for all trackers in one vectorized pass
+
+        With dynamic neighbors the graph is updated to the new positions.
+        """
+        if self.instrumentation is None:
+            Tracker.random_moving_all(self.trackers)
+        else:
+            self.instrumentation.simulator.timed(
+                'random_moving', Tracker.random_moving_all, self.trackers)
+        self._update_neighbors_timed()
+
+    def _sense_all_timed(self):
+        if self.instrumentation is None:
+            self.sense_all()
+        else:
+            self.instrumentation.simulator.timed('sense_all', self.sense_all)
+
+    def _run_phase(self, phase):
+        if self.executor is None:
+            for tracker in self.trackers:
+                getattr(tracker, phase)()
+        else:
+            for _ in self.executor.map(lambda t: getattr(t, phase)(), self.trackers):
+                pass
+
+    def _update_phased(self):
+        """Simulate once, every tracker phase runs for all trackers in turn
+
+        Payloads are double-buffered: trackers publish into their own
+        shareable_v / shareable_Q, and after each publishing phase all of them
+        are snapshotted into the front buffer that neighbors read from. So a
+        step does not depend on the order of the trackers, and each phase can
+        run the trackers concurrently on the executor.
+
+        With a message bus the published payloads are sent to the neighbors
+        instead, and they read what arrived by the time of the step.
+        """
+        if self.bus is not None:
+            self.bus.run_until(self.step_count / self.rate)
+        self._move_trackers()
+        self._sense_all_timed()
+        self._shared = {kind: {t.id: getattr(t, 'shareable_' + kind) for t in self.trackers}
+                        for kind in self.PUBLISHES.values()}
+        for phase in self.PHASES:
+            self._run_phase(phase)
+            kind = self.PUBLISHES.get(phase)
+            if kind is not None:
+                self._shared[kind] = {t.id: getattr(t, 'shareable_' + kind)
+                                      for t in self.trackers}
+                if self.bus is not None:
+                    for t in self.trackers:
+                        self.bus.publish(t.id, kind, self._shared[kind][t.id], t.neighbor)
+                    # what needs no time arrives before the next phase
+                    self.bus.run_until(self.step_count / self.rate)
+            acks, self._pending_acks = self._pending_acks, []
+            for publisher_id, reader_id, version in acks:
+                if self.bus is not None:
+                    # applied when it arrives over the link
+                    self.bus.acknowledge(publisher_id, reader_id, version)
+                else:
+                    self.trackers[publisher_id].acknowledge_Q(reader_id, version)
 
     def _update_all(self):
         """Simulate once, update all trackers and targets
         """
-        for tracker in self.trackers:
-            tracker.job()
-        for target in self.targets:
-            target.job()
+        if self.transport is not None:
+            self.transport.update()
+        elif self.phased:
+            self._update_phased()
+        elif self.batch_sensing:
+            self._move_trackers()
+            self._sense_all_timed()
+            for tracker in self.trackers:
+                tracker.fuse()
+        else:
+            # Tracker.job, with all trackers moved at once
+            self._move_trackers()
+            for tracker in self.trackers:
+                tracker._timed('sensing', tracker.sensing)
+                tracker.fuse()
+        if self.instrumentation is None:
+            Target.job_all(self.targets)
+        else:
+            self.instrumentation.simulator.timed('target_motion', Target.job_all, self.targets)
+        self._target_index_dirty = True
+
+    def step(self, n=1):
+        """Advance the simulation by n steps
 
-    def run(self, log_lvl=logging.WARN, ground_truth=False):
+        Args:
+            n (int, optional): Number of steps. Defaults to 1.
+
+        Returns:
+            list: one result per step, {'step': int, 'time': float [s], 'estimates': {tracker_id: list}}
+        """
+        results = []
+        for _ in range(n):
+            start = time.perf_counter()
+            self._update_all()
+            elapsed = time.perf_counter() - start
+            self.step_count += 1
+            if self.instrumentation is not None:
+                self.instrumentation.simulator.add_time('step', elapsed)
+                if self.bus is not None:
+                    for name, value in self.bus.stats.pop().items():
+                        self.instrumentation.simulator.add('bus_' + name, value)
+                self.instrumentation.collect(self.step_count, self.trackers)
+            if self.trace is not None:
+                self.trace.record_step(self)
+            results.append({
+                'step': self.step_count,
+                'time': elapsed,
+                'estimates': {t.id: t.target_estimates for t in self.trackers},
+            })
+            if self.renderer is not None and self.step_count % self.renderer.interval == 0:
+                self.renderer.draw()
+        return results
+
+    def run(self, log_lvl=logging.WARN, ground_truth=False, steps=None, until=None,
+            warning_interval=None):
+        """Run the simulation
+
+        Without steps and until it runs forever, like a live demo. Without
+        steps only the last result is kept, so memory doesn't grow.
+
+        Args:
+            log_lvl (int, optional): Logging level. Defaults to logging.WARN.
+            ground_truth (bool, optional): Let the renderer draw the real targets. Defaults to False.
+            steps (int, optional): Stop after this many steps. Defaults to None.
+            until (callable, optional): Stop once until(simulator, result) returns True. Defaults to None.
+            warning_interval (float, optional): Repeat each per-step warning at most once per this
+                many seconds, see LogFilters. Defaults to None, no limit.
+
+        Returns:
+            list: the per-step results, see step, only the last one without steps
+        """
         logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %H:%M:%S', level=log_lvl)
-        while 1:
-            self._update_all()
-            self.plt_sim.cla()
-            self.plt_pm.cla()
-            self.plt_sim.set_xlim(0, self.map_size[0])
-            self.plt_sim.set_ylim(0, self.map_size[1])
-            self.plt_pm.set_xlim(1000, 2000)
-            self.plt_pm.set_ylim(1000, 2000)
-
-            if ground_truth:
-                for target in self.targets:
-                    self.plt_sim.scatter(
-                        target.position[0], target.position[1], marker='x', s=2, color='r')
-            for e in self.edges:
-                t0 = self.trackers[e[0]]
-                t1 = self.trackers[e[1]]
-                self.plt_sim.plot([t0.position[0], t1.position[0]],
-                                  [t0.position[1], t1.position[1]],
-                                  linewidth=1, color='g', alpha=0.5)
-            Z = np.zeros([2000, 2000])
-            for t in self.trackers:
-                # draw the trackers
-                self.plt_sim.scatter(t.position[0], t.position[1],
-                                     marker='s', s=20, c='b')
-                self.plt_sim.annotate(t.id, (t.position[0], t.position[1]+10))
-                # draw the camera coverage
-                circle = plt.Circle(
-                    (t.position), t.sensor.coverage_radius, fill=False, color='grey', alpha=0.3)
-                self.plt_sim.add_patch(circle)
-                for est in t.target_estimates:
-                    det_pos = est[0:2]
-                    # det_abs_pos = det_pos+t.position
-                    self.plt_sim.scatter(det_pos[0], det_pos[1],
-                                         marker='^', s=2)
-                # t = self.trackers[2]
-                for ind in t.prob_map.prob_map:
-                    Z[ind] = t.prob_map.prob_map[ind]
-                    for dx in [-2, -1, 0, 1, 2]:
-                        for dy in [-2, -1, 0, 1, 2]:
-                            if Z[ind[0]+dx, ind[1]+dy] <= t.prob_map.prob_map[ind]:
-                                Z[ind[0]+dx, ind[1] +
-                                    dy] = t.prob_map.prob_map[ind]
-            # print(Z)
-            X = np.arange(1000, 2000, 1)
-            Y = np.arange(1000, 2000, 1)
-            X, Y = np.meshgrid(X, Y)
-            self.plt_pm.set_zlim(0, 1.01)
-            # print(Z)
-            self.plt_pm.plot_surface(
-                X, Y, Z[1000:, 1000:], cmap='RdBu_r', rcount=150, ccount=150, antialiased=True)
-            self.plt_pm.view_init(elev=35., azim=0)
-            plt.gca().invert_yaxis()
-            # self.plt_pm.plot_surface(X, Y, Z, cmap=cm.bwr, linewidth=5, antialiased=True)
-            self.plt_pm.zaxis.set_major_locator(LinearLocator(10))
-            plt.pause(1/self.rate)
+        if warning_interval is not None:
+            limit_warnings(warning_interval)
+        if self.renderer is not None:
+            self.renderer.ground_truth = ground_truth
+        results = deque(maxlen=1) if steps is None else []
+        count = 0
+        while steps is None or count < steps:
+            result = self.step()[0]
+            results.append(result)
+            count += 1
+            if until is not None and until(self, result):
+                break
+        return list(results)
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import pickle
+import selectors
+import socket
+import struct
+import time
+from collections import deque
+
+from ProbMap import ProbMapData
+
+"""
+Trackers running as separate processes, talking over localhost TCP
+
+Every tracker runs in its own process and sends its payloads to its
+neighbors as ProbMapData wire format (see ProbMapData.to_bytes) over
+persistent TCP connections. The simulator's process is the coordinator: it
+moves the robots and senses, sends every tracker its observations, and
+waits until all trackers finished the step.
+
+A step of a tracker process, the same phases as Simsim._update_phased:
+
+    STEP from the coordinator (observations, neighbors)
+    publish_v, send v to the neighbors, wait for theirs, update
+    publish_Q, send Q to the neighbors, wait for theirs, merge
+    send an ACK to every neighbor, wait for theirs, estimate
+    DONE to the coordinator (estimates, timings)
+
+Every message is a frame, a header followed by the body:
+
+    header  struct '<BiqI': frame type, sender's tracker ID, step, body length
+
+All sockets are non-blocking and served by one selectors loop per process,
+which also flushes what could not be sent at once.
+
+Implementations
+---------------
+1. FrameLoop := selectors loop over non-blocking connections, sends and parses frames
+2. SocketTransport := Coordinator, starts one process per tracker and keeps the steps in sync
+"""
+
+_FRAME = struct.Struct('<BiqI')
+_PORT = struct.Struct('<i')
+_VERSION = struct.Struct('<q')
+
+# frame types
+HELLO, PEERS, STEP, PAYLOAD_V, PAYLOAD_Q, ACK, DONE, STOP, STATE = range(9)
+_PAYLOAD_FRAMES = {'v': PAYLOAD_V, 'Q': PAYLOAD_Q}
+_PAYLOAD_KINDS = {PAYLOAD_V: 'v', PAYLOAD_Q: 'Q'}
+
+
+class _Connection:
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.received = bytearray()
+        self.unsent = bytearray()
+
+
+class FrameLoop:
+
+    def __init__(self, handler):
+        """Non-blocking frame connections served by one selector
+
+        Args:
+            handler (callable): called with (connection, frame type, sender, step, body)
+                for every complete frame received
+        """
+        self.handler = handler
+        self.selector = selectors.DefaultSelector()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def listen(self):
+        """Accept connections on a free localhost port
+
+        Returns:
+            int: the port
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, None)
+        return server.getsockname()[1]
+
+    def connect(self, port):
+        sock = socket.create_connection(('127.0.0.1', port))
+        connection = _Connection(sock)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+        return connection
+
+    def send(self, connection, frame_type, sender, step, body=b''):
+        """Queue a frame and send as much of it as the socket takes now
+        """
+        was_empty = not connection.unsent
+        connection.unsent += _FRAME.pack(frame_type, sender, step, len(body))
+        connection.unsent += body
+        self._flush(connection)
+        if was_empty and connection.unsent:
+            self.selector.modify(connection.sock,
+                                 selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.unsent)
+        except BlockingIOError:
+            return
+        self.bytes_sent += sent
+        del connection.unsent[:sent]
+
+    def _receive(self, connection):
+        while True:
+            try:
+                data = connection.sock.recv(1 << 20)
+            except BlockingIOError:
+                break
+            if not data:
+                # the other side is gone
+                self.selector.unregister(connection.sock)
+                connection.sock.close()
+                break
+            self.bytes_received += len(data)
+            connection.received += data
+        buffer = connection.received
+        start = 0
+        while len(buffer) - start >= _FRAME.size:
+            frame_type, sender, step, length = _FRAME.unpack_from(buffer, start)
+            end = start + _FRAME.size + length
+            if len(buffer) < end:
+                break
+            body = bytes(buffer[start + _FRAME.size:end])
+            start = end
+            self.handler(connection, frame_type, sender, step, body)
+        del buffer[:start]
+
+    def poll(self, timeout=None):
+        """Serve the sockets once, waiting at most timeout seconds for them
+        """
+        for key, mask in self.selector.select(timeout):
+            connection = key.data
+            if connection is None:
+                sock, _address = key.fileobj.accept()
+                connection = _Connection(sock)
+                self.selector.register(sock, selectors.EVENT_READ, connection)
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self._flush(connection)
+                if not connection.unsent:
+                    self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+            if mask & selectors.EVENT_READ:
+                self._receive(connection)
+
+    def wait_for(self, condition, check=None, interval=1.0):
+        """Serve the sockets until condition() is true
+
+        Args:
+            condition (callable): checked after every poll
+            check (callable, optional): called every interval seconds while waiting,
+                e.g. to raise when a process died. Defaults to None.
+            interval (float, optional): [s]. Defaults to 1.0.
+        """
+        while not condition():
+            self.poll(interval)
+            if check is not None:
+                check()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+class _TrackerProcess:
+    """Runs one tracker in its process, standing in for the simulator
+    """
+
+    def __init__(self, tracker, coordinator_port):
+        self.tracker = tracker
+        tracker.simulator = self
+        self.num_trackers = 0
+        self.step = 0
+        self.loop = FrameLoop(self._on_frame)
+        port = self.loop.listen()
+        self.coordinator = self.loop.connect(coordinator_port)
+        self.loop.send(self.coordinator, HELLO, tracker.id, 0, _PORT.pack(port))
+        # {tracker id: port} of all trackers, from the coordinator
+        self.ports = dict()
+        # {tracker id: connection} pooled connections to the neighbors
+        self.peers = dict()
+        # {(step, kind): {sender: ProbMapData}}
+        self.inbox = dict()
+        # {step: {sender: version}}
+        self.acks = dict()
+        # {publisher id: version} acknowledged in this step's merge
+        self._acknowledged = dict()
+        self.commands = deque()
+
+    def _on_frame(self, connection, frame_type, sender, step, body):
+        if frame_type in _PAYLOAD_KINDS:
+            self.inbox.setdefault((step, _PAYLOAD_KINDS[frame_type]), dict())[sender] = \
+                ProbMapData.from_buffer(body)
+        elif frame_type == ACK:
+            self.acks.setdefault(step, dict())[sender] = _VERSION.unpack(body)[0]
+        else:
+            self.commands.append((frame_type, step, body))
+
+    def get_shared(self, tracker_id, kind, reader_id=None):
+        return self.inbox[(self.step, kind)][tracker_id]
+
+    def acknowledge_Q(self, publisher_id, reader_id, version):
+        self._acknowledged[publisher_id] = version
+
+    def _send_peer(self, peer, frame_type, body):
+        connection = self.peers.get(peer)
+        if connection is None:
+            connection = self.loop.connect(self.ports[peer])
+            self.peers[peer] = connection
+        self.loop.send(connection, frame_type, self.tracker.id, self.step, body)
+
+    def _timed(self, phase, func, *args):
+        return self.tracker._timed(phase, func, *args)
+
+    def _exchange(self, kind):
+        """Send our payload to the neighbors and wait for theirs
+        """
+        tracker = self.tracker
+        body = self._timed('serialize', getattr(tracker, 'shareable_' + kind).to_bytes)
+        for e in tracker.neighbor:
+            self._send_peer(e, _PAYLOAD_FRAMES[kind], body)
+        key = (self.step, kind)
+        self._timed('wait_' + kind, self.loop.wait_for,
+                    lambda: len(self.inbox.get(key, ())) >= len(tracker.neighbor))
+
+    def _run_step(self, body):
+        tracker = self.tracker
+        observations, neighbors, self.num_trackers = pickle.loads(body)
+        neighbors = set(neighbors)
+        if neighbors != tracker.neighbor:
+            tracker.update_neighbors(neighbors - tracker.neighbor,
+                                     tracker.neighbor - neighbors)
+        tracker.observations = observations
+        tracker.publish_v()
+        self._exchange('v')
+        tracker.update()
+        tracker.publish_Q()
+        self._exchange('Q')
+        self._acknowledged = dict()
+        tracker.merge()
+        # one ACK per neighbor, 0 if there is no version to acknowledge
+        for e in tracker.neighbor:
+            self._send_peer(e, ACK, _VERSION.pack(self._acknowledged.get(e, 0)))
+        self._timed('wait_ack', self.loop.wait_for,
+                    lambda: len(self.acks.get(self.step, ())) >= len(tracker.neighbor))
+        for reader_id, version in sorted(self.acks.pop(self.step, dict()).items()):
+            if version:
+                tracker.acknowledge_Q(reader_id, version)
+        tracker.estimate()
+        for kind in _PAYLOAD_FRAMES:
+            self.inbox.pop((self.step, kind), None)
+        record = None
+        if tracker.stats is not None:
+            tracker.stats.set('bytes_wire_sent', self.loop.bytes_sent)
+            tracker.stats.set('bytes_wire_received', self.loop.bytes_received)
+            record = tracker.stats.pop()
+        self.loop.bytes_sent = self.loop.bytes_received = 0
+        self.loop.send(self.coordinator, DONE, tracker.id, self.step,
+                       pickle.dumps((tracker.target_estimates, record)))
+
+    def run(self):
+        while True:
+            self.loop.wait_for(lambda: self.commands)
+            frame_type, step, body = self.commands.popleft()
+            if frame_type == PEERS:
+                self.ports = pickle.loads(body)
+            elif frame_type == STEP:
+                self.step = step
+                self._run_step(body)
+            elif frame_type == STOP:
+                self.loop.send(self.coordinator, STATE, self.tracker.id, step,
+                               pickle.dumps(self.tracker))
+                self.loop.wait_for(lambda: not self.coordinator.unsent)
+                self.loop.close()
+                return
+
+
+def _tracker_main(tracker, coordinator_port):
+    _TrackerProcess(tracker, coordinator_port).run()
+
+
+class SocketTransport:
+
+    def __init__(self, simulator, timeout=60.):
+        """Start one process per tracker and connect them
+
+        The trackers run in their processes until close, which brings them
+        back to the simulator. Trackers can't be added in between.
+
+        Args:
+            simulator (Simsim): the coordinator's simulator
+            timeout (float, optional): Give up when the processes don't connect in time [s]. Defaults to 60.
+        """
+        self.simulator = simulator
+        self.loop = FrameLoop(self._on_frame)
+        port = self.loop.listen()
+        # fork, if the platform has it, starts much faster than spawn
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.processes = [context.Process(target=_tracker_main, args=(t, port), daemon=True)
+                          for t in simulator.trackers]
+        for process in self.processes:
+            process.start()
+        # {tracker id: connection}
+        self.connections = dict()
+        self.ports = dict()
+        self._done = dict()
+        self._states = dict()
+        deadline = time.monotonic() + timeout
+        self.loop.wait_for(lambda: len(self.ports) == len(self.processes),
+                           lambda: self._check(deadline))
+        body = pickle.dumps(self.ports)
+        for tracker_id, connection in self.connections.items():
+            self.loop.send(connection, PEERS, -1, 0, body)
+
+    def _on_frame(self, connection, frame_type, sender, step, body):
+        if frame_type == HELLO:
+            self.connections[sender] = connection
+            self.ports[sender] = _PORT.unpack(body)[0]
+        elif frame_type == DONE:
+            self._done[sender] = pickle.loads(body)
+        elif frame_type == STATE:
+            self._states[sender] = pickle.loads(body)
+
+    def _check(self, deadline=None):
+        for tracker_id, process in enumerate(self.processes):
+            if not process.is_alive() and tracker_id not in self._states:
+                # what it sent before exiting may still be unread
+                self.loop.poll(0)
+                if tracker_id in self._states:
+                    continue
+                raise RuntimeError(f"The process of tracker {tracker_id} exited "
+                                   f"with code {process.exitcode}")
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("The tracker processes didn't connect in time")
+
+    def update(self):
+        """Move and sense in the coordinator, then step every tracker process
+        """
+        simulator = self.simulator
+        simulator._move_trackers()
+        simulator._sense_all_timed()
+        for t in simulator.trackers:
+            self.loop.send(self.connections[t.id], STEP, -1, simulator.step_count,
+                           pickle.dumps((t.observations, sorted(t.neighbor),
+                                         simulator.num_trackers)))
+        self.loop.wait_for(lambda: len(self._done) == len(self.processes), self._check)
+        for t in simulator.trackers:
+            t.target_estimates, record = self._done[t.id]
+            if record is not None and t.stats is not None:
+                for name, value in record.items():
+                    t.stats.add(name, value)
+        self._done = dict()
+
+    def close(self):
+        """Stop the processes and bring their trackers back to the simulator
+        """
+        simulator = self.simulator
+        for connection in self.connections.values():
+            self.loop.send(connection, STOP, -1, simulator.step_count)
+        self.loop.wait_for(lambda: len(self._states) == len(self.processes), self._check)
+        for i, tracker in enumerate(simulator.trackers):
+            restored = self._states[tracker.id]
+            restored.simulator = simulator
+            restored.attach_motion(simulator.get_motion(restored.motion_group), tracker._slot)
+            # the coordinator kept moving and sensing with the tracker's random
+            # generator, and keeps the statistics collected so far
+            restored.rng = tracker.rng
+            restored.stats = tracker.stats
+            simulator.trackers[i] = restored
+        for process in self.processes:
+            process.join()
+        self.loop.close()
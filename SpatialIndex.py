@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from CellStore import pack_xy_index
+
+"""
+Spatial indexing for range queries over robot positions
+
+Implementations
+---------------
+1. GridIndex := Uniform grid (cell list) over 2D points, rebuilt per step
+"""
+
+
+class GridIndex:
+
+    def __init__(self, cell_size):
+        """Uniform grid over 2D points
+
+        Points are bucketed by the grid cell they fall in and the buckets are
+        kept as one array sorted by cell key, so a rebuild is a single argsort
+        and a radius query only scans the cells overlapping the query circle.
+
+        Args:
+            cell_size (float): grid cell size [m], ideally close to the typical query radius
+        """
+        self.cell_size = cell_size
+        self.positions = np.empty((0, 2))
+        self._order = np.empty(0, dtype=np.int64)
+        self._sorted_keys = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell_of(self, positions):
+        return np.floor(positions / self.cell_size).astype(np.int64)
+
+    def rebuild(self, positions):
+        """Index a new set of points
+
+        Args:
+            positions (np.ndarray): (n, 2) point positions [m]
+        """
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        cells = self._cell_of(self.positions)
+        keys = pack_xy_index(cells[:, 0], cells[:, 1])
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+    def _candidates(self, lower_cell, upper_cell):
+        """Indices of all points in the cells between lower_cell and upper_cell
+        """
+        xs = np.arange(lower_cell[0], upper_cell[0] + 1)
+        ys = np.arange(lower_cell[1], upper_cell[1] + 1)
+        keys = pack_xy_index(np.repeat(xs, len(ys)), np.tile(ys, len(xs)))
+        starts = np.searchsorted(self._sorted_keys, keys, side='left')
+        ends = np.searchsorted(self._sorted_keys, keys, side='right')
+        return np.concatenate([self._order[s:e] for s, e in zip(starts, ends)]
+                              + [np.empty(0, dtype=np.int64)])
+
+    def query_radius(self, center, radius):
+        """Find all points strictly closer than radius to center
+
+        Args:
+            center (np.ndarray): query position [m]
+            radius (float): query radius [m]
+
+        Returns:
+            np.ndarray: sorted indices of the points in range
+        """
+        center = np.asarray(center, dtype=np.float64)
+        candidates = self._candidates(self._cell_of(center - radius),
+                                      self._cell_of(center + radius))
+        distance = np.linalg.norm(self.positions[candidates] - center, axis=1)
+        return np.sort(candidates[distance < radius])
+
+    def query_pairs(self, centers, radii):
+        """Find all (query, point) pairs closer than the query's radius
+
+        All queries are answered together, one vectorized pass per grid cell
+        offset instead of one pass per query.
+
+        Args:
+            centers (np.ndarray): (m, 2) query positions [m]
+            radii (np.ndarray): (m,) query radii [m]
+
+        Returns:
+            tuple: (query indices, point indices), sorted by query then point
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), len(centers))
+        empty = np.empty(0, dtype=np.int64)
+        if len(centers) == 0 or len(self.positions) == 0:
+            return empty, empty
+        span = int(np.ceil(radii.max() / self.cell_size))
+        cells = self._cell_of(centers)
+        query_ids = np.arange(len(centers))
+        found_queries, found_points = [empty], [empty]
+        for dx in range(-span, span + 1):
+            for dy in range(-span, span + 1):
+                keys = pack_xy_index(cells[:, 0] + dx, cells[:, 1] + dy)
+                starts = np.searchsorted(self._sorted_keys, keys, side='left')
+                counts = np.searchsorted(self._sorted_keys, keys, side='right') - starts
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # expand every [start, start + count) range into flat positions
+                first = np.cumsum(counts) - counts
+                flat = np.arange(total) - np.repeat(first - starts, counts)
+                found_queries.append(np.repeat(query_ids, counts))
+                found_points.append(self._order[flat])
+        queries = np.concatenate(found_queries)
+        points = np.concatenate(found_points)
+        distance = np.linalg.norm(
+            self.positions[points] - centers[queries], axis=1)
+        in_range = distance < radii[queries]
+        queries, points = queries[in_range], points[in_range]
+        order = np.lexsort((points, queries))
+        return queries[order], points[order]
+
+    def pairs_within(self, radius):
+        """Find all pairs of indexed points closer than radius
+
+        Args:
+            radius (float): pair distance [m]
+
+        Returns:
+            tuple: (i, j) point indices with i < j, sorted by i then j
+        """
+        first, second = self.query_pairs(self.positions, radius)
+        unique = first < second
+        return first[unique], second[unique]
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from ProbMap import ProbMapData
+
+"""
+Recording of simulation traces and their replay
+
+A trace is an append-only file of chunks, each holding the state of a few
+consecutive steps:
+
+    chunk header   struct '<4sIQ': magic, table length, data length
+    table          JSON {'first_step', 'n_steps', 'arrays': {name: {'dtype', 'shape', 'offset'}}}
+    padding        up to the next multiple of 64 bytes
+    data           the raw arrays, each one starting at a multiple of 64 bytes
+
+so the reader can memory-map the file and hand out the arrays without
+copying them. Ragged data (detections, payloads, cells) is stored flat per
+chunk, with a segments array of [step, tracker id, start, end] rows telling
+which rows belong to which tracker and step.
+
+Implementations
+---------------
+1. TraceWriter := Buffers steps and writes chunks on a background thread
+2. TraceReader := Memory-maps a trace, seeks to any step
+"""
+
+_CHUNK_HEADER = struct.Struct('<4sIQ')
+_CHUNK_MAGIC = b'PMTC'
+_ALIGN = 64
+
+# kinds of published payloads, see Tracker.shareable_v / shareable_Q
+_PAYLOAD_KINDS = ('v', 'Q')
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _segments(rows):
+    """[step, owner, start, end] rows of consecutive blocks of the given sizes
+    """
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    ends = np.cumsum(rows[:, 2])
+    return np.column_stack([rows[:, 0], rows[:, 1], ends - rows[:, 2], ends])
+
+
+def _concat(arrays, empty):
+    return np.concatenate(list(arrays) + [empty])
+
+
+class TraceWriter:
+
+    def __init__(self, path, chunk_steps=32, cells=True, payloads=True, max_pending=4):
+        """Stream simulation steps to a trace file
+
+        record_step only takes copies of the state, the chunks are built and
+        written on a background thread.
+
+        Args:
+            path (str): trace file, appended to if it exists
+            chunk_steps (int, optional): Steps per chunk. Defaults to 32.
+            cells (bool, optional): Record every tracker's active cells. Defaults to True.
+            payloads (bool, optional): Record the exchanged ProbMapData. Defaults to True.
+            max_pending (int, optional): Chunks waiting for the writer before record_step blocks. Defaults to 4.
+        """
+        self.path = path
+        self.chunk_steps = chunk_steps
+        self.cells = cells
+        self.payloads = payloads
+        self._steps = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._file = open(path, 'ab')
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record_step(self, simulator):
+        """Take a copy of the simulator's current state
+        """
+        self._raise_error()
+        step = {
+            'step': simulator.step_count,
+            'trackers': simulator.positions('trackers'),
+            'targets': simulator.positions('targets'),
+            # replaced, not modified, by every sensing
+            'detections': [(t.id, t.observations) for t in simulator.trackers],
+        }
+        if self.payloads:
+            # payloads are rebuilt by every publish, never modified
+            for kind in _PAYLOAD_KINDS:
+                step['payload_' + kind] = [
+                    (t.id, getattr(t, 'shareable_' + kind)) for t in simulator.trackers]
+        if self.cells:
+            step['cells'] = [(t.id, t.prob_map.non_empty_cell.key_array().copy(),
+                              np.asarray(t.prob_map.non_empty_cell.value_array(),
+                                         dtype=np.float64).copy())
+                             for t in simulator.trackers]
+        self._steps.append(step)
+        if len(self._steps) >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered steps to the writer thread
+        """
+        if self._steps:
+            self._queue.put(self._steps)
+            self._steps = []
+
+    def close(self):
+        """Write everything buffered and wait for the writer thread
+        """
+        if self._thread is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Writing the trace {self.path} failed") from error
+
+    def _write_loop(self):
+        while True:
+            steps = self._queue.get()
+            if steps is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write_chunk(self._build_chunk(steps))
+            except Exception as error:
+                self._error = error
+
+    @staticmethod
+    def _build_chunk(steps):
+        """Turn buffered steps into {name: array}
+        """
+        arrays = {'steps': np.array([s['step'] for s in steps], dtype=np.int64)}
+        for kind in ('trackers', 'targets'):
+            arrays[kind] = _concat((s[kind] for s in steps), np.empty((0, 2)))
+            arrays[kind + '_segments'] = _segments(
+                [(s['step'], -1, len(s[kind])) for s in steps])
+        detections = [(s['step'], tid, det) for s in steps for tid, det in s['detections']]
+        arrays['detections'] = _concat((np.asarray(det, dtype=np.float64).reshape(-1, 3)
+                                        for _, _, det in detections), np.empty((0, 3)))
+        arrays['detections_segments'] = _segments(
+            [(step, tid, len(det)) for step, tid, det in detections])
+        for kind in _PAYLOAD_KINDS:
+            name = 'payload_' + kind
+            if name not in steps[0]:
+                continue
+            payloads = [(s['step'], tid, data) for s in steps for tid, data in s[name]]
+            arrays[name] = _concat((data.cells for _, _, data in payloads),
+                                   np.empty(0, dtype=ProbMapData.dtype))
+            arrays[name + '_deleted'] = _concat((data.deleted for _, _, data in payloads),
+                                                np.empty(0, dtype=ProbMapData.deleted_dtype))
+            arrays[name + '_segments'] = _segments(
+                [(step, tid, len(data)) for step, tid, data in payloads])
+            arrays[name + '_deleted_segments'] = _segments(
+                [(step, tid, len(data.deleted)) for step, tid, data in payloads])
+            arrays[name + '_versions'] = np.array(
+                [[data.version, data.base_version] for _, _, data in payloads],
+                dtype=np.int64).reshape(-1, 2)
+        if 'cells' in steps[0]:
+            cells = [(s['step'], tid, keys, values) for s in steps
+                     for tid, keys, values in s['cells']]
+            arrays['cells'] = _concat((c[2] for c in cells), np.empty(0, dtype=np.int64))
+            arrays['cells_values'] = _concat((c[3] for c in cells), np.empty(0))
+            arrays['cells_segments'] = _segments(
+                [(step, tid, len(keys)) for step, tid, keys, _ in cells])
+        return arrays
+
+    def _write_chunk(self, arrays):
+        table = {'first_step': int(arrays['steps'][0]),
+                 'n_steps': len(arrays['steps']),
+                 'arrays': dict()}
+        offset = 0
+        for name, array in arrays.items():
+            table['arrays'][name] = {'dtype': np.lib.format.dtype_to_descr(array.dtype),
+                                     'shape': list(array.shape),
+                                     'offset': offset}
+            offset = _aligned(offset + array.nbytes)
+        table = json.dumps(table).encode()
+        head = _CHUNK_HEADER.pack(_CHUNK_MAGIC, len(table), offset)
+        head += table
+        self._file.write(head + bytes(_aligned(len(head)) - len(head)))
+        for name, array in arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            self._file.write(data + bytes(_aligned(len(data)) - len(data)))
+        self._file.flush()
+
+
+class TraceReader:
+
+    def __init__(self, path):
+        """Replay a trace written by TraceWriter
+
+        Only the chunk headers are read up front, the arrays are views into
+        the memory-mapped file.
+
+        Args:
+            path (str): trace file
+        """
+        self.path = path
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        # (first step, number of steps, data offset in the file, table) per chunk
+        self._chunks = []
+        position = 0
+        while position + _CHUNK_HEADER.size <= len(self._mmap):
+            magic, table_size, data_size = _CHUNK_HEADER.unpack_from(self._mmap, position)
+            if magic != _CHUNK_MAGIC:
+                raise ValueError(f"{path} is not a trace, or is damaged at byte {position}")
+            start = position + _CHUNK_HEADER.size
+            table = json.loads(bytes(self._mmap[start:start + table_size]))
+            data_start = _aligned(start + table_size - position) + position
+            if data_start + data_size > len(self._mmap):
+                # the writer was interrupted in this chunk
+                break
+            self._chunks.append((table['first_step'], table['n_steps'], data_start, table))
+            position = data_start + data_size
+        self._first_steps = np.array([c[0] for c in self._chunks], dtype=np.int64)
+
+    @property
+    def steps(self):
+        """All recorded step numbers
+        """
+        return np.concatenate([self._array(i, 'steps') for i in range(len(self._chunks))]
+                              + [np.empty(0, dtype=np.int64)])
+
+    def _array(self, chunk, name):
+        _first, _n, data_start, table = self._chunks[chunk]
+        spec = table['arrays'].get(name)
+        if spec is None:
+            return None
+        dtype = np.lib.format.descr_to_dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        start = data_start + spec['offset']
+        return np.frombuffer(self._mmap, dtype=dtype, count=count,
+                             offset=start).reshape(spec['shape'])
+
+    def _chunk_of(self, step):
+        chunk = int(np.searchsorted(self._first_steps, step, side='right')) - 1
+        if chunk < 0 or step not in self._array(chunk, 'steps'):
+            raise KeyError(f"Step {step} is not in the trace")
+        return chunk
+
+    def _segments(self, chunk, name, step):
+        """{tracker id: rows} of one step of a ragged array
+        """
+        data = self._array(chunk, name)
+        segments = self._array(chunk, name + '_segments')
+        if data is None:
+            return None
+        rows = segments[segments[:, 0] == step]
+        return {int(owner): data[start:end] for _, owner, start, end in rows.tolist()}
+
+    def positions(self, step):
+        """Tracker and target positions after a step
+
+        Returns:
+            tuple: (trackers' positions, targets' positions), (n, 2) arrays ordered by ID
+        """
+        chunk = self._chunk_of(step)
+        return (self._segments(chunk, 'trackers', step)[-1],
+                self._segments(chunk, 'targets', step)[-1])
+
+    def detections(self, step):
+        """{tracker id: (k, 3) observations [x, y, confidence]} of a step
+        """
+        return self._segments(self._chunk_of(step), 'detections', step)
+
+    def cells(self, step):
+        """{tracker id: (packed keys, values)} of every tracker's active cells after a step
+        """
+        chunk = self._chunk_of(step)
+        keys = self._segments(chunk, 'cells', step)
+        if keys is None:
+            raise KeyError("The trace has no cells")
+        # the keys and values share cells_segments
+        values = self._array(chunk, 'cells_values')
+        segments = self._array(chunk, 'cells_segments')
+        rows = segments[segments[:, 0] == step]
+        return {int(owner): (keys[int(owner)], values[start:end])
+                for _, owner, start, end in rows.tolist()}
+
+    def payloads(self, step, kind='Q'):
+        """{tracker id: ProbMapData} published in a step, the cells are views into the trace
+
+        Args:
+            step (int): step number
+            kind (str, optional): 'v' for measurements, 'Q' for the maps. Defaults to 'Q'.
+        """
+        chunk = self._chunk_of(step)
+        name = 'payload_' + kind
+        cells = self._segments(chunk, name, step)
+        if cells is None:
+            raise KeyError("The trace has no payloads")
+        deleted = self._segments(chunk, name + '_deleted', step)
+        segments = self._array(chunk, name + '_segments')
+        versions = self._array(chunk, name + '_versions')[segments[:, 0] == step]
+        payloads = dict()
+        for (owner, records), (version, base_version) in zip(cells.items(), versions.tolist()):
+            data = ProbMapData()
+            data.type = kind
+            data.tracker_id = owner
+            data.version = version
+            data.base_version = base_version
+            data.cells = records
+            data.deleted = deleted[owner]
+            payloads[owner] = data
+        return payloads
+
+    def load_map(self, step, tracker_id, prob_map):
+        """Restore a tracker's map as it was after a step
+
+        Args:
+            step (int): step number
+            tracker_id (int): tracker's ID
+            prob_map (ProbMap): map to fill, same geometry as the tracker's
+        """
+        keys, values = self.cells(step)[tracker_id]
+        prob_map.non_empty_cell.clear()
+        prob_map.non_empty_cell.update_many(keys, values)
+        return prob_map
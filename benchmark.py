@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from CellStore import pack_xy_index, unpack_xy_index
+from ProbMap import ProbMap, ProbMapData, aggregate_cells
+from Simsim import Simsim
+
+"""
+Microbenchmarks for the ProbMap and Tracker hot paths
+
+Every benchmark builds fresh, seeded states per repeat and times one call
+on each, back to back, so the numbers don't drift with the state the
+previous call left behind and short calls are still well above the timer's
+resolution. Peak memory is measured on a separate call under tracemalloc,
+which would otherwise slow down the timed calls.
+
+A comparison refuses a baseline run with another storage, map size,
+repeat or number of calls, those numbers aren't comparable.
+
+Usage
+-----
+python benchmark.py                          # run the full sweep
+python benchmark.py --quick --only map_update
+python benchmark.py --save baseline.json     # keep the results
+python benchmark.py --compare baseline.json  # flag regressions, exit code 1 if any
+python benchmark.py --compare baseline.json --force  # compare even if the setups differ
+"""
+
+MAP_SIZE = 2000  # [m], same as the trackers' maps
+DETECTIONS = 20  # detections per tracker in the map update benchmarks
+
+SWEEPS = {
+    'map_update': dict(cells=[1000, 10000, 100000], d=[2, 4, 8]),
+    'consensus': dict(cells=[1000, 10000, 100000], d=[2, 4, 8]),
+    'convert_to_prob_map': dict(cells=[1000, 10000, 100000]),
+    'get_info_from_neighbors': dict(cells=[1000, 10000, 100000], d=[2, 4, 8]),
+    'get_detection': dict(targets_per_km2=[10, 100, 1000]),
+    'step': dict(N=[4, 16, 64], targets_per_km2=[10, 100]),
+}
+QUICK_SWEEPS = {
+    'map_update': dict(cells=[1000, 10000], d=[2, 8]),
+    'consensus': dict(cells=[1000, 10000], d=[2, 8]),
+    'convert_to_prob_map': dict(cells=[1000, 10000]),
+    'get_info_from_neighbors': dict(cells=[1000, 10000], d=[2, 8]),
+    'get_detection': dict(targets_per_km2=[10, 100]),
+    'step': dict(N=[4, 16], targets_per_km2=[10]),
+}
+
+
+def _random_keys(rng, n, pool=None):
+    """n distinct packed keys, from pool if given, otherwise anywhere on the map
+    """
+    if pool is not None:
+        return rng.choice(pool, min(n, len(pool)), replace=False)
+    flat = rng.choice(MAP_SIZE * MAP_SIZE, n, replace=False)
+    x, y = np.divmod(flat, MAP_SIZE)
+    return pack_xy_index(x, y)
+
+
+def _make_map(rng, cells, storage):
+    prob_map = ProbMap(MAP_SIZE, MAP_SIZE, 1, center_x=0.0, center_y=0.0,
+                       init_val=0.6, false_alarm_prob=0.05, storage=storage)
+    keys = _random_keys(rng, cells)
+    prob_map.non_empty_cell.update_many(keys, rng.uniform(-10, 10, cells))
+    return prob_map, keys
+
+
+def _payload(rng, keys, info_type, tracker_id):
+    return ProbMapData.from_cells(unpack_xy_index(keys), rng.uniform(-10, 10, len(keys)),
+                                  info_type, tracker_id)
+
+
+def _make_sim(rng, n_trackers, targets_per_km2, **kwargs):
+    sim = Simsim(seed=int(rng.integers(2**31)), headless=True, **kwargs)
+    for position in rng.uniform(-800, 800, (n_trackers, 2)):
+        sim.add_tracker('tracker', position, sensor_rad=250)
+    n_targets = int(targets_per_km2 * (MAP_SIZE / 1000.) ** 2)
+    for position in rng.uniform(-MAP_SIZE / 2, MAP_SIZE / 2, (n_targets, 2)):
+        sim.add_target('tgt', position)
+    return sim
+
+
+def bench_map_update(rng, storage, cells, d):
+    prob_map, keys = _make_map(rng, cells, storage)
+    # half of the detections hit existing cells
+    local_keys = np.unique(np.concatenate([_random_keys(rng, DETECTIONS // 2, keys),
+                                           _random_keys(rng, DETECTIONS // 2)]))
+    local = (local_keys, np.full(len(local_keys), prob_map.v_for_1))
+    neighbors = aggregate_cells(
+        _payload(rng, _random_keys(rng, DETECTIONS), 'v', i) for i in range(d))
+    return lambda: prob_map.map_update(local, neighbors[:2], 16, d)
+
+
+def bench_consensus(rng, storage, cells, d):
+    prob_map, keys = _make_map(rng, cells, storage)
+    # neighbors know most of our cells and some of their own
+    neighbors = aggregate_cells(
+        _payload(rng, np.concatenate([_random_keys(rng, cells * 9 // 10, keys),
+                                      _random_keys(rng, cells // 10)]), 'Q', i)
+        for i in range(d))
+    return lambda: prob_map.consensus(neighbors)
+
+
+def bench_convert_to_prob_map(rng, storage, cells):
+    prob_map, _keys = _make_map(rng, cells, storage)
+    return lambda: prob_map.convert_to_prob_map(0.5, normalization=True)
+
+
+def bench_get_info_from_neighbors(rng, storage, cells, d):
+    sim = _make_sim(rng, d + 1, 0)
+    sim.add_edges([[0, i] for i in range(1, d + 1)])
+    for tracker in sim.trackers[1:]:
+        tracker.shareable_Q = _payload(rng, _random_keys(rng, cells), 'Q', tracker.id)
+    return lambda: sim.trackers[0].get_info_from_neighbors('Q')
+
+
+def bench_get_detection(rng, storage, targets_per_km2):
+    sim = _make_sim(rng, 1, targets_per_km2)
+    sim.trackers[0].position = np.zeros(2)
+    sim.query_targets(sim.trackers[0].position, 0)  # build the target index
+    return sim.trackers[0].sensor.get_detection
+
+
+def bench_step(rng, storage, N, targets_per_km2):
+    sim = _make_sim(rng, N, targets_per_km2, batch_sensing=True)
+    sim.add_edges([[i, (i + 1) % N] for i in range(N)]
+                  + [[i, (i + 3) % N] for i in range(N) if N > 6])
+    for tracker in sim.trackers:
+        tracker.prob_map = ProbMap(MAP_SIZE, MAP_SIZE, 1, center_x=0.0, center_y=0.0,
+                                   init_val=0.6, false_alarm_prob=0.05, storage=storage)
+    # let the maps fill up before timing
+    sim.step(5)
+    return sim.step
+
+
+BENCHMARKS = {
+    'map_update': bench_map_update,
+    'consensus': bench_consensus,
+    'convert_to_prob_map': bench_convert_to_prob_map,
+    'get_info_from_neighbors': bench_get_info_from_neighbors,
+    'get_detection': bench_get_detection,
+    'step': bench_step,
+}
+
+
+def run_meta(storage, repeat, number, seed):
+    """What a run's numbers depend on, saved with the results
+    """
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'storage': storage,
+            'map_size': MAP_SIZE,
+            'detections': DETECTIONS,
+            'repeat': repeat,
+            'number': number,
+            'seed': seed}
+
+
+# meta that must match for a comparison, and the value of baselines without it
+COMPARABLE_META = {'storage': None, 'map_size': MAP_SIZE, 'detections': DETECTIONS,
+                   'repeat': None, 'number': 1}
+
+
+def meta_mismatches(meta, baseline_meta):
+    """Differences between the setups of a run and of its baseline
+
+    Returns:
+        list: (key, baseline value, value) of the meta that must match but doesn't
+    """
+    return [(key, baseline_meta.get(key, default), meta[key])
+            for key, default in COMPARABLE_META.items()
+            if baseline_meta.get(key, default) != meta[key]]
+
+
+def result_key(name, params):
+    return name + '[' + ','.join(f'{k}={v}' for k, v in sorted(params.items())) + ']'
+
+
+def run_benchmark(name, params, storage='array', repeat=5, seed=0, number=5):
+    """Time one benchmark with one set of parameters
+
+    Args:
+        name (str): benchmark name, see BENCHMARKS
+        params (dict): keyword arguments of the benchmark
+        storage (str, optional): cell storage of the maps. Defaults to 'array'.
+        repeat (int, optional): Number of timings. Defaults to 5.
+        seed (int, optional): Seed of the states. Defaults to 0.
+        number (int, optional): Calls per timing, each on its own state. Defaults to 5.
+
+    Returns:
+        dict: {'name', 'params', 'times' [s per call], 'median' [s], 'min' [s], 'peak_memory' [bytes]}
+    """
+    setup = BENCHMARKS[name]
+    times = []
+    for i in range(repeat):
+        # the legacy code paths draw from the global stream
+        np.random.seed(seed + i)
+        calls = [setup(np.random.default_rng([seed + i, j]), storage, **params)
+                 for j in range(number)]
+        start = time.perf_counter()
+        for call in calls:
+            call()
+        times.append((time.perf_counter() - start) / number)
+        del calls
+    np.random.seed(seed)
+    call = setup(np.random.default_rng(seed), storage, **params)
+    tracemalloc.start()
+    call()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'name': name, 'params': params, 'times': times,
+            'median': statistics.median(times), 'min': min(times),
+            'peak_memory': peak}
+
+
+def run_suite(names, sweeps, storage='array', repeat=5, seed=0, number=5):
+    """Run every benchmark over its parameter sweep
+
+    Returns:
+        dict: {result key: result}, see run_benchmark
+    """
+    results = dict()
+    for name in names:
+        sweep = sweeps[name]
+        for values in itertools.product(*sweep.values()):
+            params = dict(zip(sweep.keys(), values))
+            result = run_benchmark(name, params, storage, repeat, seed, number)
+            results[result_key(name, params)] = result
+            print(f"{result_key(name, params):<55} "
+                  f"{result['median'] * 1e3:10.3f} ms "
+                  f"(min {result['min'] * 1e3:.3f}) "
+                  f"{result['peak_memory'] / 1024:10.1f} KiB", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline
+
+    Args:
+        results (dict): {result key: result} of this run
+        baseline (dict): {result key: result} of the baseline
+        tolerance (float): Relative slow down flagged as a regression. The fastest
+            calls are compared, they are the least disturbed by the rest of the machine
+
+    Returns:
+        list: keys of the regressed benchmarks
+    """
+    regressions = []
+    print(f"\n{'benchmark':<55} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['min'] / baseline[key]['min']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 / (1 + tolerance):
+            flag = '  faster'
+        print(f"{key:<55} {baseline[key]['min'] * 1e3:9.3f} ms "
+              f"{result['min'] * 1e3:9.3f} ms {ratio:7.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the ProbMap and Tracker hot paths")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument('--quick', action='store_true', help="smaller sweeps")
+    parser.add_argument('--storage', default='array', choices=['dict', 'array', 'tiled'],
+                        help="cell storage of the maps")
+    parser.add_argument('--repeat', type=int, default=5, help="timings per case")
+    parser.add_argument('--number', type=int, default=5,
+                        help="calls per timing, each on a fresh state")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='JSON', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='JSON', help="compare with a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slow down flagged as a regression")
+    parser.add_argument('--force', action='store_true',
+                        help="compare even if the baseline ran with another setup")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    meta = run_meta(args.storage, args.repeat, args.number, args.seed)
+    baseline = None
+    if args.compare:
+        # checked before running, a mismatch would waste the whole sweep
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        mismatches = meta_mismatches(meta, baseline.get('meta', {}))
+        for key, then, now in mismatches:
+            print(f"{args.compare} ran with {key}={then}, this run with {key}={now}",
+                  file=sys.stderr)
+        if mismatches and not args.force:
+            print("Not comparable, rerun with the baseline's setup or pass --force",
+                  file=sys.stderr)
+            return 2
+    results = run_suite(args.only, QUICK_SWEEPS if args.quick else SWEEPS,
+                        args.storage, args.repeat, args.seed, args.number)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if baseline is not None:
+        if compare(results, baseline['results'], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,30 @@ import numpy as np
 
 
 class Target(Robot):
+    motion_group = 'targets'
+
     def __init__(self, simulator, name: str, id: int, position: np.array) -> None:
         super().__init__(simulator, name, id, position)
 
     def job(self):
         # return 0
-        if self.waypoint_ctrl():
-            self.ang = (self.ang + np.deg2rad(15)) % 360
-            rot_mat = np.asarray([[np.cos(self.ang), -np.sin(self.ang)],
-                                  [np.sin(self.ang), np.cos(self.ang)]])
-            self.waypoint_ctrl(speed=20, desired_pos=(self.position
-                                                      - np.dot([0, 10], rot_mat)))
+        self.job_all([self])
+
+    @staticmethod
+    def job_all(targets):
+        """job for many targets of the same simulator at once
+
+        Args:
+            targets (list): targets sharing one Kinematics group
+        """
+        if not targets:
+            return
+        motion = targets[0]._motion
+        slots = np.array([t._slot for t in targets], dtype=np.int64)
+        arrived = slots[motion.advance(slots)]
+        if len(arrived):
+            motion.ang[arrived] = (motion.ang[arrived] + np.deg2rad(15)) % 360
+            ang = motion.ang[arrived]
+            # 10 m ahead, [0, 10] rotated by the new heading
+            motion.set_waypoints(arrived, -10*np.column_stack([np.sin(ang), np.cos(ang)]),
+                                 speed=20)
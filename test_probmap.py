@@ -0,0 +1,25 @@
+import numpy as np
+
+from ProbMap import ProbMap
+
+
+def test_indices_inside_up_to_the_last_cell():
+    # 10 x 4 cells from (-5, -2) to (5, 2)
+    prob_map = ProbMap(10, 4, 1, center_x=0., center_y=0.)
+    positions = np.array([[-5., -2.],     # first cell
+                          [4.99, 1.99],   # last cell
+                          [5., 0.],       # one cell past the right edge
+                          [0., 2.],       # one cell past the top edge
+                          [-5.01, 0.]])   # left of the area
+    index, inside = prob_map.get_xy_indices_from_xy_pos(positions)
+    assert index[:2].tolist() == [[0, 0], [9, 3]]
+    assert inside.tolist() == [True, True, False, False, False]
+
+
+def test_indices_match_the_scalar_conversion():
+    prob_map = ProbMap(10, 4, 1, center_x=0., center_y=0.)
+    positions = np.array([[-4.5, -1.5], [0.2, 0.7], [4.5, 1.5]])
+    index, inside = prob_map.get_xy_indices_from_xy_pos(positions)
+    assert inside.all()
+    assert [tuple(i) for i in index.tolist()] == \
+        [prob_map.get_xy_index_from_xy_pos(x, y) for x, y in positions]
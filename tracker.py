@@ -1,12 +1,13 @@
 import logging
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as st
 
-from ProbMap import ProbMap, ProbMapData
+from DeltaSharing import DeltaDecoder
+from ProbMap import ProbMap, ProbMapData, aggregate_cells
 from Robot import Robot
 
+logger = logging.getLogger(__name__)
+
 
 class Sensor:
     def __init__(self, tracker, coverage_radius=150) -> None:
@@ -16,34 +17,86 @@ class Sensor:
         self.coverage_radius = coverage_radius
         # the sensor's condidence will multiplied by this factor
         self.health = 1.0
+        # standard deviation of the detection noise [m]
+        self.noise_std = 1
+
+    @staticmethod
+    def make_detections(offsets, noise, std_dev, coverage_radius):
+        """Turn true target offsets into noisy detections
+
+        Works on any number of detections at once, the confidence of each one
+        comes from the density of its noise (closed-form normal pdf).
+
+        Args:
+            offsets (np.ndarray): (k, 2) true target positions relative to the tracker
+            noise (np.ndarray): (k, 2) noise drawn from N(0, std_dev)
+            std_dev (float or np.ndarray): noise standard deviation, scalar or (k,)
+            coverage_radius (float or np.ndarray): sensor range, scalar or (k,)
+
+        Returns:
+            np.ndarray: (k, 3) detections as [dx, dy, confidence]
+        """
+        std_dev = np.reshape(std_dev, (-1, 1))
+        pdf = np.exp(-0.5 * (noise / std_dev) ** 2) / (std_dev * np.sqrt(2 * np.pi))
+        confidence = pdf.sum(axis=1) * 2 / 2 * std_dev[:, 0]
+        confidence = np.maximum(confidence, 0.55)
+        detection = offsets + noise
+        # noise can push a detection out of range, pull it back to the edge
+        distance = np.linalg.norm(detection, axis=1)
+        scale = np.minimum(1., coverage_radius / np.maximum(distance, 1e-12))
+        detection = detection * scale[:, None]
+        return np.column_stack([detection, confidence])
+
+    @staticmethod
+    def sense_many(trackers, positions, target_index):
+        """Sense for many trackers in one pass
+
+        Finds every tracker-target pair in range at once, draws each tracker's
+        noise from its own seeded generator and hands every tracker its array
+        of detections.
+
+        Args:
+            trackers (list): the trackers
+            positions (np.ndarray): (n, 2) positions of the trackers
+            target_index (GridIndex): index of the targets' positions
+        """
+        radii = np.array([t.sensor.coverage_radius for t in trackers],
+                         dtype=np.float64)
+        std_devs = np.array([t.sensor.noise_std for t in trackers],
+                            dtype=np.float64)
+        tracker_ids, target_ids = target_index.query_pairs(
+            positions, radii)
+        counts = np.bincount(tracker_ids, minlength=len(trackers))
+        offsets = target_index.positions[target_ids] - positions[tracker_ids]
+        noise = np.concatenate(
+            [t.rng.normal(loc=0, scale=t.sensor.noise_std, size=(count, 2))
+             for t, count in zip(trackers, counts.tolist())] + [np.empty((0, 2))])
+        detections = Sensor.make_detections(offsets, noise, std_devs[tracker_ids],
+                                            radii[tracker_ids])
+        for t, det in zip(trackers, np.split(detections, np.cumsum(counts)[:-1])):
+            t.set_detections(det)
 
     def get_detection(self):
-        all_targets = self.tracker.simulator.targets
-        detections = []
-        for target in all_targets:
-            if np.linalg.norm(target.position - self.tracker.position) < self.coverage_radius:
-                detection = (target.position-self.tracker.position)
-                # logging.debug(
-                #     f"Ture {self.tracker.name}{self.tracker.id} detection:\t" + str(detection))
-                # make up some noise and calculate the confidence of the detection
-                std_dev = 1
-                noise = np.random.normal(loc=0, scale=std_dev, size=2)
-                confidence = sum(st.norm.pdf(
-                    noise, loc=0, scale=std_dev)*2)/2*std_dev
-                if confidence <= 0.55:
-                    confidence = 0.55
-                detection = detection + noise
-                distance = np.linalg.norm(detection)
-                if distance > self.coverage_radius:
-                    detection = detection * (self.coverage_radius/distance)
-                detection = np.append(detection, confidence)
-                detections.append(detection)
-                logging.debug(
-                    f"Noisy {self.tracker.log_head} Detection: {detection}")
+        simulator = self.tracker.simulator
+        in_range = simulator.query_targets(
+            self.tracker.position, self.coverage_radius)
+        offsets = np.array([simulator.targets[i].position for i in in_range.tolist()],
+                           dtype=np.float64).reshape(-1, 2) - self.tracker.position
+        # make up some noise and calculate the confidence of the detection,
+        # from the tracker's own seeded generator like sense_many
+        noise = self.tracker.rng.normal(
+            loc=0, scale=self.noise_std, size=offsets.shape)
+        detections = self.make_detections(
+            offsets, noise, self.noise_std, self.coverage_radius)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Noisy %s Detection: %s", self.tracker.log_head, detections,
+                         extra={'event': 'detection', 'tracker': self.tracker.id})
         return detections
 
 
 class Tracker(Robot):
+    motion_group = 'trackers'
+
     def __init__(self, simulator, name: str, id: int, position: np.array, coverage_radius) -> None:
         super().__init__(simulator, name, id, position)
         self.sensor = Sensor(self, coverage_radius)
@@ -54,115 +107,253 @@ class Tracker(Robot):
         self.resolution = 1  # meter
         self.prob_map = ProbMap(self.area_width, self.area_height, self.resolution,
                                 center_x=0.0, center_y=0.0, init_val=0.6,
-                                false_alarm_prob=0.05)
+                                false_alarm_prob=0.05, storage='array')
 
-        self.observations = dict()  # type: dict[tuple]
+        self.observations = np.empty((0, 3))  # [x, y, confidence] per row
+        self.local_v = (np.empty(0, dtype=np.int64), np.empty(0))  # (packed keys, values)
         self.shareable_v = ProbMapData()
         self.shareable_Q = ProbMapData()
         self.neighbors_v = dict()
         self.neighbors_Q = dict()
+        self.target_estimates = []
+        # one estimate per cluster of cells instead of one per cell
+        self.cluster_estimates = False
+        # delta sharing of the Q map, see DeltaSharing
+        self.q_encoder = None
+        self.q_decoder = DeltaDecoder()
+        # StepRecorder of the per-phase timings and counters, None when disabled
+        self.stats = None
+
+    def _timed(self, phase, func, *args, **kwargs):
+        if self.stats is None:
+            return func(*args, **kwargs)
+        return self.stats.timed(phase, func, *args, **kwargs)
+
+    def save_map(self, path):
+        """Save a snapshot of the local map, see ProbMap.save
+        """
+        self.prob_map.save(path)
+
+    def set_area(self, width, height, center_x, center_y):
+        """Replace the local map with an empty one covering another area
+
+        Args:
+            width (float): width of the monitored area [m]
+            height (float): height of the monitored area [m]
+            center_x (float): x of the area's center [m]
+            center_y (float): y of the area's center [m]
+        """
+        self.area_width = width
+        self.area_height = height
+        self.prob_map = ProbMap(width, height, self.resolution,
+                                center_x=center_x, center_y=center_y, init_val=0.6,
+                                false_alarm_prob=0.05,
+                                storage=type(self.prob_map.non_empty_cell))
+
+    def bootstrap_map(self, path):
+        """Start from a snapshot of a (neighbor's) map instead of an empty one
+
+        Args:
+            path (str): snapshot written by save_map or ProbMap.save
+        """
+        prob_map = ProbMap.load(path, storage=type(self.prob_map.non_empty_cell))
+        if not prob_map.same_geometry(self.prob_map):
+            raise ValueError(f"Snapshot {path} doesn't match the grid of {self.log_head}")
+        self.prob_map = prob_map
 
     def build_shareable_info(self, shareable_info, info_type):
         """Generate shareable information from local
 
         Args:
-            shareable_info (dict): Stores all local infomation. Format: {(x, y) : value}
+            shareable_info (dict): Stores all local infomation. Format: {(x, y) : value},
+                a (packed keys, values) tuple or a cell store
+        """
+        data = ProbMapData.from_mapping(shareable_info, info_type, self.id)
+        if info_type == 'Q':
+            self.shareable_Q = data
+        else:
+            self.shareable_v = data
+
+    def publish_Q(self):
+        """Publish the local map, as a delta if delta sharing is enabled
+        """
+        if self.q_encoder is None:
+            self.build_shareable_info(self.prob_map.non_empty_cell, 'Q')
+        else:
+            store = self.prob_map.non_empty_cell
+            self.shareable_Q = self.q_encoder.encode(
+                store.key_array(), store.value_array(), self.id, self.neighbor)
+        if self.stats is not None:
+            self.stats.add('bytes_sent_Q', self.shareable_Q.nbytes())
+
+    def acknowledge_Q(self, neighbor_id, version):
+        """A neighbor tells which version of our map it holds
+        """
+        if self.q_encoder is not None:
+            self.q_encoder.acknowledge(neighbor_id, version)
+
+    def update_neighbors(self, added=(), removed=()):
+        """Change the neighbors, forgetting what the removed ones shared
+
+        Args:
+            added (iterable, optional): IDs of the new neighbors. Defaults to ().
+            removed (iterable, optional): IDs of the neighbors out of range. Defaults to ().
         """
-        local_meas_info = ProbMapData()
-        local_meas_info.tracker_id = self.id
-        local_meas_info.type = info_type
-        for k, v in shareable_info.items():
-            local_meas_info.grid_ind += k
-            local_meas_info.values.append(v)
-        self.shareable_v = local_meas_info
+        for e in removed:
+            self.neighbor.discard(e)
+            self.neighbors_v.pop(e, None)
+            self.neighbors_Q.pop(e, None)
+            self.q_decoder.maps.pop(e, None)
+            if self.q_encoder is not None:
+                # gets a full snapshot should it come back
+                self.q_encoder.acked.pop(e, None)
+        self.neighbor.update(added)
 
     def get_info_from_neighbors(self, req_type):
-        neighbors_info = dict()
+        """Collect the neighbors' payloads and sum them up per cell
+
+        Args:
+            req_type (str): 'v' for measurements, 'Q' for maps
+
+        Returns:
+            tuple: (keys, sums) for 'v', (keys, sums, counts) for 'Q', see aggregate_cells
+        """
         # Send requests and get responses from all neighbors' services
         # Collect info from neighbors
         if req_type == 'v':
             for e in self.neighbor:
-                self.neighbors_v[e] = self.simulator.trackers[e].shareable_v
-
-            for _id, res in self.neighbors_v.items():
-                for i in range(len(res.values)):
-                    cell_ind = tuple([res.grid_ind[i*2], res.grid_ind[i*2+1]])
-                    # sum up all neighbors' measurement values
-                    value = res.values[i]
-                    try:
-                        neighbors_info[cell_ind] += value
-                    except KeyError:
-                        neighbors_info[cell_ind] = value
+                self.neighbors_v[e] = self.simulator.get_shared(e, 'v', self.id)
+            if self.stats is not None:
+                self.stats.add('bytes_received_v', sum(
+                    self.neighbors_v[e].nbytes() for e in self.neighbor))
+            # sum up all neighbors' measurement values
+            keys, sums, _counts = aggregate_cells(
+                self.neighbors_v[e] for e in self.neighbor)
+            return keys, sums
         elif req_type == 'Q':
             for e in self.neighbor:
-                self.neighbors_v[e] = self.simulator.trackers[e].shareable_Q
-            for _id, res in self.neighbors_Q.items():
-                for i in range(len(res.values)):
-                    cell_ind = tuple([res.grid_ind[i*2], res.grid_ind[i*2+1]])
-                    # sum up all neighbors' values and counting, need to calculate average value
-                    value = res.values[i]
-                    try:
-                        neighbors_info[cell_ind][0] += value
-                        neighbors_info[cell_ind][1] += 1.
-                    except KeyError:
-                        neighbors_info[cell_ind] = [value, 1.]
-        return neighbors_info
+                payload = self.simulator.get_shared(e, 'Q', self.id)
+                if self.stats is not None:
+                    self.stats.add('bytes_received_Q', payload.nbytes())
+                res = self.q_decoder.decode(payload)
+                if res is None:
+                    continue
+                # a map read again was acknowledged already
+                acknowledged = res is self.neighbors_Q.get(e)
+                self.neighbors_Q[e] = res
+                if res.version and not acknowledged:
+                    self.simulator.acknowledge_Q(e, self.id, res.version)
+            # sum up all neighbors' values and counting, need to calculate average value
+            return aggregate_cells(self.neighbors_Q[e] for e in self.neighbor
+                                   if e in self.neighbors_Q)
 
     def sensing(self):
-        detections = self.sensor.get_detection()
-        output_detection = dict()
-        id_counter = 0
-        for det in detections:
-            transformed_detection = det+np.append(self.position, 0)
-            output_detection[id_counter] = transformed_detection
-            id_counter += 1
-        self.observations = output_detection
-    
+        self.set_detections(self.sensor.get_detection())
+
+    def set_detections(self, detections):
+        """Store detections as observations in world coordinates
+
+        Args:
+            detections (np.ndarray): (k, 3) detections as [dx, dy, confidence]
+        """
+        self.observations = detections + np.append(self.position, 0)
+        if self.stats is not None:
+            self.stats.add('detections', len(detections))
+
     def random_moving(self):
+        self.random_moving_all([self])
+
+    @staticmethod
+    def random_moving_all(trackers):
+        """random_moving for many trackers of the same simulator at once
+
+        Args:
+            trackers (list): trackers sharing one Kinematics group
+        """
+        if not trackers:
+            return
+        motion = trackers[0]._motion
+        slots = np.array([t._slot for t in trackers], dtype=np.int64)
         # if already reached the previous waypoint
-        if self.waypoint_ctrl():
-            self.ang = (self.ang + np.deg2rad(np.random.randint(-360, 360))) % 360
-            rot_mat = np.asarray([[np.cos(self.ang), -np.sin(self.ang)],
-                                  [np.sin(self.ang), np.cos(self.ang)]])
-            self.waypoint_ctrl(speed=20, desired_pos=(self.position
-                                                      - np.dot([0, 10], rot_mat)))
+        arrived = np.flatnonzero(motion.advance(slots))
+        if len(arrived) == 0:
+            return
+        for i in arrived.tolist():
+            t = trackers[i]
+            t.ang = (t.ang + np.deg2rad(t.rng.integers(-360, 360))) % 360
+        slots = slots[arrived]
+        ang = motion.ang[slots]
+        # 10 m ahead, [0, 10] rotated by the new heading
+        motion.set_waypoints(slots, -10*np.column_stack([np.sin(ang), np.cos(ang)]),
+                             speed=20)
 
     def job(self):
-        self.random_moving()
-        self.sensing()
+        self._timed('random_moving', self.random_moving)
+        self._timed('sensing', self.sensing)
+        self.fuse()
+
+    def fuse(self):
+        """Fuse the current observations with the neighbors' and estimate targets
+        """
+        self.publish_v()
+        self.update()
+        self.publish_Q()
+        self.merge()
+        self.estimate()
+
+    def publish_v(self):
+        """Convert the observations to measurements and publish them
+        """
         # logging.debug(f"{self.log_head} OBSERVATION: {self.observations}")
-        shareable_v = self.prob_map.generate_shareable_v(
-            self.observations)
+        self.local_v = self._timed('generate_shareable_v', self.prob_map.generate_shareable_v,
+                                   self.observations)
 
         # build shareable_v and publish it
-        self.build_shareable_info(shareable_v, 'v')
+        self.build_shareable_info(self.local_v, 'v')
+        if self.stats is not None:
+            self.stats.add('bytes_sent_v', self.shareable_v.nbytes())
         # logging.debug(f"{self.name}_{self.id}: {self.shareable_v.grid_ind}")
 
+    def update(self):
+        """Update the local map by all detections (local and neighbors')
+        """
         # get all neighbors' detections
-        neighbors_meas = self.get_info_from_neighbors('v')
+        neighbors_meas = self._timed('get_info_v', self.get_info_from_neighbors, 'v')
         # logging.debug("{}{} got neighbor {} info: {}".format(
         #     self.name, self.id, self.neighbor, neighbors_meas))
 
-        # # Update the local map by all detections (local and neighbors')
-        self.prob_map.map_update(shareable_v, neighbors_meas,
-                                 len(self.simulator.trackers), len(self.neighbor))
-
-        # Convert prob map to a shareable information and publish it
-        self.build_shareable_info(
-            self.prob_map.non_empty_cell, 'Q')
+        size = len(self.prob_map.non_empty_cell)
+        self._timed('map_update', self.prob_map.map_update, self.local_v, neighbors_meas,
+                    self.simulator.num_trackers, len(self.neighbor))
+        if self.stats is not None:
+            self.stats.add('cells_added', len(self.prob_map.non_empty_cell) - size)
 
+    def merge(self):
+        """Make consensus, merge neighbors' map
+        """
         # Collect neighbors' map (Q) for consensus
-        neighbors_map = self.get_info_from_neighbors('Q')
+        neighbors_map = self._timed('get_info_Q', self.get_info_from_neighbors, 'Q')
         # # rospy.loginfo("{} got neighbors' map: {}".format(
         # #     self.name, neighbors_map))
 
-        # Make consensus, merge neighbors' map
-        self.prob_map.consensus(neighbors_map)
+        size = len(self.prob_map.non_empty_cell)
+        self._timed('consensus', self.prob_map.consensus, neighbors_map)
+        if self.stats is not None:
+            self.stats.add('cells_added', len(self.prob_map.non_empty_cell) - size)
 
-        self.target_estimates = self.prob_map.get_target_est(
-            0.5, normalization=True)
-        logging.debug(
-            f"{self.name}_{self.id} ProbMap: {self.prob_map.prob_map}")
-        logging.debug(
-            f"{self.name}_{self.id} NonEmp: {self.prob_map.non_empty_cell}")
+    def estimate(self):
+        size = len(self.prob_map.non_empty_cell)
+        self.target_estimates = self._timed(
+            'get_target_est', self.prob_map.get_target_est,
+            0.5, normalization=True, cluster=self.cluster_estimates)
+        if self.stats is not None:
+            # low probability cells are pruned here
+            self.stats.add('cells_deleted', size - len(self.prob_map.non_empty_cell))
+            self.stats.set('active_cells', len(self.prob_map.non_empty_cell))
+            self.stats.set('estimates', len(self.target_estimates))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s ProbMap: %s", self.log_head, self.prob_map.prob_map,
+                         extra={'event': 'prob_map', 'tracker': self.id})
+            logger.debug("%s NonEmp: %s", self.log_head, self.prob_map.non_empty_cell,
+                         extra={'event': 'non_empty_cell', 'tracker': self.id})
         # print(target_estimates)